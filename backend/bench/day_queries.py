@@ -0,0 +1,212 @@
+"""
+Benchmark de las consultas por día sobre reservations.
+
+Crea un esquema desechable, carga N días de reservas (gimnasio por bloques y
+espacios comunes por día completo) y compara:
+
+  antes   -> consultas con start_time::date = ... y rangos con strings,
+             con los índices simples originales (res_id) y (dept_id)
+  despues -> rangos semiabiertos de timestamps con los índices compuestos
+             (res_id, start_time, id) y (dept_id, res_id, start_time)
+
+Imprime los planes EXPLAIN (ANALYZE, BUFFERS) y la mediana/p95 de cada
+consulta para cada tamaño de historial, de modo que se vea si el costo
+crece con la tabla o se mantiene plano.
+
+Uso:
+    DATABASE_URL=postgresql://... python bench/day_queries.py --sizes 90,365,730
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import time as clock
+from datetime import date, datetime, time, timedelta
+
+import psycopg
+from dotenv import load_dotenv
+
+SCHEMA = "bench_day_queries"
+BLOCK_HOURS = range(8, 21)
+GYM_ID = 1
+COMMON_IDS = (2, 3, 4)
+
+LEGACY_INDEXES = [
+    "CREATE INDEX ON reservations(res_id)",
+    "CREATE INDEX ON reservations(dept_id)",
+]
+NEW_INDEXES = [
+    "CREATE INDEX ON reservations(start_time, id)",
+    "CREATE INDEX ON reservations(dept_id, start_time, id)",
+    "CREATE INDEX ON reservations(res_id, start_time, id)",
+    "CREATE INDEX ON reservations(dept_id, res_id, start_time)",
+]
+
+# (nombre, consulta antes, consulta después). Los parámetros son (día, depto, recurso)
+QUERIES = [
+    (
+        "disponibilidad_gym",
+        "SELECT start_time, SUM(attendees) FROM reservations "
+        "WHERE res_id=1 AND start_time::date = %(day)s GROUP BY start_time",
+        "SELECT start_time, SUM(attendees) FROM reservations "
+        "WHERE res_id=1 AND start_time >= %(day_start)s AND start_time < %(day_end)s GROUP BY start_time",
+    ),
+    (
+        "reserva_gym_del_depto",
+        "SELECT id, start_time, attendees FROM reservations WHERE res_id=1 AND dept_id=%(dept)s "
+        "AND start_time >= %(day_start_str)s AND start_time <= %(day_last_str)s",
+        "SELECT id, start_time, attendees FROM reservations WHERE res_id=1 AND dept_id=%(dept)s "
+        "AND start_time >= %(day_start)s AND start_time < %(day_end)s",
+    ),
+    (
+        "reservas_comunes_del_dia",
+        "SELECT id, res_id, dept_id, start_time, end_time, attendees FROM reservations "
+        "WHERE start_time::date = %(day)s AND res_id=%(res)s ORDER BY res_id, start_time",
+        "SELECT id, res_id, dept_id, start_time, end_time, attendees FROM reservations "
+        "WHERE start_time >= %(day_start)s AND start_time < %(day_end)s AND res_id=%(res)s "
+        "ORDER BY res_id, start_time",
+    ),
+]
+
+
+def seed(conn, days: int, depts: int):
+    rng = random.Random(42)
+    first_day = date.today() - timedelta(days=days)
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SCHEMA}")
+        cur.execute(f"SET search_path TO {SCHEMA}")
+        cur.execute(
+            """
+            CREATE TABLE reservations (
+                id SERIAL PRIMARY KEY,
+                res_id INTEGER,
+                dept_id INTEGER,
+                start_time TIMESTAMP NOT NULL,
+                end_time TIMESTAMP NOT NULL,
+                attendees INTEGER NOT NULL
+            )
+            """
+        )
+        with cur.copy(
+            "COPY reservations (res_id, dept_id, start_time, end_time, attendees) FROM STDIN"
+        ) as copy:
+            for offset in range(days):
+                day = first_day + timedelta(days=offset)
+                for hour in BLOCK_HOURS:
+                    free = 3
+                    while free > 0 and rng.random() < 0.7:
+                        attendees = rng.randint(1, min(2, free))
+                        free -= attendees
+                        start = datetime.combine(day, time(hour))
+                        copy.write_row((GYM_ID, rng.randint(1, depts), start, start + timedelta(hours=1), attendees))
+                for res_id in COMMON_IDS:
+                    if rng.random() < 0.3:
+                        start = datetime.combine(day, time.min)
+                        end = start + timedelta(days=1) - timedelta(seconds=1)
+                        copy.write_row((res_id, rng.randint(1, depts), start, end, rng.randint(1, 30)))
+        cur.execute("SELECT count(*) FROM reservations")
+        rows = cur.fetchone()[0]
+    conn.commit()
+    return first_day, rows
+
+
+def params_for(day: date, dept: int, res_id: int) -> dict:
+    day_start = datetime.combine(day, time.min)
+    return {
+        "day": day.isoformat(),
+        "dept": dept,
+        "res": res_id,
+        "day_start": day_start,
+        "day_end": day_start + timedelta(days=1),
+        "day_start_str": f"{day.isoformat()}T00:00:00",
+        "day_last_str": f"{day.isoformat()}T23:59:59",
+    }
+
+
+def measure(conn, sql: str, samples: list) -> dict:
+    timings = []
+    with conn.cursor() as cur:
+        for p in samples:
+            t0 = clock.perf_counter()
+            cur.execute(sql, p)
+            cur.fetchall()
+            timings.append((clock.perf_counter() - t0) * 1000)
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, samples[0])
+        plan = "\n".join(r[0] for r in cur.fetchall())
+    timings.sort()
+    return {
+        "median_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 3),
+        "plan": plan,
+    }
+
+
+def run_phase(conn, indexes: list, column: int, samples: list) -> dict:
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT indexname FROM pg_indexes WHERE schemaname=%s AND indexname NOT LIKE '%%pkey'",
+            (SCHEMA,),
+        )
+        for (name,) in cur.fetchall():
+            cur.execute(f'DROP INDEX {SCHEMA}."{name}"')
+        for ddl in indexes:
+            cur.execute(ddl)
+        cur.execute("ANALYZE reservations")
+    conn.commit()
+    return {q[0]: measure(conn, q[column], samples) for q in QUERIES}
+
+
+def main():
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "..", ".env"))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="365", help="Días de historial a cargar, separados por coma")
+    parser.add_argument("--depts", type=int, default=200)
+    parser.add_argument("--samples", type=int, default=200, help="Ejecuciones por consulta")
+    parser.add_argument("--json", dest="json_path", help="Guarda los resultados en este archivo")
+    parser.add_argument("--keep", action="store_true", help="No borra el esquema al terminar")
+    args = parser.parse_args()
+
+    results = []
+    # Binding en el cliente, igual que hacía psycopg2, para comparar las consultas tal cual
+    with psycopg.connect(os.environ["DATABASE_URL"], cursor_factory=psycopg.ClientCursor) as conn:
+        try:
+            for days in (int(x) for x in args.sizes.split(",")):
+                first_day, rows = seed(conn, days, args.depts)
+                rng = random.Random(days)
+                samples = [
+                    params_for(
+                        first_day + timedelta(days=rng.randrange(days)),
+                        rng.randint(1, args.depts),
+                        rng.choice(COMMON_IDS),
+                    )
+                    for _ in range(args.samples)
+                ]
+                before = run_phase(conn, LEGACY_INDEXES, 1, samples)
+                after = run_phase(conn, NEW_INDEXES, 2, samples)
+                results.append({"days": days, "rows": rows, "antes": before, "despues": after})
+
+                print(f"\n=== {days} días, {rows} reservas ===")
+                for name, *_ in QUERIES:
+                    b, a = before[name], after[name]
+                    print(
+                        f"{name:28s} antes: {b['median_ms']:8.3f} ms (p95 {b['p95_ms']:8.3f})"
+                        f"   después: {a['median_ms']:8.3f} ms (p95 {a['p95_ms']:8.3f})"
+                    )
+                for name, *_ in QUERIES:
+                    print(f"\n--- {name} (antes) ---\n{before[name]['plan']}")
+                    print(f"\n--- {name} (después) ---\n{after[name]['plan']}")
+        finally:
+            if not args.keep:
+                with conn.cursor() as cur:
+                    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+                conn.commit()
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
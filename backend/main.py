@@ -1,60 +1,1133 @@
-# Bloques horarios del gimnasio
-BLOCKS = [
-    "08:00-09:00",
-    "09:00-10:00",
-    "10:00-11:00",
-    "11:00-12:00",
-    "12:00-13:00",
-    "13:00-14:00",
-    "14:00-15:00",
-    "15:00-16:00",
-    "16:00-17:00",
-    "17:00-18:00",
-    "18:00-19:00",
-    "19:00-20:00",
-    "20:00-21:00"
-]
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
-import psycopg2
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, ORJSONResponse
+from starlette.datastructures import Headers
+from pydantic import BaseModel, ValidationError, ValidationInfo, conint, field_validator
+from typing import List, Optional
+from uuid import UUID
+import orjson
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 import os
+import re
+import io
+import csv
+import base64
+import json
+import asyncio
+import contextvars
+import hashlib
+import hmac
+import secrets
+import socket
+import logging
+import math
+import random
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+import time as clock
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
 from dotenv import load_dotenv
-from datetime import date
-from sqlalchemy import create_engine
-from sqlalchemy.pool import NullPool
+from datetime import date, datetime, time, timedelta
 from passlib.context import CryptContext
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))
-from contextlib import contextmanager
+from contextlib import asynccontextmanager
+
+# Recurso que atienden los endpoints /api/reserve/gym. Sus bloques y aforo,
+# como los de cualquier recurso por bloques, viven en resource_schedules.
+GYM_RES_ID = int(os.getenv("GYM_RES_ID", "1"))
 
 # Configuración de conexión a PostgreSQL
- 
+# Pool asíncrono acotado: cada request espera una conexión sin ocupar un hilo,
+# y si no hay conexión libre en DB_POOL_TIMEOUT segundos responde 503.
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL, echo=True)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+# Umbral del log de consultas lentas (0 = desactivado)
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "0"))
 
-@contextmanager
-def get_db():
-    conn = engine.raw_connection()
-    try:
+
+def conninfo_from_url(url: str) -> str:
+    # Acepta también URLs estilo SQLAlchemy ('postgresql+psycopg2://...')
+    return re.sub(r"^postgres(ql)?\+\w+://", "postgresql://", url or "")
+
+
+async def configure_connection(conn: psycopg.AsyncConnection):
+    conn.cursor_factory = TimedCursor
+    await conn.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+    await conn.commit()
+
+
+pool = AsyncConnectionPool(
+    conninfo_from_url(DATABASE_URL),
+    min_size=DB_POOL_MIN,
+    max_size=DB_POOL_MAX,
+    timeout=DB_POOL_TIMEOUT,
+    max_lifetime=DB_POOL_RECYCLE,
+    max_idle=DB_POOL_MAX_IDLE,
+    check=AsyncConnectionPool.check_connection if DB_POOL_PRE_PING else None,
+    configure=configure_connection,
+    open=False,
+)
+
+
+@asynccontextmanager
+async def get_db():
+    # Al salir el pool hace rollback de lo no confirmado y recupera la conexión
+    requested = clock.perf_counter()
+    async with pool.connection() as conn:
+        DB_CHECKOUT_SECONDS.observe(clock.perf_counter() - requested)
         yield conn
-    finally:
-        conn.close()
+
+
+# Métricas en formato Prometheus (expuestas en /metrics)
+METRICS = []
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    """Valor leído al momento de exportar (p. ej. el largo de una cola)."""
+
+    def __init__(self, name: str, help: str, read):
+        self.name = name
+        self.help = help
+        self.read = read
+        METRICS.append(self)
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label_values -> [conteos acumulados por bucket, suma, total]
+        self.series = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value: float, *label_values):
+        with self.lock:
+            series = self.series.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(names, label_values + (bound,))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(names, label_values + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    # Con call_next se mide hasta que empieza la respuesta: en los streams (SSE,
+    # exportaciones, ?stream=true) no incluye el envío del cuerpo
+    "edi5_http_request_seconds", "Latencia por ruta hasta el inicio de la respuesta (sin el cuerpo de los streams)",
+    ("method", "route", "status"),
+)
+DB_QUERY_SECONDS = Histogram(
+    "edi5_db_query_seconds", "Duración de cada consulta SQL", ("statement",),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+DB_QUERY_ROWS = Histogram(
+    "edi5_db_query_rows", "Filas devueltas o afectadas por consulta", ("statement",),
+    buckets=(0, 1, 10, 100, 1000, 10000),
+)
+DB_CHECKOUT_SECONDS = Histogram(
+    "edi5_db_pool_checkout_seconds", "Espera para obtener una conexión del pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+Gauge("edi5_db_pool_size", "Conexiones abiertas por el pool", lambda: pool.get_stats().get("pool_size", 0))
+Gauge("edi5_db_pool_available", "Conexiones libres en el pool", lambda: pool.get_stats().get("pool_available", 0))
+Gauge("edi5_db_pool_waiting", "Requests esperando conexión", lambda: pool.get_stats().get("requests_waiting", 0))
+
+logger = logging.getLogger("edi5")
+slow_query_log = logging.getLogger("edi5.slow_query")
+
+
+def statement_kind(query) -> str:
+    # Primera palabra de la consulta: mantiene acotada la cardinalidad de las etiquetas
+    words = str(query).split(None, 1) if isinstance(query, (str, bytes)) else []
+    word = words[0].lower() if words else ""
+    return word if word in ("select", "insert", "update", "delete", "with", "set", "listen") else "other"
+
+
+class TimedCursor(psycopg.AsyncCursor):
+    """Cursor de las conexiones del pool: mide cada consulta y registra las lentas."""
+
+    async def execute(self, query, params=None, **kwargs):
+        started = clock.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            elapsed = clock.perf_counter() - started
+            kind = statement_kind(query)
+            DB_QUERY_SECONDS.observe(elapsed, kind)
+            if self.rowcount >= 0:
+                DB_QUERY_ROWS.observe(self.rowcount, kind)
+            if DB_SLOW_QUERY_MS and elapsed * 1000 >= DB_SLOW_QUERY_MS:
+                slow_query_log.warning("%.1f ms, %s filas: %s", elapsed * 1000, self.rowcount, query)
+
+
+# Réplicas de lectura (opcional): los GET más consultados leen de una réplica
+# sana elegida por turno. Una tarea revisa cada REPLICA_CHECK_INTERVAL segundos
+# que responda y que su retraso no pase de REPLICA_MAX_LAG_SECONDS; si ninguna
+# sirve, se lee del primario. Tras escribir, el cliente recibe X-Last-Write y
+# al reenviarlo lee del primario durante READ_YOUR_WRITES_SECONDS.
+DATABASE_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+DB_REPLICA_POOL_MAX = int(os.getenv("DB_REPLICA_POOL_MAX", str(DB_POOL_MAX)))
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "2"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))
+# Sin WAL pendiente de aplicar el retraso es 0 aunque el primario esté inactivo
+REPLICA_LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+DB_READS = Counter("edi5_db_reads_total", "Lecturas enrutadas por destino", ("target",))
+
+# True durante las solicitudes que deben leer del primario (escrituras y X-Last-Write reciente)
+read_from_primary = contextvars.ContextVar("read_from_primary", default=True)
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.pool = AsyncConnectionPool(
+            conninfo_from_url(url),
+            min_size=1,
+            max_size=DB_REPLICA_POOL_MAX,
+            timeout=DB_POOL_TIMEOUT,
+            max_lifetime=DB_POOL_RECYCLE,
+            max_idle=DB_POOL_MAX_IDLE,
+            configure=configure_connection,
+            open=False,
+        )
+        self.healthy = False
+        self.lag = None
+
+
+class ReplicaSet:
+    def __init__(self, urls: list):
+        self.replicas = [Replica(url) for url in urls]
+        self.turn = 0
+
+    def pick(self) -> Optional[Replica]:
+        healthy = [r for r in self.replicas if r.healthy]
+        if not healthy:
+            return None
+        self.turn += 1
+        return healthy[self.turn % len(healthy)]
+
+    async def open(self):
+        for replica in self.replicas:
+            # Sin esperar: una réplica caída no debe impedir que arranque la API
+            await replica.pool.open(wait=False)
+
+    async def close(self):
+        for replica in self.replicas:
+            await replica.pool.close()
+
+    async def check(self):
+        for replica in self.replicas:
+            try:
+                async with replica.pool.connection(timeout=REPLICA_CHECK_INTERVAL) as conn:
+                    cur = await conn.execute(REPLICA_LAG_QUERY)
+                    replica.lag = float((await cur.fetchone())[0])
+                replica.healthy = replica.lag <= REPLICA_MAX_LAG_SECONDS
+            except (PoolTimeout, psycopg.Error) as e:
+                if replica.healthy:
+                    logger.warning("Réplica fuera de servicio: %s", e)
+                replica.healthy = False
+
+    async def run(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+
+
+replicas = ReplicaSet(DATABASE_REPLICA_URLS)
+Gauge("edi5_db_replicas_healthy", "Réplicas de lectura en servicio", lambda: sum(r.healthy for r in replicas.replicas))
+
+
+@asynccontextmanager
+async def get_read_db():
+    """
+    Conexión para lecturas que toleran unos segundos de retraso. Las cargas de
+    caché siguen en get_db: un valor atrasado quedaría guardado hasta su TTL.
+    """
+    replica = None if read_from_primary.get() else replicas.pick()
+    if replica is not None:
+        entered = False
+        requested = clock.perf_counter()
+        try:
+            async with replica.pool.connection() as conn:
+                entered = True
+                DB_CHECKOUT_SECONDS.observe(clock.perf_counter() - requested)
+                DB_READS.inc("replica")
+                yield conn
+                return
+        except (PoolTimeout, psycopg.OperationalError):
+            if entered:
+                raise
+            # No se pudo conectar: la sacamos de la rotación hasta el próximo chequeo
+            replica.healthy = False
+    DB_READS.inc("primary")
+    async with get_db() as conn:
+        yield conn
+
+
+class ReadRoutingMiddleware:
+    """Decide primario/réplica por solicitud y marca con X-Last-Write las escrituras exitosas."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not replicas.replicas:
+            return await self.app(scope, receive, send)
+        if scope["method"] not in ("GET", "HEAD"):
+            read_from_primary.set(True)
+
+            async def mark_write(message):
+                if message["type"] == "http.response.start" and message["status"] < 400:
+                    headers = message.setdefault("headers", [])
+                    headers.append((b"x-last-write", str(int(clock.time() * 1000)).encode()))
+                await send(message)
+
+            return await self.app(scope, receive, mark_write)
+
+        last_write = Headers(scope=scope).get("x-last-write", "")
+        age = clock.time() * 1000 - int(last_write) if last_write.isdigit() else math.inf
+        read_from_primary.set(0 <= age < READ_YOUR_WRITES_SECONDS * 1000)
+        return await self.app(scope, receive, send)
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-app = FastAPI()
+# bcrypt tarda ~100-250 ms por operación. Corre en un pool de hilos propio y
+# acotado (bcrypt libera el GIL), y si la cola se llena respondemos 503 en vez
+# de dejar que una ráfaga de logins deje sin workers a las reservas.
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", "2"))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "16"))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+password_pending = 0
+
+PASSWORD_SECONDS = Histogram(
+    "edi5_password_hash_seconds", "Duración de cada operación bcrypt", ("op",),
+    buckets=(0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.5, 1, 2),
+)
+PASSWORD_WAIT_SECONDS = Histogram(
+    "edi5_password_queue_wait_seconds", "Espera en cola antes de ejecutar bcrypt", ("op",),
+)
+PASSWORD_REJECTED = Counter(
+    "edi5_password_rejected_total", "Operaciones bcrypt rechazadas por cola llena", ("op",),
+)
+Gauge("edi5_password_pending", "Operaciones bcrypt en curso o en cola", lambda: password_pending)
+
+
+async def run_password_op(op: str, fn, *args):
+    global password_pending
+    if password_pending >= PASSWORD_WORKERS + PASSWORD_QUEUE_LIMIT:
+        PASSWORD_REJECTED.inc(op)
+        raise HTTPException(
+            status_code=503,
+            detail="Demasiadas solicitudes de autenticación, intenta nuevamente",
+            headers={"Retry-After": "1"},
+        )
+    queued_at = clock.perf_counter()
+
+    def timed():
+        started = clock.perf_counter()
+        PASSWORD_WAIT_SECONDS.observe(started - queued_at, op)
+        try:
+            return fn(*args)
+        finally:
+            PASSWORD_SECONDS.observe(clock.perf_counter() - started, op)
+
+    password_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, timed)
+    finally:
+        password_pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await run_password_op("hash", pwd_context.hash, password)
+
+
+async def verify_password(password: str, password_hash: str) -> bool:
+    return await run_password_op("verify", pwd_context.verify, password, password_hash)
+
+
+# Difusión en vivo de la ocupación del gimnasio (SSE)
+# Con AVAILABILITY_NOTIFY=1 los cambios viajan por LISTEN/NOTIFY de PostgreSQL,
+# así todos los workers de uvicorn reciben los cambios de los demás.
+AVAILABILITY_CHANNEL = "gym_availability"
+AVAILABILITY_NOTIFY = os.getenv("AVAILABILITY_NOTIFY", "0") == "1"
+
+
+class AvailabilityBroadcaster:
+    """Reparte los cambios de ocupación a todos los streams abiertos del proceso."""
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self.subscribers = set()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, event: dict):
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Cliente lento: descartamos sus deltas y le pedimos resincronizar
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync"})
+
+
+broadcaster = AvailabilityBroadcaster()
+
+
+async def block_event(cur, schedule, start_time, occupied: Optional[int] = None) -> Optional[dict]:
+    """
+    Calcula la ocupación vigente del bloque dentro de la transacción en curso.
+    Debe llamarse antes del commit: con NOTIFY activo el aviso sale al confirmar.
+    Si quien llama ya conoce la ocupación (book_block la devuelve) no se vuelve a sumar.
+    """
+    if isinstance(start_time, str):
+        start_time = datetime.fromisoformat(start_time)
+    block = schedule.label_for(start_time)
+    if block is None:
+        return None
+    if occupied is None:
+        await cur.execute(
+            "SELECT COALESCE(MAX(attendees),0) FROM block_occupancy WHERE res_id=%s AND block_start=%s",
+            (schedule.res_id, start_time)
+        )
+        occupied = (await cur.fetchone())[0]
+    event = {
+        "type": "block",
+        "res_id": schedule.res_id,
+        "date": start_time.date().isoformat(),
+        "block": block,
+        "occupied": int(occupied),
+    }
+    if AVAILABILITY_NOTIFY:
+        await cur.execute("SELECT pg_notify(%s, %s)", (AVAILABILITY_CHANNEL, json.dumps(event)))
+    return event
+
+
+def announce(event: Optional[dict]):
+    # Tras el commit. Con NOTIFY el listener es quien reparte, incluso en este worker.
+    if event is not None and not AVAILABILITY_NOTIFY:
+        broadcaster.publish(event)
+
+
+# Caché en memoria de datos de referencia (recursos, departamentos, perfiles)
+# Cada mutación invalida su entrada; con AVAILABILITY_NOTIFY=1 la invalidación
+# viaja también por NOTIFY al resto de los workers. El TTL acota lo demás.
+CACHE_CHANNEL = "cache_invalidation"
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHES = {}
+CACHE_REQUESTS = Counter("edi5_cache_requests_total", "Lecturas de caché por resultado", ("cache", "result"))
+
+
+class CachedBody:
+    def __init__(self, data):
+        self.body = orjson.dumps(data)
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest() + '"'
+        self.loaded_at = int(clock.time())
+        self.expires_at = clock.monotonic() + CACHE_TTL_SECONDS
+
+
+class TTLCache:
+    """Caché read-through acotada: expulsa la entrada menos usada y expira por TTL."""
+
+    def __init__(self, name: str, maxsize: int = CACHE_MAX_ENTRIES):
+        self.name = name
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        # Índices derivados de los mismos datos (p. ej. access_codes), invalidados junto con la caché
+        self.dependents = []
+        CACHES[name] = self
+
+    def get(self, key) -> Optional[CachedBody]:
+        entry = self.entries.get(key)
+        if entry is None or entry.expires_at < clock.monotonic():
+            self.entries.pop(key, None)
+            CACHE_REQUESTS.inc(self.name, "miss")
+            return None
+        self.entries.move_to_end(key)
+        CACHE_REQUESTS.inc(self.name, "hit")
+        return entry
+
+    def put(self, key, data) -> CachedBody:
+        entry = CachedBody(data)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+        for dependent in self.dependents:
+            dependent.invalidate()
+
+
+resources_cache = TTLCache("resources")
+departments_cache = TTLCache("departments")
+users_cache = TTLCache("users")
+
+
+async def cached_json(request: Request, cache: TTLCache, key, load) -> Response:
+    """Sirve desde la caché (o carga con load()) y responde 304 si el cliente ya tiene esa versión."""
+    entry = cache.get(key)
+    if entry is None:
+        entry = cache.put(key, await load())
+    headers = {
+        "ETag": entry.etag,
+        "Last-Modified": formatdate(entry.loaded_at, usegmt=True),
+        # El navegador guarda la respuesta pero revalida siempre con If-None-Match
+        "Cache-Control": "private, no-cache",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        if if_none_match.strip() == "*" or entry.etag in (t.strip() for t in if_none_match.split(",")):
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get("if-modified-since"):
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"]).timestamp()
+            if entry.loaded_at <= since:
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
+# Horarios por recurso (resource_schedules + schedule_exceptions) compilados en
+# memoria al iniciar. Un recurso con horario se reserva por bloques con aforo;
+# uno sin horario, por día completo (quinchos, salas).
+def minutes_of(value: time) -> int:
+    return value.hour * 60 + value.minute
+
+
+class Schedule:
+    """
+    Horario compilado de un recurso. Los bloques forman una grilla fija desde la
+    hora de apertura, así que ubicar un timestamp en su bloque es aritmética.
+    Las excepciones solo acortan o cierran un día, nunca mueven la grilla.
+    """
+
+    def __init__(self, res_id: int, slot_minutes: int, opens_at: time, closes_at: time,
+                 capacity: int, dept_capacity: int, exceptions: dict):
+        self.res_id = res_id
+        self.slot_minutes = slot_minutes
+        self.opens = minutes_of(opens_at)
+        # closes_at = 00:00 significa medianoche del día siguiente
+        self.closes = minutes_of(closes_at) or 24 * 60
+        self.capacity = capacity
+        self.dept_capacity = dept_capacity
+        self.exceptions = exceptions
+        self.labels = [
+            f"{m // 60:02d}:{m % 60:02d}-{(m + slot_minutes) // 60 % 24:02d}:{(m + slot_minutes) % 60:02d}"
+            for m in range(self.opens, self.closes - slot_minutes + 1, slot_minutes)
+        ]
+        self.label_index = {label: i for i, label in enumerate(self.labels)}
+
+    def slot_index(self, start: datetime) -> Optional[int]:
+        offset = start.hour * 60 + start.minute - self.opens
+        if start.second or start.microsecond or offset < 0 or offset % self.slot_minutes:
+            return None
+        index = offset // self.slot_minutes
+        return index if index < len(self.labels) else None
+
+    def label_for(self, start: datetime) -> Optional[str]:
+        index = self.slot_index(start)
+        return None if index is None else self.labels[index]
+
+    def is_open(self, day: date, index: int) -> bool:
+        if day not in self.exceptions:
+            return True
+        hours = self.exceptions[day]
+        if hours is None:
+            return False
+        start = self.opens + index * self.slot_minutes
+        return hours[0] <= start and start + self.slot_minutes <= hours[1]
+
+    def block_bounds(self, day: date, label: str) -> Optional[tuple]:
+        """Inicio y fin del bloque 'HH:MM-HH:MM' ese día, o None si no existe o está cerrado."""
+        index = self.label_index.get(label)
+        if index is None or not self.is_open(day, index):
+            return None
+        start = datetime.combine(day, time.min) + timedelta(minutes=self.opens + index * self.slot_minutes)
+        return start, start + timedelta(minutes=self.slot_minutes)
+
+    def as_dict(self) -> dict:
+        return {
+            "res_id": self.res_id,
+            "slot_minutes": self.slot_minutes,
+            "opens_at": f"{self.opens // 60:02d}:{self.opens % 60:02d}",
+            "closes_at": f"{self.closes // 60 % 24:02d}:{self.closes % 60:02d}",
+            "capacity": self.capacity,
+            "dept_capacity": self.dept_capacity,
+            "slots": self.labels,
+            "exceptions": {
+                day.isoformat(): None if hours is None else [
+                    f"{hours[0] // 60:02d}:{hours[0] % 60:02d}", f"{hours[1] // 60 % 24:02d}:{hours[1] % 60:02d}"
+                ]
+                for day, hours in sorted(self.exceptions.items())
+            },
+        }
+
+
+class ScheduleIndex:
+    """Índice res_id -> Schedule. Invalidarlo lo recompila en la siguiente lectura."""
+
+    name = "schedules"
+
+    def __init__(self):
+        self.schedules = {}
+        self.stale = True
+        self.lock = asyncio.Lock()
+        CACHES[self.name] = self
+
+    async def load(self):
+        # Si alguien invalida durante la carga, stale vuelve a True y se recarga;
+        # si la carga falla, también, para reintentar en la siguiente lectura
+        self.stale = False
+        try:
+            async with get_db() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        "SELECT res_id, day, opens_at, closes_at FROM schedule_exceptions WHERE day >= CURRENT_DATE"
+                    )
+                    exceptions = {}
+                    for res_id, day, opens_at, closes_at in await cur.fetchall():
+                        hours = None if opens_at is None else (minutes_of(opens_at), minutes_of(closes_at) or 24 * 60)
+                        exceptions.setdefault(res_id, {})[day] = hours
+                    await cur.execute(
+                        "SELECT res_id, slot_minutes, opens_at, closes_at, capacity, dept_capacity FROM resource_schedules"
+                    )
+                    self.schedules = {
+                        r[0]: Schedule(*r, exceptions=exceptions.get(r[0], {})) for r in await cur.fetchall()
+                    }
+        except BaseException:
+            self.stale = True
+            raise
+
+    def invalidate(self, key=None):
+        self.stale = True
+
+    async def refresh(self):
+        if self.stale:
+            async with self.lock:
+                if self.stale:
+                    await self.load()
+
+    async def get(self, res_id: int) -> Optional[Schedule]:
+        await self.refresh()
+        return self.schedules.get(res_id)
+
+    async def require(self, res_id: int) -> Schedule:
+        schedule = await self.get(res_id)
+        if schedule is None:
+            raise HTTPException(status_code=404, detail="El recurso no tiene horario por bloques")
+        return schedule
+
+
+schedules = ScheduleIndex()
+
+
+async def commit_and_invalidate(conn, cache: TTLCache, key=None):
+    # El aviso a otros workers sale con el commit; la copia local se borra después
+    # para que ninguna lectura concurrente vuelva a cachear el dato anterior.
+    if AVAILABILITY_NOTIFY:
+        await conn.execute(
+            "SELECT pg_notify(%s, %s)", (CACHE_CHANNEL, json.dumps({"cache": cache.name, "key": key}))
+        )
+    await conn.commit()
+    cache.invalidate(key)
+
+
+async def listen_availability():
+    # Conexión dedicada fuera del pool, esperando NOTIFY sin bloquear el event loop
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(
+                conninfo_from_url(DATABASE_URL), autocommit=True
+            ) as conn:
+                await conn.execute(f"LISTEN {AVAILABILITY_CHANNEL}")
+                await conn.execute(f"LISTEN {CACHE_CHANNEL}")
+                async for notify in conn.notifies():
+                    payload = json.loads(notify.payload)
+                    if notify.channel == CACHE_CHANNEL:
+                        cache = CACHES.get(payload["cache"])
+                        if cache is not None:
+                            cache.invalidate(payload.get("key"))
+                    else:
+                        broadcaster.publish(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Listener de disponibilidad caído, reintentando: %s", e)
+            await asyncio.sleep(5)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await pool.open()
+    await replicas.open()
+    await schedules.load()
+    await access_codes.load()
+    tasks = []
+    if replicas.replicas:
+        tasks.append(asyncio.create_task(replicas.run()))
+    if AVAILABILITY_NOTIFY:
+        tasks.append(asyncio.create_task(listen_availability()))
+    if BOOKING_QUEUE_WINDOW_SECONDS > 0:
+        tasks.append(asyncio.create_task(booking_queue.run()))
+    if SCHEDULER_ENABLED:
+        tasks.append(asyncio.create_task(scheduler.run_forever()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await replicas.close()
+    await pool.close()
+    password_executor.shutdown(wait=False)
+
+
+# Idempotency-Key en los POST de reservas y altas: la primera respuesta (< 500)
+# queda en idempotency_keys y los reintentos reciben esa misma respuesta sin
+# volver a ejecutar el endpoint. Un LRU del proceso evita ir a la base en el
+# caso común (el reintento cae en el mismo worker).
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENT_PATHS = {
+    "/api/reserve/gym",
+    "/api/reserve/common",
+    "/api/reservations",
+    "/api/reservations/batch",
+    "/api/users",
+    "/api/departments",
+    "/api/resources",
+}
+IDEMPOTENCY_RETRYABLE = {401, 409, 429}
+IDEMPOTENCY_REPLAYS = Counter(
+    "edi5_idempotency_replays_total", "Respuestas repetidas por Idempotency-Key", ("source",),
+)
+
+
+async def claim_idempotency_key(key: str, path: str, request_hash: str) -> Optional[tuple]:
+    """
+    Reserva la clave para esta solicitud. Devuelve None si quedó reservada (o la
+    anterior ya expiró); si no, la fila existente (request_hash, status, content_type, body).
+    """
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                INSERT INTO idempotency_keys (key, scope, request_hash) VALUES (%s, %s, %s)
+                ON CONFLICT (key, scope) DO UPDATE
+                   SET request_hash = EXCLUDED.request_hash, status_code = NULL,
+                       content_type = NULL, body = NULL, created_at = now()
+                 WHERE idempotency_keys.created_at < now() - make_interval(secs => %s)
+                RETURNING key
+                """,
+                (key, path, request_hash, IDEMPOTENCY_TTL_SECONDS),
+            )
+            claimed = await cur.fetchone()
+            existing = None
+            if not claimed:
+                await cur.execute(
+                    "SELECT request_hash, status_code, content_type, body FROM idempotency_keys WHERE key=%s AND scope=%s",
+                    (key, path),
+                )
+                existing = await cur.fetchone()
+            await conn.commit()
+            return existing
+
+
+async def store_idempotent_response(key: str, path: str, status: int, content_type: Optional[str], body: bytes):
+    async with get_db() as conn:
+        await conn.execute(
+            "UPDATE idempotency_keys SET status_code=%s, content_type=%s, body=%s WHERE key=%s AND scope=%s",
+            (status, content_type, body, key, path),
+        )
+        await conn.commit()
+
+
+async def release_idempotency_key(key: str, path: str):
+    # Error del servidor: liberamos la clave para que el reintento se ejecute de nuevo
+    async with get_db() as conn:
+        await conn.execute(
+            "DELETE FROM idempotency_keys WHERE key=%s AND scope=%s AND status_code IS NULL", (key, path)
+        )
+        await conn.commit()
+
+
+def replay_request(body: bytes, receive):
+    """receive() que entrega el cuerpo ya leído y luego sigue con el original."""
+    consumed = False
+
+    async def replay_body():
+        nonlocal consumed
+        if consumed:
+            return await receive()
+        consumed = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return replay_body
+
+
+class IdempotencyMiddleware:
+    def __init__(self, app):
+        self.app = app
+        # ("ruta:usuario", key) -> (request_hash, status, content_type, body, expira)
+        self.recent = OrderedDict()
+
+    def remembered(self, cache_key) -> Optional[tuple]:
+        entry = self.recent.get(cache_key)
+        if entry is None or entry[4] < clock.monotonic():
+            self.recent.pop(cache_key, None)
+            return None
+        self.recent.move_to_end(cache_key)
+        return entry[:4]
+
+    def remember(self, cache_key, entry: tuple):
+        self.recent[cache_key] = (*entry, clock.monotonic() + IDEMPOTENCY_TTL_SECONDS)
+        self.recent.move_to_end(cache_key)
+        while len(self.recent) > IDEMPOTENCY_CACHE_SIZE:
+            self.recent.popitem(last=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in IDEMPOTENT_PATHS:
+            return await self.app(scope, receive, send)
+        key = Headers(scope=scope).get("idempotency-key")
+        if not key:
+            return await self.app(scope, receive, send)
+        if len(key) > 255:
+            response = JSONResponse({"detail": "Idempotency-Key demasiado larga"}, status_code=400)
+            return await response(scope, receive, send)
+
+        chunks, more = [], True
+        while more:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more = message.get("more_body", False)
+        body = b"".join(chunks)
+        request_hash = hashlib.sha256(body).hexdigest()
+        # La clave vale por usuario: sin una sesión válida no hay replay (el
+        # endpoint responderá 401) y nadie lee la respuesta guardada de otro
+        auth_scheme, _, token = Headers(scope=scope).get("authorization", "").partition(" ")
+        claims = read_token(token, "access") if auth_scheme.lower() == "bearer" else None
+        if claims is None:
+            return await self.app(scope, replay_request(body, receive), send)
+        path = f"{scope['path']}:{claims['sub']}"
+
+        stored = self.remembered((path, key))
+        source = "memory"
+        if stored is None:
+            stored = await claim_idempotency_key(key, path, request_hash)
+            source = "database"
+        if stored is not None:
+            response = self.replay(stored, request_hash, source)
+            if stored[1] is not None and stored[0] == request_hash:
+                self.remember((path, key), stored)
+            return await response(scope, receive, send)
+
+        status, content_type, response_chunks = 500, None, []
+
+        async def capture(message):
+            nonlocal status, content_type
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                content_type = Headers(raw=message["headers"]).get("content-type")
+            elif message["type"] == "http.response.body":
+                response_chunks.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, replay_request(body, receive), capture)
+        except BaseException:
+            await release_idempotency_key(key, path)
+            raise
+        # Errores del servidor, sesión vencida, conflictos (bloque muy solicitado)
+        # y límites de tasa no escribieron nada: la clave queda libre para reintentar
+        if status >= 500 or status in IDEMPOTENCY_RETRYABLE:
+            await release_idempotency_key(key, path)
+            return
+        response_body = b"".join(response_chunks)
+        await store_idempotent_response(key, path, status, content_type, response_body)
+        self.remember((path, key), (request_hash, status, content_type, response_body))
+
+    @staticmethod
+    def replay(stored: tuple, request_hash: str, source: str) -> Response:
+        stored_hash, status, content_type, body = stored
+        if stored_hash != request_hash:
+            return JSONResponse(
+                {"detail": "Esta Idempotency-Key ya se usó con otra solicitud"}, status_code=422
+            )
+        if status is None:
+            return JSONResponse(
+                {"detail": "La solicitud original aún se está procesando"},
+                status_code=409,
+                headers={"Retry-After": "1"},
+            )
+        IDEMPOTENCY_REPLAYS.inc(source)
+        return Response(
+            content=bytes(body), status_code=status, media_type=content_type,
+            headers={"Idempotent-Replayed": "true"},
+        )
+
+
+# Control de admisión: token bucket por departamento y por IP, más un tope de
+# solicitudes simultáneas por clase de endpoint. Lo que excede recibe 429/503
+# con Retry-After en vez de hacer cola por el pool de conexiones.
+# Con RATE_LIMIT_BACKEND=postgres los buckets viven en la base y el límite vale
+# para todos los workers; el default (memory) es por proceso.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+
+
+def parse_rate(spec: str) -> tuple:
+    # "tokens_por_segundo/ráfaga"; una tasa 0 desactiva el límite
+    rate, burst = spec.split("/")
+    return float(rate), float(burst)
+
+
+RATE_LIMITS = {
+    "booking_dept": parse_rate(os.getenv("RATE_LIMIT_BOOKING_DEPT", "0.2/5")),
+    "booking_ip": parse_rate(os.getenv("RATE_LIMIT_BOOKING_IP", "1/20")),
+    "read_ip": parse_rate(os.getenv("RATE_LIMIT_READ_IP", "5/50")),
+    "access_device": parse_rate(os.getenv("RATE_LIMIT_ACCESS_DEVICE", "0.2/10")),
+    "access_ip": parse_rate(os.getenv("RATE_LIMIT_ACCESS_IP", "50/500")),
+}
+BOOKING_MAX_CONCURRENCY = int(os.getenv("BOOKING_MAX_CONCURRENCY", "20"))
+READ_MAX_CONCURRENCY = int(os.getenv("READ_MAX_CONCURRENCY", "50"))
+RATE_LIMITED = Counter("edi5_rate_limited_total", "Solicitudes rechazadas por límite de tasa", ("limit",))
+ADMISSION_REJECTED = Counter("edi5_admission_rejected_total", "Solicitudes rechazadas por concurrencia", ("gate",))
+
+
+class TokenBucketLimiter:
+    """Buckets del proceso (LRU acotado). Devuelve los segundos a esperar; 0 si pasa."""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+
+    def peek(self, key: str, rate: float, burst: float) -> float:
+        """Como take, pero sin consumir el token."""
+        now = clock.monotonic()
+        tokens, last = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        now = clock.monotonic()
+        tokens, last = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+        self.buckets[key] = (tokens - 1 if wait == 0 else tokens, now)
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return wait
+
+
+class PostgresLimiter:
+    """Mismo algoritmo en la función take_token: un UPSERT atómico por solicitud."""
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        async with get_db() as conn:
+            cur = await conn.execute("SELECT take_token(%s, %s, %s)", (key, rate, burst))
+            wait = (await cur.fetchone())[0]
+            await conn.commit()
+            return wait
+
+
+rate_limiter = PostgresLimiter() if RATE_LIMIT_BACKEND == "postgres" else TokenBucketLimiter()
+
+
+def client_ip(request: Request) -> str:
+    # Detrás de un proxy, uvicorn --proxy-headers pone aquí la IP real
+    return request.client.host if request.client else "desconocida"
+
+
+def rate_limited(limit: str, wait: float) -> HTTPException:
+    RATE_LIMITED.inc(limit)
+    return HTTPException(
+        status_code=429,
+        detail="Demasiadas solicitudes, intenta en unos segundos",
+        headers={"Retry-After": str(math.ceil(wait))},
+    )
+
+
+async def enforce_rate_limit(limit: str, key, limiter=None):
+    rate, burst = RATE_LIMITS[limit]
+    if rate <= 0:
+        return
+    wait = await (limiter or rate_limiter).take(f"{limit}:{key}", rate, burst)
+    if wait > 0:
+        raise rate_limited(limit, wait)
+
+
+def limit_by_ip(limit: str):
+    async def dependency(request: Request):
+        await enforce_rate_limit(limit, client_ip(request))
+    return dependency
+
+
+class ConcurrencyGate:
+    """
+    Dependencia que acota las solicitudes simultáneas de una clase de endpoints.
+    El cupo se libera cuando el endpoint retorna: un StreamingResponse debe
+    envolver su cuerpo con hold() para seguir contando mientras se envía. El SSE
+    y las exportaciones de administración quedan fuera de los gates a propósito.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        Gauge(f"edi5_{name}_inflight", f"Solicitudes de {name} en curso", lambda: self.active)
+
+    async def __call__(self):
+        if self.active >= self.limit:
+            ADMISSION_REJECTED.inc(self.name)
+            raise HTTPException(
+                status_code=503,
+                detail="Servicio ocupado, intenta nuevamente",
+                headers={"Retry-After": "1"},
+            )
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+
+    async def hold(self, body):
+        # Ya admitido por la dependencia: aquí solo se cuenta, sin rechazar
+        self.active += 1
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            self.active -= 1
+
+
+booking_gate = ConcurrencyGate("booking", BOOKING_MAX_CONCURRENCY)
+read_gate = ConcurrencyGate("read", READ_MAX_CONCURRENCY)
+BOOKING_ADMISSION = [Depends(limit_by_ip("booking_ip")), Depends(booking_gate)]
+READ_ADMISSION = [Depends(limit_by_ip("read_ip")), Depends(read_gate)]
+
+
+app = FastAPI(lifespan=lifespan)
+# Va antes que CORS en la lista para quedar por dentro: las respuestas
+# repetidas también llevan las cabeceras CORS
+app.add_middleware(IdempotencyMiddleware)
+app.add_middleware(ReadRoutingMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"] ,
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Idempotent-Replayed", "X-Last-Write"]
 )
 
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = clock.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Plantilla de la ruta ('/api/users/{user_id}'), no la URL concreta
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(
+            clock.perf_counter() - started,
+            request.method,
+            route.path if route is not None else "unmatched",
+            status,
+        )
+
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    # Pool agotado: mejor rechazar rápido que encolar sin límite
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Servidor ocupado, intenta nuevamente"},
+        headers={"Retry-After": "1"},
+    )
+
+
 # Modelos CRUD
 class UserCreate(BaseModel):
     email: str
@@ -79,6 +1152,11 @@ class DepartmentUpdate(BaseModel):
     floor: Optional[int]
     access_code: Optional[str]
 
+class AccessVerifyRequest(BaseModel):
+    code: str
+    device_id: str
+    dept_id: Optional[int] = None
+
 class ResourceCreate(BaseModel):
     name: str
     type: str
@@ -89,7 +1167,8 @@ class ResourceUpdate(BaseModel):
 
 class ReservationCreate(BaseModel):
     res_id: int
-    dept_id: int
+    # Lo decide el token; solo un administrador puede indicar otro departamento
+    dept_id: Optional[int] = None
     start_time: str
     end_time: str
     attendees: int
@@ -99,221 +1178,658 @@ class ReservationUpdate(BaseModel):
     end_time: Optional[str]
     attendees: Optional[int]
 
+class ReservationSlot(BaseModel):
+    start_time: datetime
+    end_time: Optional[datetime] = None
+
+RECURRENCE_MAX_DAYS = int(os.getenv("RECURRENCE_MAX_DAYS", "366"))
+
+class Recurrence(BaseModel):
+    start_date: date
+    end_date: date
+    weekdays: List[conint(ge=0, le=6)] = []  # 0 = lunes ... 6 = domingo; vacío = todos los días
+    blocks: List[str] = []  # recursos por bloques, formato '08:00-09:00'
+
+    @field_validator("end_date")
+    @classmethod
+    def limit_span(cls, end_date: date, info: ValidationInfo) -> date:
+        # Acota el recorrido día a día de expand_batch_slots
+        start_date = info.data.get("start_date")
+        if start_date is not None and (end_date - start_date).days > RECURRENCE_MAX_DAYS:
+            raise ValueError(f"La recurrencia puede abarcar como máximo {RECURRENCE_MAX_DAYS} días")
+        return end_date
+
+
+class ReservationBatch(BaseModel):
+    res_id: int
+    # Lo decide el token; un administrador puede indicar otro o ninguno (p. ej. mantención)
+    dept_id: Optional[int] = None
+    attendees: int
+    slots: List[ReservationSlot] = []
+    recurrence: Optional[Recurrence] = None
+    # False: todo o nada. True: se crean los bloques válidos y se informan los demás
+    partial: bool = False
+
+
+# Modelos de respuesta de los listados. Esos endpoints devuelven la respuesta ya
+# serializada con orjson, así que aquí solo documentan el esquema (OpenAPI).
+class UserOut(BaseModel):
+    id: UUID
+    email: str
+    full_name: str
+    dept_id: Optional[int]
+    is_admin: Optional[bool]
+
+
+class ReservationOut(BaseModel):
+    id: int
+    res_id: Optional[int]
+    dept_id: Optional[int]
+    start_time: datetime
+    end_time: datetime
+    attendees: int
+
+
+class BlockReservationOut(BaseModel):
+    id: int
+    dept_id: Optional[int]
+    start_time: datetime
+    end_time: datetime
+    attendees: int
+
     # Endpoint de login
 class LoginRequest(BaseModel):
     email: str
     password: str
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
 class GymReservationRequest(BaseModel):
-    dept_id: int
+    # Lo decide el token; solo un administrador puede indicar otro departamento
+    dept_id: Optional[int] = None
     block: str  # formato '08:00-09:00'
     attendees: int
+    resource_id: int = GYM_RES_ID
+
+
+class ScheduleUpdate(BaseModel):
+    slot_minutes: int
+    opens_at: time
+    closes_at: time  # 00:00 = medianoche
+    capacity: int
+    dept_capacity: int
+
+
+class ScheduleExceptionUpdate(BaseModel):
+    # Sin horario = cerrado todo el día
+    opens_at: Optional[time] = None
+    closes_at: Optional[time] = None
 
 
 class CommonReservationRequest(BaseModel):
-    dept_id: int
+    dept_id: Optional[int] = None
     resource_id: int
     date: str  # formato 'YYYY-MM-DD'
     attendees: int
 
-@app.post("/api/reserve/gym")
-def reserve_gym(req: GymReservationRequest):
+def day_range(day) -> tuple:
+    """
+    Rango semiabierto [00:00 del día, 00:00 del día siguiente) para filtrar start_time.
+    Comparar la columna contra timestamps (y no castearla a date) permite usar los índices.
+    """
+    if isinstance(day, str):
+        try:
+            day = date.fromisoformat(day)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Fecha inválida, usa formato YYYY-MM-DD")
+    start = datetime.combine(day, time.min)
+    return start, start + timedelta(days=1)
+
+
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+
+async def fetch_json(query: str, params: tuple = ()) -> ORJSONResponse:
+    # Filas como dict directo del driver y orjson (datetime/UUID nativos), sin jsonable_encoder
+    async with get_read_db() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(query, params)
+            return ORJSONResponse(await cur.fetchall())
+
+
+def stream_json(query: str, params: tuple = (), gate: Optional[ConcurrencyGate] = None) -> StreamingResponse:
+    """Arreglo JSON escrito por lotes desde un cursor del servidor: memoria constante."""
+
+    async def chunks():
+        async with get_read_db() as conn:
+            async with conn.cursor(name=f"stream_{uuid4().hex}", row_factory=dict_row) as cur:
+                await cur.execute(query, params)
+                yield b"["
+                separator = b""
+                while batch := await cur.fetchmany(STREAM_BATCH_SIZE):
+                    yield separator + b",".join(orjson.dumps(row) for row in batch)
+                    separator = b","
+                yield b"]"
+
+    body = chunks() if gate is None else gate.hold(chunks())
+    return StreamingResponse(body, media_type="application/json")
+
+
+def raise_for_booking_status(status: str, slot_start: Optional[datetime], schedule: Schedule):
+    # Traduce el resultado de book_block / resize_block_reservation a errores HTTP
+    if status == "not_found":
+        raise HTTPException(status_code=404, detail="Reserva no encontrada")
+    if status == "dept_limit":
+        raise HTTPException(status_code=400, detail=f"Máximo {schedule.dept_capacity} personas por departamento")
+    if status == "other_block":
+        existing_hour = slot_start.strftime("%H:%M")
+        raise HTTPException(
+            status_code=400,
+            detail=f"Ya tienes una reserva en el bloque {existing_hour}. Elimínala para cambiar de horario."
+        )
+    if status == "full":
+        raise HTTPException(status_code=400, detail="Aforo total del bloque superado")
+
+
+# Sesiones sin estado: /api/login entrega un token firmado (HMAC-SHA256) con el
+# usuario, su departamento y su rol, y current_session lo verifica sin consultar
+# la base. El token de refresco dura más y /api/login/refresh relee al usuario.
+SESSION_SECRET = os.getenv("SESSION_SECRET", "")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "900"))
+REFRESH_TTL_SECONDS = int(os.getenv("REFRESH_TTL_SECONDS", "604800"))
+if not SESSION_SECRET:
+    # Sin secreto compartido cada worker firma con el suyo y los tokens no sobreviven un reinicio
+    SESSION_SECRET = secrets.token_urlsafe(32)
+    logger.warning("SESSION_SECRET no definido: se usa uno aleatorio solo válido para este proceso")
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def sign_token(claims: dict, ttl: int) -> str:
+    payload = b64url(orjson.dumps({**claims, "exp": int(clock.time()) + ttl}))
+    signature = hmac.new(SESSION_SECRET.encode(), payload.encode(), hashlib.sha256).digest()
+    return f"{payload}.{b64url(signature)}"
+
+
+def read_token(token: str, kind: str) -> Optional[dict]:
+    payload, _, signature = token.partition(".")
+    expected = b64url(hmac.new(SESSION_SECRET.encode(), payload.encode(), hashlib.sha256).digest())
+    if not hmac.compare_digest(signature, expected):
+        return None
     try:
-        start, end = req.block.split("-")
-        today = date.today().isoformat()
-        start_time = f"{today}T{start}:00"
-        end_time = f"{today}T{end}:00"
-    except Exception:
-        raise HTTPException(status_code=400, detail="Bloque horario inválido")
+        claims = orjson.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    except (ValueError, orjson.JSONDecodeError):
+        return None
+    if claims.get("typ") != kind or claims.get("exp", 0) < clock.time():
+        return None
+    return claims
 
-    if req.attendees < 1 or req.attendees > 2:
-        raise HTTPException(status_code=400, detail="Máximo 2 personas por departamento")
 
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            try:
-                # 1. Verificar si el departamento ya tiene una reserva en CUALQUIER bloque hoy
-                cur.execute(
+class Session:
+    def __init__(self, claims: dict):
+        self.user_id = claims["sub"]
+        self.dept_id = claims.get("dept")
+        self.is_admin = bool(claims.get("adm"))
+
+
+def issue_session(user_id, dept_id: Optional[int], is_admin: bool) -> dict:
+    claims = {"sub": str(user_id), "dept": dept_id, "adm": bool(is_admin)}
+    return {
+        "token": sign_token({**claims, "typ": "access"}, SESSION_TTL_SECONDS),
+        "refresh_token": sign_token({"sub": claims["sub"], "typ": "refresh"}, REFRESH_TTL_SECONDS),
+        "expires_in": SESSION_TTL_SECONDS,
+    }
+
+
+async def current_session(request: Request) -> Session:
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    claims = read_token(token, "access") if scheme.lower() == "bearer" else None
+    if claims is None:
+        raise HTTPException(
+            status_code=401, detail="Sesión inválida o expirada", headers={"WWW-Authenticate": "Bearer"}
+        )
+    return Session(claims)
+
+
+def session_dept(session: Session, requested: Optional[int]) -> int:
+    """Departamento por el que reserva la sesión: el del token, salvo que un administrador indique otro."""
+    if session.is_admin and requested is not None:
+        return requested
+    if session.dept_id is None:
+        raise HTTPException(status_code=400, detail="El usuario no tiene departamento asignado")
+    if requested is not None and requested != session.dept_id:
+        raise HTTPException(status_code=403, detail="No puedes reservar para otro departamento")
+    return session.dept_id
+
+
+async def admin_session(session: Session = Depends(current_session)) -> Session:
+    if not session.is_admin:
+        raise HTTPException(status_code=403, detail="Se requieren permisos de administrador")
+    return session
+
+
+# Rutas de administración (/api/admin/*, usuarios y altas/cambios de
+# departamentos, recursos y horarios): solo con una sesión de administrador
+ADMIN_ONLY = [Depends(admin_session)]
+
+
+# Modo de reserva por turnos para la apertura de bloques: durante los primeros
+# BOOKING_QUEUE_WINDOW_SECONDS tras la hora de apertura del recurso, reserve_gym
+# no compite por los locks. Encola la solicitud y responde 202 con un ticket;
+# un único asignador por worker junta lo que llega en BOOKING_QUEUE_BATCH_MS,
+# lo sortea (el orden no depende de la latencia de cada cliente) y lo resuelve
+# todo en una transacción con book_blocks(). 0 desactiva el modo.
+BOOKING_QUEUE_WINDOW_SECONDS = int(os.getenv("BOOKING_QUEUE_WINDOW_SECONDS", "0"))
+BOOKING_QUEUE_BATCH_MS = int(os.getenv("BOOKING_QUEUE_BATCH_MS", "200"))
+BOOKING_QUEUE_LIMIT = int(os.getenv("BOOKING_QUEUE_LIMIT", "1000"))
+TICKET_TTL_SECONDS = int(os.getenv("TICKET_TTL_SECONDS", "3600"))
+BOOKING_BATCH_SIZE = Histogram(
+    "edi5_booking_batch_size", "Solicitudes resueltas por lote del asignador",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+BOOKING_STATUS_MESSAGES = {"created": "Reserva creada", "updated": "Reserva actualizada"}
+
+
+def in_booking_window(schedule: Schedule, now: datetime) -> bool:
+    since_open = (now.hour * 60 + now.minute - schedule.opens) * 60 + now.second
+    return 0 <= since_open < BOOKING_QUEUE_WINDOW_SECONDS
+
+
+def ticket_result(status: str, slot_start: Optional[datetime], schedule: Schedule) -> dict:
+    if status == "busy":
+        return {"status": status, "ok": False, "detail": "El bloque está muy solicitado, intenta nuevamente"}
+    if status == "error":
+        return {"status": status, "ok": False, "detail": "Error interno, intenta nuevamente"}
+    try:
+        raise_for_booking_status(status, slot_start, schedule)
+    except HTTPException as e:
+        return {"status": status, "ok": False, "detail": e.detail}
+    return {"status": status, "ok": True, "message": BOOKING_STATUS_MESSAGES[status]}
+
+
+class BookingQueue:
+    def __init__(self):
+        self.pending = []
+        # ticket -> resultado (None mientras está pendiente) y evento para long-polling
+        self.tickets = {}
+        self.wakeup = asyncio.Event()
+
+    def submit(self, schedule: Schedule, dept_id: int, start_time: datetime, end_time: datetime, attendees: int) -> str:
+        if len(self.pending) >= BOOKING_QUEUE_LIMIT:
+            raise HTTPException(
+                status_code=503, detail="Demasiadas solicitudes en espera, intenta nuevamente",
+                headers={"Retry-After": "1"},
+            )
+        # El prefijo con la hora permite a otros workers saber si un ticket desconocido sigue vigente
+        ticket = f"{int(clock.time())}-{uuid4().hex}"
+        self.tickets[ticket] = [None, asyncio.Event()]
+        self.pending.append((ticket, schedule, dept_id, start_time, end_time, attendees))
+        self.wakeup.set()
+        return ticket
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(BOOKING_QUEUE_BATCH_MS / 1000)
+            self.wakeup.clear()
+            batch, self.pending = self.pending, []
+            random.shuffle(batch)
+            by_resource = {}
+            for item in batch:
+                by_resource.setdefault(item[1].res_id, []).append(item)
+            for items in by_resource.values():
+                try:
+                    await self.settle(items)
+                except Exception:
+                    logger.exception("Asignador de reservas: lote fallido")
+                    await self.fail(items)
+            self.expire()
+
+    async def settle(self, items: list):
+        schedule = items[0][1]
+        BOOKING_BATCH_SIZE.observe(len(items))
+        async with get_db() as conn:
+            async with conn.cursor() as cur:
+                # Un solo viaje: asigna el lote en orden y guarda el resultado de cada ticket
+                await cur.execute(
                     """
-                    SELECT id, start_time, attendees FROM reservations 
-                    WHERE res_id=1 AND dept_id=%s 
-                    AND start_time >= %s AND start_time <= %s
+                    WITH r AS (
+                        SELECT * FROM book_blocks(%s, %s::int[], %s::timestamp[], %s::timestamp[], %s::int[], %s, %s)
+                    ), t AS (
+                        INSERT INTO booking_tickets (id, res_id, status, reservation_id, slot_start)
+                        SELECT (%s::text[])[r.ord], %s, r.status, r.reservation_id, r.slot_start FROM r
+                    )
+                    SELECT ord, status, slot_start FROM r ORDER BY ord
                     """,
-                    (req.dept_id, f"{today}T00:00:00", f"{today}T23:59:59")
+                    (
+                        schedule.res_id,
+                        [item[2] for item in items],
+                        [item[3] for item in items],
+                        [item[4] for item in items],
+                        [item[5] for item in items],
+                        schedule.capacity,
+                        schedule.dept_capacity,
+                        [item[0] for item in items],
+                        schedule.res_id,
+                    ),
                 )
-                existing_res = cur.fetchone()
-
-                if existing_res:
-                    res_id, res_start, res_attendees = existing_res
-                    # Si la reserva existente es en un bloque DIFERENTE al solicitado, bloqueamos
-                    # Comparamos solo la parte de la hora del ISOstring
-                    existing_hour = res_start.strftime("%H:%M") # "08:00"
-                    if existing_hour != start:
-                        raise HTTPException(
-                            status_code=400, 
-                            detail=f"Ya tienes una reserva en el bloque {existing_hour}. Elimínala para cambiar de horario."
-                        )
-                    
-                    # Si es el MISMO bloque, validamos aforo y actualizamos
-                    # (Esto permite pasar de 1 a 2 personas en el mismo bloque)
-                    cur.execute(
-                        "SELECT COALESCE(SUM(attendees),0) FROM reservations WHERE start_time=%s AND res_id=1 AND id != %s",
-                        (start_time, res_id)
-                    )
-                    others_total = cur.fetchone()[0]
-                    
-                    if others_total + req.attendees > 3:
-                        raise HTTPException(status_code=400, detail="Aforo total del bloque superado")
-
-                    cur.execute(
-                        "UPDATE reservations SET attendees=%s WHERE id=%s",
-                        (req.attendees, res_id)
-                    )
-                    conn.commit()
-                    return {"ok": True, "message": "Reserva actualizada"}
+                rows = await cur.fetchall()
+                events = []
+                for start_time in sorted({item[3] for item in items}):
+                    event = await block_event(cur, schedule, start_time)
+                    if event:
+                        events.append(event)
+                await conn.commit()
+        for event in events:
+            announce(event)
+        for ord, status, slot_start in rows:
+            self.resolve(items[ord - 1][0], ticket_result(status, slot_start, schedule))
 
-                # 2. Si no hay reserva previa, procedemos con inserción normal
-                # Validar aforo total del bloque (máx 3)
-                cur.execute(
-                    "SELECT COALESCE(SUM(attendees),0) FROM reservations WHERE start_time=%s AND res_id=1",
-                    (start_time,)
+    async def fail(self, items: list):
+        # Resultado terminal también en la base: quien consulta el ticket desde
+        # otro worker ve el error en vez de "pending" hasta que venza
+        tickets = [item[0] for item in items]
+        for ticket in tickets:
+            self.resolve(ticket, ticket_result("error", None, items[0][1]))
+        try:
+            async with get_db() as conn:
+                await conn.execute(
+                    "INSERT INTO booking_tickets (id, res_id, status) "
+                    "SELECT unnest(%s::text[]), %s, 'error' ON CONFLICT (id) DO NOTHING",
+                    (tickets, items[0][1].res_id),
                 )
-                total_in_block = cur.fetchone()[0]
+                await conn.commit()
+        except Exception:
+            logger.exception("Asignador de reservas: no se pudieron registrar los tickets fallidos")
 
-                if total_in_block + req.attendees > 3:
-                    raise HTTPException(status_code=400, detail="Aforo total del bloque superado")
+    def resolve(self, ticket: str, result: dict):
+        entry = self.tickets.get(ticket)
+        if entry is not None:
+            entry[0] = result
+            entry[1].set()
 
-                cur.execute(
-                    """
-                    INSERT INTO reservations (res_id, dept_id, start_time, end_time, attendees)
-                    VALUES (1, %s, %s, %s, %s)
-                    """,
-                    (req.dept_id, start_time, end_time, req.attendees),
+    def expire(self):
+        cutoff = clock.time() - TICKET_TTL_SECONDS
+        for ticket in [t for t, (result, _) in self.tickets.items() if result and ticket_time(t) < cutoff]:
+            del self.tickets[ticket]
+
+
+def ticket_time(ticket: str) -> int:
+    try:
+        return int(ticket.split("-", 1)[0])
+    except ValueError:
+        return 0
+
+
+booking_queue = BookingQueue()
+
+
+@app.get("/api/reserve/gym/tickets/{ticket}")
+async def get_booking_ticket(ticket: str, wait: float = Query(0, ge=0, le=30, description="Segundos a esperar el resultado")):
+    entry = booking_queue.tickets.get(ticket)
+    if entry is not None:
+        # Ticket de este worker: esperamos el resultado sin consultar la base
+        if entry[0] is None and wait:
+            try:
+                await asyncio.wait_for(entry[1].wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+        return {"ticket": ticket, **(entry[0] or {"status": "pending"})}
+
+    deadline = clock.monotonic() + wait
+    while True:
+        async with get_db() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT res_id, status, slot_start FROM booking_tickets WHERE id=%s", (ticket,)
+                )
+                row = await cur.fetchone()
+        if row:
+            schedule = await schedules.require(row[0])
+            return {"ticket": ticket, **ticket_result(row[1], row[2], schedule)}
+        if clock.time() - ticket_time(ticket) > TICKET_TTL_SECONDS:
+            raise HTTPException(status_code=404, detail="Ticket no encontrado")
+        # Lo encoló otro worker y aún no se resuelve
+        if clock.monotonic() >= deadline:
+            return {"ticket": ticket, "status": "pending"}
+        await asyncio.sleep(0.25)
+
+
+@app.post("/api/reserve/gym", dependencies=BOOKING_ADMISSION)
+async def reserve_gym(req: GymReservationRequest, session: Session = Depends(current_session)):
+    dept_id = session_dept(session, req.dept_id)
+    await enforce_rate_limit("booking_dept", dept_id)
+    schedule = await schedules.require(req.resource_id)
+    bounds = schedule.block_bounds(date.today(), req.block)
+    if bounds is None:
+        raise HTTPException(status_code=400, detail="Bloque horario inválido")
+    start_time, end_time = bounds
+
+    if req.attendees < 1 or req.attendees > schedule.dept_capacity:
+        raise HTTPException(status_code=400, detail=f"Máximo {schedule.dept_capacity} personas por departamento")
+
+    if BOOKING_QUEUE_WINDOW_SECONDS > 0 and in_booking_window(schedule, datetime.now()):
+        ticket = booking_queue.submit(schedule, dept_id, start_time, end_time, req.attendees)
+        return JSONResponse(
+            {"ok": True, "queued": True, "ticket": ticket, "status": "pending"},
+            status_code=202,
+            headers={"Location": f"/api/reserve/gym/tickets/{ticket}"},
+        )
+
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            try:
+                # Validación de aforo + inserción/actualización en una sola operación atómica
+                await cur.execute(
+                    "SELECT status, reservation_id, slot_start, occupied FROM book_block(%s, %s, %s, %s, %s, %s, %s)",
+                    (schedule.res_id, dept_id, start_time, end_time, req.attendees,
+                     schedule.capacity, schedule.dept_capacity),
                 )
-                conn.commit()
+                status, resv_id, slot_start, occupied = await cur.fetchone()
+                raise_for_booking_status(status, slot_start, schedule)
+                event = await block_event(cur, schedule, start_time, occupied)
+                await conn.commit()
+                announce(event)
+                if status == "updated":
+                    return {"ok": True, "message": "Reserva actualizada"}
                 return {"ok": True, "message": "Reserva creada"}
 
             except HTTPException as he:
                 raise he
+            except psycopg.errors.LockNotAvailable:
+                raise HTTPException(status_code=409, detail="El bloque está muy solicitado, intenta nuevamente")
             except Exception as e:
-                conn.rollback()
+                await conn.rollback()
                 raise HTTPException(status_code=500, detail=f"Error interno: {e}")
 
-@app.put("/api/reserve/gym/{res_id}")
-def update_gym_reservation(res_id: int, req: GymReservationRequest):
+@app.put("/api/reserve/gym/{res_id}", dependencies=BOOKING_ADMISSION)
+async def update_gym_reservation(res_id: int, req: GymReservationRequest, session: Session = Depends(current_session)):
     """
     Endpoint específico para actualizaciones desde el panel lateral del Gym
     """
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            # Validar que la reserva exista
-            cur.execute("SELECT start_time FROM reservations WHERE id=%s", (res_id,))
-            row = cur.fetchone()
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            # El aforo depende del recurso de la reserva, no del que venga en el body
+            await cur.execute("SELECT res_id, dept_id FROM reservations WHERE id=%s", (res_id,))
+            row = await cur.fetchone()
             if not row:
                 raise HTTPException(status_code=404, detail="Reserva no encontrada")
-            
-            start_time = row[0]
-            
-            # Validar aforo de otros
-            cur.execute(
-                "SELECT COALESCE(SUM(attendees),0) FROM reservations WHERE start_time=%s AND res_id=1 AND id != %s",
-                (start_time, res_id)
-            )
-            others_total = cur.fetchone()[0]
-
-            if others_total + req.attendees > 3:
-                raise HTTPException(status_code=400, detail="Aforo excedido")
-
-            cur.execute("UPDATE reservations SET attendees=%s WHERE id=%s", (req.attendees, res_id))
-            conn.commit()
+            if not session.is_admin and row[1] != session.dept_id:
+                raise HTTPException(status_code=403, detail="La reserva es de otro departamento")
+            schedule = await schedules.require(row[0])
+            try:
+                await cur.execute(
+                    "SELECT status, reservation_id, slot_start, occupied FROM resize_block_reservation(%s, %s, %s, %s)",
+                    (res_id, req.attendees, schedule.capacity, schedule.dept_capacity),
+                )
+            except psycopg.errors.LockNotAvailable:
+                raise HTTPException(status_code=409, detail="El bloque está muy solicitado, intenta nuevamente")
+            status, _, slot_start, occupied = await cur.fetchone()
+            raise_for_booking_status(status, slot_start, schedule)
+            event = await block_event(cur, schedule, slot_start, occupied)
+            await conn.commit()
+            announce(event)
             return {"ok": True}
 
 # Modificación en el GET de disponibilidad para facilitar el consumo del front
-@app.get("/api/reserve/gym/availability")
-def get_gym_availability(date: Optional[str] = Query(None)):
-    if not date:
-        from datetime import date as dt_date
-        date = dt_date.today().isoformat()
-    
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
+@app.get("/api/reserve/gym/availability", dependencies=READ_ADMISSION)
+async def get_gym_availability(
+    date: Optional[str] = Query(None),
+    resource_id: int = Query(GYM_RES_ID),
+):
+    schedule = await schedules.require(resource_id)
+    day_start, day_end = day_range(date or datetime.today().date())
+
+    async with get_read_db() as conn:
+        async with conn.cursor() as cur:
+            # Lectura directa del resumen mantenido por trigger, sin agregar reservas
+            await cur.execute(
                 """
-                SELECT start_time, SUM(attendees)
-                FROM reservations
-                WHERE res_id=1 AND start_time::date = %s
-                GROUP BY start_time
+                SELECT block_start, attendees
+                FROM block_occupancy
+                WHERE res_id=%s AND block_start >= %s AND block_start < %s
                 """,
-                (date,)
+                (resource_id, day_start, day_end)
             )
-            rows = cur.fetchall()
+            rows = await cur.fetchall()
             # Retorna un diccionario { "08:00-09:00": ocupados }
             availability = {}
-            for r in rows:
-                # r[0] es un datetime -> extraemos "08:00"
-                time_str = r[0].strftime("%H:%M")
-                # Buscamos a qué bloque pertenece
-                for b in BLOCKS:
-                    if b.startswith(time_str):
-                        availability[b] = int(r[1])
+            for block_start, attendees in rows:
+                block = schedule.label_for(block_start)
+                if block is not None:
+                    availability[block] = int(attendees)
             return availability
 
 
+@app.get("/api/reserve/gym/availability/stream", dependencies=[Depends(limit_by_ip("read_ip"))])
+async def stream_gym_availability(request: Request, resource_id: int = Query(GYM_RES_ID)):
+    """
+    Server-Sent Events: un evento 'snapshot' con el mapa completo de ocupación
+    y luego un evento 'block' por cada bloque que cambia.
+    """
+    queue = broadcaster.subscribe()
+
+    async def events():
+        # EventSource no puede enviar X-Last-Write: el snapshot sale siempre del
+        # primario para no mostrar una réplica atrasada justo después de reservar
+        read_from_primary.set(True)
+        try:
+            today = date.today().isoformat()
+            snapshot = await get_gym_availability(today, resource_id)
+            yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # Mantiene viva la conexión a través de proxies
+                    yield ": ping\n\n"
+                    continue
+                if event.get("type") == "resync":
+                    today = date.today().isoformat()
+                    snapshot = await get_gym_availability(today, resource_id)
+                    yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+                elif event.get("date") == today and event.get("res_id") == resource_id:
+                    yield f"event: block\ndata: {json.dumps(event)}\n\n"
+        finally:
+            broadcaster.unsubscribe(queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
 @app.post("/api/login")
-def login(req: LoginRequest):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, email, password_hash, full_name, is_admin FROM users WHERE email=%s", (req.email,))
-            user = cur.fetchone()
-            if not user:
-                raise HTTPException(status_code=401, detail="Correo o contraseña incorrectos.")
-            user_id, email, password_hash, full_name, is_admin = user
-            if not pwd_context.verify(req.password, password_hash):
-                raise HTTPException(status_code=401, detail="Correo o contraseña incorrectos.")
-            return {
-                "id": user_id,
-                "email": email,
-                "full_name": full_name,
-                "is_admin": is_admin
-            }
+async def login(req: LoginRequest):
+    # bcrypt corre con la conexión ya devuelta al pool
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT id, email, password_hash, full_name, dept_id, is_admin FROM users WHERE email=%s", (req.email,))
+            user = await cur.fetchone()
+    if not user:
+        raise HTTPException(status_code=401, detail="Correo o contraseña incorrectos.")
+    user_id, email, password_hash, full_name, dept_id, is_admin = user
+    if not await verify_password(req.password, password_hash):
+        raise HTTPException(status_code=401, detail="Correo o contraseña incorrectos.")
+    return {
+        "id": user_id,
+        "email": email,
+        "full_name": full_name,
+        "dept_id": dept_id,
+        "is_admin": is_admin,
+        **issue_session(user_id, dept_id, is_admin),
+    }
+
+
+@app.post("/api/login/refresh")
+async def refresh_session(req: RefreshRequest):
+    claims = read_token(req.refresh_token, "refresh")
+    if claims is None:
+        raise HTTPException(status_code=401, detail="Sesión inválida o expirada")
+    # Releemos al usuario: un cambio de departamento o rol se refleja al refrescar
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT dept_id, is_admin FROM users WHERE id=%s", (claims["sub"],))
+            user = await cur.fetchone()
+    if not user:
+        raise HTTPException(status_code=401, detail="Sesión inválida o expirada")
+    return {"dept_id": user[0], "is_admin": user[1], **issue_session(claims["sub"], user[0], user[1])}
 
 
 # CRUD Usuarios
-@app.get("/api/users")
-def list_users():
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, email, full_name, dept_id, is_admin FROM users ORDER BY full_name")
-            return [
-                {"id": r[0], "email": r[1], "full_name": r[2], "dept_id": r[3], "is_admin": r[4]}
-                for r in cur.fetchall()
-            ]
+USERS_PAGE_QUERY = "SELECT id, email, full_name, dept_id, is_admin FROM users"
+
+
+def next_users_cursor(last: dict) -> str:
+    return encode_keyset(last["full_name"], str(last["id"]))
+
+
+@app.get("/api/users", response_model=List[UserOut], dependencies=ADMIN_ONLY)
+async def list_users(
+    stream: bool = Query(False, description="Envía las filas a medida que se leen"),
+    cursor: Optional[str] = Query(None, description="Valor de X-Next-Cursor de la página anterior"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Pagina el listado (sin limit, lista completa)"),
+):
+    if limit is None and cursor is None:
+        query = USERS_PAGE_QUERY + " ORDER BY full_name, id"
+        return stream_json(query) if stream else await fetch_json(query)
+    query, params = USERS_PAGE_QUERY, []
+    if cursor:
+        query += " WHERE (full_name, id) > (%s, %s::uuid)"
+        params.extend(decode_keyset(cursor, 2))
+    return await fetch_page(query + " ORDER BY full_name, id", params, limit or 100, next_users_cursor)
         
 # CRUD Usuarios
-@app.get("/api/users/{user_id}")
-def get_user(user_id: str):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, email, full_name, dept_id, is_admin FROM users WHERE id=%s", (user_id,))
-            r = cur.fetchone()
-            if not r:
-                raise HTTPException(status_code=404, detail="Usuario no encontrado")
-            return {"id": r[0], "email": r[1], "full_name": r[2], "dept_id": r[3], "is_admin": r[4]}
+@app.get("/api/users/{user_id}", dependencies=ADMIN_ONLY)
+async def get_user(user_id: str, request: Request):
+    async def load():
+        async with get_db() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT id, email, full_name, dept_id, is_admin FROM users WHERE id=%s", (user_id,))
+                r = await cur.fetchone()
+                if not r:
+                    raise HTTPException(status_code=404, detail="Usuario no encontrado")
+                return {"id": r[0], "email": r[1], "full_name": r[2], "dept_id": r[3], "is_admin": r[4]}
 
-@app.post("/api/users")
-def create_user(user: UserCreate):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            from uuid import uuid4
-            user_id = str(uuid4())
-            if len(user.password.encode('utf-8')) > 72:
-                raise HTTPException(status_code=400, detail="La contraseña no puede superar los 72 caracteres.")
-            try:
-                password_hash = pwd_context.hash(user.password)
-            except ValueError as e:
-                raise HTTPException(status_code=400, detail=f"Error al procesar la contraseña: {e}")
-            cur.execute(
+    return await cached_json(request, users_cache, user_id.lower(), load)
+
+@app.post("/api/users", dependencies=ADMIN_ONLY)
+async def create_user(user: UserCreate):
+    user_id = str(uuid4())
+    if len(user.password.encode('utf-8')) > 72:
+        raise HTTPException(status_code=400, detail="La contraseña no puede superar los 72 caracteres.")
+    # El hash se calcula antes de pedir una conexión al pool
+    try:
+        password_hash = await hash_password(user.password)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Error al procesar la contraseña: {e}")
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
                 """
                 INSERT INTO users (id, email, password_hash, full_name, dept_id, is_admin)
                 VALUES (%s, %s, %s, %s, %s, %s)
@@ -321,67 +1837,90 @@ def create_user(user: UserCreate):
                 """,
                 (user_id, user.email, password_hash, user.full_name, user.dept_id, user.is_admin),
             )
-            conn.commit()
-            r = cur.fetchone()
+            await conn.commit()
+            r = await cur.fetchone()
             return {"id": r[0], "email": r[1], "full_name": r[2], "dept_id": r[3], "is_admin": r[4]}
 
-@app.put("/api/users/{user_id}")
-def update_user(user_id: str, user: UserUpdate):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            fields = []
-            values = []
-            if user.full_name:
-                fields.append("full_name=%s")
-                values.append(user.full_name)
-            if user.dept_id:
-                fields.append("dept_id=%s")
-                values.append(user.dept_id)
-            if user.is_admin is not None:
-                fields.append("is_admin=%s")
-                values.append(user.is_admin)
-            if user.password:
-                fields.append("password_hash=%s")
-                from passlib.context import CryptContext
-                pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-                values.append(pwd_context.hash(user.password))
-            if not fields:
-                raise HTTPException(status_code=400, detail="Nada para actualizar")
-            values.append(user_id)
-            cur.execute(f"UPDATE users SET {', '.join(fields)} WHERE id=%s RETURNING id, email, full_name, dept_id, is_admin", tuple(values))
-            conn.commit()
-            r = cur.fetchone()
+@app.put("/api/users/{user_id}", dependencies=ADMIN_ONLY)
+async def update_user(user_id: str, user: UserUpdate):
+    fields = []
+    values = []
+    if user.full_name:
+        fields.append("full_name=%s")
+        values.append(user.full_name)
+    if user.dept_id:
+        fields.append("dept_id=%s")
+        values.append(user.dept_id)
+    if user.is_admin is not None:
+        fields.append("is_admin=%s")
+        values.append(user.is_admin)
+    if user.password:
+        fields.append("password_hash=%s")
+        values.append(await hash_password(user.password))
+    if not fields:
+        raise HTTPException(status_code=400, detail="Nada para actualizar")
+    values.append(user_id)
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(f"UPDATE users SET {', '.join(fields)} WHERE id=%s RETURNING id, email, full_name, dept_id, is_admin", tuple(values))
+            await commit_and_invalidate(conn, users_cache, user_id.lower())
+            r = await cur.fetchone()
             if not r:
                 raise HTTPException(status_code=404, detail="Usuario no encontrado")
             return {"id": r[0], "email": r[1], "full_name": r[2], "dept_id": r[3], "is_admin": r[4]}
 
-@app.delete("/api/users/{user_id}")
-def delete_user(user_id: str):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM users WHERE id=%s RETURNING id", (user_id,))
-            conn.commit()
-            r = cur.fetchone()
+@app.delete("/api/users/{user_id}", dependencies=ADMIN_ONLY)
+async def delete_user(user_id: str):
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("DELETE FROM users WHERE id=%s RETURNING id", (user_id,))
+            await commit_and_invalidate(conn, users_cache, user_id.lower())
+            r = await cur.fetchone()
             if not r:
                 raise HTTPException(status_code=404, detail="Usuario no encontrado")
             return {"id": r[0]}
 
 # CRUD Departamentos
 @app.get("/api/departments")
-def list_departments():
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, floor, access_code FROM departments ORDER BY id")
-            return [
-                {"id": r[0], "floor": r[1], "access_code": r[2]}
-                for r in cur.fetchall()
-            ]
+async def list_departments(
+    request: Request,
+    cursor: Optional[str] = Query(None, description="Valor de X-Next-Cursor de la página anterior"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Pagina el listado (sin limit, lista completa en caché)"),
+):
+    # Sin access_code: los códigos solo se validan con /api/access/verify
+    if limit is not None or cursor is not None:
+        return await departments_page("SELECT id, floor FROM departments", cursor, limit)
+
+    return await cached_json(request, departments_cache, "all", load_departments)
+
+
+@app.get("/api/admin/departments", dependencies=ADMIN_ONLY)
+async def list_departments_admin(
+    cursor: Optional[str] = Query(None, description="Valor de X-Next-Cursor de la página anterior"),
+    limit: int = Query(100, ge=1, le=500),
+):
+    return await departments_page("SELECT id, floor, access_code FROM departments", cursor, limit)
+
+
+async def departments_page(query: str, cursor: Optional[str], limit: Optional[int]):
+    params = []
+    if cursor:
+        query += " WHERE id > %s"
+        params.extend(decode_keyset(cursor, 1))
+    return await fetch_page(query + " ORDER BY id", params, limit or 100, lambda last: encode_keyset(last["id"]))
 
-@app.post("/api/departments")
-def create_department(dep: DepartmentCreate):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
+
+async def load_departments() -> list:
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT id, floor FROM departments ORDER BY id")
+            return [{"id": r[0], "floor": r[1]} for r in await cur.fetchall()]
+
+@app.post("/api/departments", dependencies=ADMIN_ONLY)
+async def create_department(dep: DepartmentCreate):
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
                 """
                 INSERT INTO departments (id, floor, access_code)
                 VALUES (%s, %s, %s)
@@ -389,19 +1928,19 @@ def create_department(dep: DepartmentCreate):
                 """,
                 (dep.id, dep.floor, dep.access_code),
             )
-            conn.commit()
-            r = cur.fetchone()
+            await commit_and_invalidate(conn, departments_cache)
+            r = await cur.fetchone()
             return {"id": r[0], "floor": r[1], "access_code": r[2]}
         
-@app.put("/api/departments/{dep_id}")
-def update_department(dep_id: int, dep: DepartmentUpdate):
-    with get_db() as conn:
-        with conn.cursor() as cur:
+@app.put("/api/departments/{dep_id}", dependencies=ADMIN_ONLY)
+async def update_department(dep_id: int, dep: DepartmentUpdate):
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
             fields = []
             values = []
-            if dep.number:
-                fields.append("number=%s")
-                values.append(dep.number)
+            if dep.id is not None and dep.id != dep_id:
+                fields.append("id=%s")
+                values.append(dep.id)
             if dep.floor:
                 fields.append("floor=%s")
                 values.append(dep.floor)
@@ -411,40 +1950,146 @@ def update_department(dep_id: int, dep: DepartmentUpdate):
             if not fields:
                 raise HTTPException(status_code=400, detail="Nada para actualizar")
             values.append(dep_id)
-            cur.execute(f"UPDATE departments SET {', '.join(fields)} WHERE id=%s RETURNING id, number, floor, access_code", tuple(values))
-            conn.commit()
-            r = cur.fetchone()
+            await cur.execute(f"UPDATE departments SET {', '.join(fields)} WHERE id=%s RETURNING id, floor, access_code", tuple(values))
+            await commit_and_invalidate(conn, departments_cache)
+            r = await cur.fetchone()
             if not r:
                 raise HTTPException(status_code=404, detail="Departamento no encontrado")
-            return {"id": r[0], "floor": r[2], "access_code": r[3]}
-
-@app.delete("/api/departments/{dep_id}")
-def delete_department(dep_id: int):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM departments WHERE id=%s RETURNING id", (dep_id,))
-            conn.commit()
-            r = cur.fetchone()
+            return {"id": r[0], "floor": r[1], "access_code": r[2]}
+
+@app.delete("/api/departments/{dep_id}", dependencies=ADMIN_ONLY)
+async def delete_department(dep_id: int):
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("DELETE FROM departments WHERE id=%s RETURNING id", (dep_id,))
+            await commit_and_invalidate(conn, departments_cache)
+            r = await cur.fetchone()
             if not r:
                 raise HTTPException(status_code=404, detail="Departamento no encontrado")
             return {"id": r[0]}
 
+# Verificación de códigos de acceso para paneles de puerta y citófonos. El
+# índice vive en memoria con solo HMAC de los códigos (clave aleatoria del
+# proceso) y se reconstruye cuando cambian los departamentos, así que validar
+# un código no va a la base. Tras una rotación, el código anterior sigue
+# valiendo ACCESS_CODE_GRACE_SECONDS para no dejar afuera a quien ya lo tenía.
+ACCESS_CODE_GRACE_SECONDS = int(os.getenv("ACCESS_CODE_GRACE_SECONDS", "900"))
+ACCESS_VERIFICATIONS = Counter("edi5_access_verifications_total", "Verificaciones de códigos de acceso", ("result",))
+
+
+class AccessCodeIndex:
+    """HMAC del código -> departamentos. Invalidarlo lo reconstruye en la siguiente verificación."""
+
+    name = "access_codes"
+
+    def __init__(self):
+        self.key = secrets.token_bytes(32)
+        self.current = {}
+        self.previous = {}
+        self.stale = True
+        self.lock = asyncio.Lock()
+        CACHES[self.name] = self
+        Gauge("edi5_access_codes", "Códigos de acceso en el índice", lambda: len(self.current))
+
+    def digest(self, code: str) -> bytes:
+        return hmac.new(self.key, code.strip().encode(), hashlib.sha256).digest()
+
+    async def load(self):
+        # Si alguien invalida durante la carga, stale vuelve a True y se recarga;
+        # si la carga falla, también, y se conserva el índice anterior
+        self.stale = False
+        try:
+            async with get_db() as conn:
+                cur = await conn.execute(
+                    """
+                    SELECT id, access_code, previous_access_code,
+                           EXTRACT(EPOCH FROM access_code_changed_at + make_interval(secs => %s) - now())
+                    FROM departments
+                    """,
+                    (ACCESS_CODE_GRACE_SECONDS,),
+                )
+                rows = await cur.fetchall()
+        except BaseException:
+            self.stale = True
+            raise
+        now = clock.monotonic()
+        current, previous = {}, {}
+        for dept_id, code, old_code, grace_left in rows:
+            current.setdefault(self.digest(code), []).append(dept_id)
+            if old_code and grace_left and grace_left > 0:
+                previous.setdefault(self.digest(old_code), []).append((dept_id, now + float(grace_left)))
+        self.current, self.previous = current, previous
+
+    def invalidate(self, key=None):
+        self.stale = True
+
+    async def refresh(self):
+        if self.stale:
+            async with self.lock:
+                if self.stale:
+                    await self.load()
+
+    def verify(self, code: str, dept_id: Optional[int] = None) -> Optional[int]:
+        """Departamento dueño del código, o None. Un código vigente gana a uno en periodo de gracia."""
+        digest = self.digest(code)
+        now = clock.monotonic()
+        previous = [d for d, expires_at in self.previous.get(digest, ()) if expires_at > now]
+        for candidates in (self.current.get(digest, ()), previous):
+            matches = [d for d in candidates if dept_id is None or d == dept_id]
+            if matches:
+                # Dos departamentos con el mismo código: el panel debe indicar dept_id
+                return matches[0] if len(matches) == 1 else None
+        return None
+
+
+access_codes = AccessCodeIndex()
+departments_cache.dependents.append(access_codes)
+# Siempre en memoria: con RATE_LIMIT_BACKEND=postgres cada intento iría a la base
+access_limiter = TokenBucketLimiter()
+
+
+@app.post("/api/access/verify")
+async def verify_access(req: AccessVerifyRequest, request: Request):
+    await enforce_rate_limit("access_ip", client_ip(request), access_limiter)
+    # Los intentos fallidos gastan tokens del dispositivo; agotados, ni un código válido pasa
+    rate, burst = RATE_LIMITS["access_device"]
+    device_key = f"access_device:{req.device_id}"
+    if rate > 0:
+        wait = access_limiter.peek(device_key, rate, burst)
+        if wait > 0:
+            ACCESS_VERIFICATIONS.inc("throttled")
+            raise rate_limited("access_device", wait)
+    await access_codes.refresh()
+    dept_id = access_codes.verify(req.code, req.dept_id)
+    if dept_id is None:
+        ACCESS_VERIFICATIONS.inc("denied")
+        if rate > 0:
+            await access_limiter.take(device_key, rate, burst)
+        return {"ok": False, "dept_id": None}
+    ACCESS_VERIFICATIONS.inc("granted")
+    return {"ok": True, "dept_id": dept_id}
+
+
 # CRUD Recursos
 @app.get("/api/resources")
-def list_resources():
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, name, type FROM resources ORDER BY name")
+async def list_resources(request: Request):
+    return await cached_json(request, resources_cache, "all", load_resources)
+
+
+async def load_resources() -> list:
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT id, name, type FROM resources ORDER BY name")
             return [
                 {"id": r[0], "name": r[1], "type": r[2]}
-                for r in cur.fetchall()
+                for r in await cur.fetchall()
             ]
 
-@app.post("/api/resources")
-def create_resource(res: ResourceCreate):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
+@app.post("/api/resources", dependencies=ADMIN_ONLY)
+async def create_resource(res: ResourceCreate):
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
                 """
                 INSERT INTO resources (name, type)
                 VALUES (%s, %s)
@@ -452,14 +2097,14 @@ def create_resource(res: ResourceCreate):
                 """,
                 (res.name, res.type),
             )
-            conn.commit()
-            r = cur.fetchone()
+            await commit_and_invalidate(conn, resources_cache)
+            r = await cur.fetchone()
             return {"id": r[0], "name": r[1], "type": r[2]}
 
-@app.put("/api/resources/{res_id}")
-def update_resource(res_id: int, res: ResourceUpdate):
-    with get_db() as conn:
-        with conn.cursor() as cur:
+@app.put("/api/resources/{res_id}", dependencies=ADMIN_ONLY)
+async def update_resource(res_id: int, res: ResourceUpdate):
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
             fields = []
             values = []
             if res.name:
@@ -471,40 +2116,222 @@ def update_resource(res_id: int, res: ResourceUpdate):
             if not fields:
                 raise HTTPException(status_code=400, detail="Nada para actualizar")
             values.append(res_id)
-            cur.execute(f"UPDATE resources SET {', '.join(fields)} WHERE id=%s RETURNING id, name, type", tuple(values))
-            conn.commit()
-            r = cur.fetchone()
+            await cur.execute(f"UPDATE resources SET {', '.join(fields)} WHERE id=%s RETURNING id, name, type", tuple(values))
+            await commit_and_invalidate(conn, resources_cache)
+            r = await cur.fetchone()
             if not r:
                 raise HTTPException(status_code=404, detail="Recurso no encontrado")
             return {"id": r[0], "name": r[1], "type": r[2]}
 
-@app.delete("/api/resources/{res_id}")
-def delete_resource(res_id: int):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM resources WHERE id=%s RETURNING id", (res_id,))
-            conn.commit()
-            r = cur.fetchone()
+@app.delete("/api/resources/{res_id}", dependencies=ADMIN_ONLY)
+async def delete_resource(res_id: int):
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("DELETE FROM resources WHERE id=%s RETURNING id", (res_id,))
+            await commit_and_invalidate(conn, resources_cache)
+            r = await cur.fetchone()
             if not r:
                 raise HTTPException(status_code=404, detail="Recurso no encontrado")
             return {"id": r[0]}
 
+# Horarios de recursos por bloques
+@app.get("/api/schedules")
+async def list_schedules():
+    await schedules.refresh()
+    return [schedule.as_dict() for _, schedule in sorted(schedules.schedules.items())]
+
+
+@app.get("/api/schedules/{res_id}")
+async def get_schedule(res_id: int):
+    return (await schedules.require(res_id)).as_dict()
+
+
+@app.put("/api/schedules/{res_id}", dependencies=ADMIN_ONLY)
+async def upsert_schedule(res_id: int, sch: ScheduleUpdate):
+    opens, closes = minutes_of(sch.opens_at), minutes_of(sch.closes_at) or 24 * 60
+    if sch.slot_minutes < 1 or closes - opens < sch.slot_minutes:
+        raise HTTPException(status_code=400, detail="El horario debe contener al menos un bloque")
+    if sch.capacity < 1 or not 1 <= sch.dept_capacity <= sch.capacity:
+        raise HTTPException(status_code=400, detail="Aforo inválido")
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            try:
+                await cur.execute(
+                    """
+                    INSERT INTO resource_schedules (res_id, slot_minutes, opens_at, closes_at, capacity, dept_capacity)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (res_id) DO UPDATE SET
+                        slot_minutes = EXCLUDED.slot_minutes, opens_at = EXCLUDED.opens_at,
+                        closes_at = EXCLUDED.closes_at, capacity = EXCLUDED.capacity,
+                        dept_capacity = EXCLUDED.dept_capacity
+                    """,
+                    (res_id, sch.slot_minutes, sch.opens_at, sch.closes_at, sch.capacity, sch.dept_capacity),
+                )
+            except psycopg.errors.ForeignKeyViolation:
+                raise HTTPException(status_code=404, detail="Recurso no encontrado")
+            await commit_and_invalidate(conn, schedules)
+    return (await schedules.require(res_id)).as_dict()
+
+
+@app.delete("/api/schedules/{res_id}", dependencies=ADMIN_ONLY)
+async def delete_schedule(res_id: int):
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("DELETE FROM resource_schedules WHERE res_id=%s RETURNING res_id", (res_id,))
+            r = await cur.fetchone()
+            await commit_and_invalidate(conn, schedules)
+            if not r:
+                raise HTTPException(status_code=404, detail="Horario no encontrado")
+            return {"res_id": r[0]}
+
+
+@app.put("/api/schedules/{res_id}/exceptions/{day}", dependencies=ADMIN_ONLY)
+async def upsert_schedule_exception(res_id: int, day: str, exc: ScheduleExceptionUpdate):
+    schedule = await schedules.require(res_id)
+    day_start, _ = day_range(day)
+    if (exc.opens_at is None) != (exc.closes_at is None):
+        raise HTTPException(status_code=400, detail="Indica apertura y cierre, o ninguno para cerrar el día")
+    if exc.opens_at is not None:
+        opens, closes = minutes_of(exc.opens_at), minutes_of(exc.closes_at) or 24 * 60
+        # Solo se puede acortar el día sobre la misma grilla de bloques
+        if (opens < schedule.opens or closes > schedule.closes or opens >= closes
+                or (opens - schedule.opens) % schedule.slot_minutes
+                or (closes - schedule.opens) % schedule.slot_minutes):
+            raise HTTPException(status_code=400, detail="El horario especial debe calzar con los bloques del recurso")
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                INSERT INTO schedule_exceptions (res_id, day, opens_at, closes_at)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (res_id, day) DO UPDATE SET opens_at = EXCLUDED.opens_at, closes_at = EXCLUDED.closes_at
+                """,
+                (res_id, day_start.date(), exc.opens_at, exc.closes_at),
+            )
+            await commit_and_invalidate(conn, schedules)
+    return (await schedules.require(res_id)).as_dict()
+
+
+@app.delete("/api/schedules/{res_id}/exceptions/{day}", dependencies=ADMIN_ONLY)
+async def delete_schedule_exception(res_id: int, day: str):
+    day_start, _ = day_range(day)
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "DELETE FROM schedule_exceptions WHERE res_id=%s AND day=%s RETURNING res_id",
+                (res_id, day_start.date()),
+            )
+            r = await cur.fetchone()
+            await commit_and_invalidate(conn, schedules)
+            if not r:
+                raise HTTPException(status_code=404, detail="Excepción no encontrada")
+            return {"res_id": r[0], "day": day_start.date().isoformat()}
+
+
 # CRUD Reservas
-@app.get("/api/reservations")
-def list_reservations():
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, res_id, dept_id, start_time, end_time, attendees FROM reservations ORDER BY start_time DESC")
-            return [
-                {"id": r[0], "res_id": r[1], "dept_id": r[2], "start_time": r[3], "end_time": r[4], "attendees": r[5]}
-                for r in cur.fetchall()
-            ]
+def parse_datetime_param(value: str, name: str) -> datetime:
+    # Acepta 'YYYY-MM-DD' o un ISO completo 'YYYY-MM-DDTHH:MM:SS'
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Parámetro '{name}' inválido, usa formato ISO")
+
+
+def encode_cursor(start_time: datetime, resv_id: int) -> str:
+    raw = f"{start_time.isoformat()}|{resv_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        start_str, id_str = base64.urlsafe_b64decode(padded).decode().split("|")
+        return datetime.fromisoformat(start_str), int(id_str)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+
+def encode_keyset(*values) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode().rstrip("=")
+
+
+def decode_keyset(cursor: str, size: int) -> list:
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return values
+
+
+async def fetch_page(query: str, params: list, limit: int, next_cursor) -> ORJSONResponse:
+    """Ejecuta una consulta keyset pidiendo limit + 1 filas y pone X-Next-Cursor si hay más."""
+    async with get_read_db() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(query + " LIMIT %s", (*params, limit + 1))
+            rows = await cur.fetchall()
+    response = ORJSONResponse(rows[:limit])
+    if len(rows) > limit:
+        response.headers["X-Next-Cursor"] = next_cursor(rows[limit - 1])
+    return response
 
-@app.post("/api/reservations")
-def create_reservation(res: ReservationCreate):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
+
+@app.get("/api/reservations", response_model=List[ReservationOut], dependencies=READ_ADMISSION)
+async def list_reservations(
+    dept_id: Optional[int] = Query(None),
+    user_id: Optional[UUID] = Query(None, description="Filtra por el departamento del usuario"),
+    res_id: Optional[int] = Query(None),
+    date_from: Optional[str] = Query(None, alias="from", description="Inicio inclusivo (ISO)"),
+    date_to: Optional[str] = Query(None, alias="to", description="Fin exclusivo (ISO)"),
+    cursor: Optional[str] = Query(None, description="Valor de X-Next-Cursor de la página anterior"),
+    limit: int = Query(100, ge=1, le=500),
+    stream: bool = Query(False, description="Todas las filas del filtro en un stream, sin paginar"),
+    archive: bool = Query(False, description="Incluye los meses archivados"),
+):
+    # Paginación por keyset sobre (start_time, id) descendente: cada página es un
+    # rango del índice, sin OFFSET, así que el costo no crece con el historial.
+    conditions = []
+    params = []
+    if dept_id is not None:
+        conditions.append("dept_id=%s")
+        params.append(dept_id)
+    if user_id is not None:
+        conditions.append("dept_id=(SELECT dept_id FROM users WHERE id=%s)")
+        params.append(user_id)
+    if res_id is not None:
+        conditions.append("res_id=%s")
+        params.append(res_id)
+    if date_from:
+        conditions.append("start_time >= %s")
+        params.append(parse_datetime_param(date_from, "from"))
+    if date_to:
+        conditions.append("start_time < %s")
+        params.append(parse_datetime_param(date_to, "to"))
+    if cursor:
+        conditions.append("(start_time, id) < (%s, %s)")
+        params.extend(decode_cursor(cursor))
+
+    # Con from/to el planner descarta las particiones fuera del rango
+    table = "reservations_history" if archive else "reservations"
+    query = f"SELECT id, res_id, dept_id, start_time, end_time, attendees FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY start_time DESC, id DESC"
+    if stream:
+        return stream_json(query, tuple(params), read_gate)
+    return await fetch_page(query, params, limit, lambda last: encode_cursor(last["start_time"], last["id"]))
+
+@app.post("/api/reservations", dependencies=BOOKING_ADMISSION)
+async def create_reservation(res: ReservationCreate, session: Session = Depends(current_session)):
+    res.dept_id = session_dept(session, res.dept_id)
+    await enforce_rate_limit("booking_dept", res.dept_id)
+    schedule = await schedules.get(res.res_id)
+    if schedule is not None:
+        return await create_block_reservation(res, schedule)
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
                 """
                 INSERT INTO reservations (res_id, dept_id, start_time, end_time, attendees)
                 VALUES (%s, %s, %s, %s, %s)
@@ -512,14 +2339,170 @@ def create_reservation(res: ReservationCreate):
                 """,
                 (res.res_id, res.dept_id, res.start_time, res.end_time, res.attendees),
             )
-            conn.commit()
-            r = cur.fetchone()
+            await conn.commit()
+            r = await cur.fetchone()
             return {"id": r[0], "res_id": r[1], "dept_id": r[2], "start_time": r[3], "end_time": r[4], "attendees": r[5]}
 
-@app.put("/api/reservations/{resv_id}")
-def update_reservation(resv_id: int, res: ReservationUpdate):
-    with get_db() as conn:
-        with conn.cursor() as cur:
+
+async def create_block_reservation(res: ReservationCreate, schedule: Schedule):
+    # En recursos por bloques la creación manual respeta el mismo aforo que reserve_gym
+    start_time = parse_datetime_param(res.start_time, "start_time")
+    end_time = parse_datetime_param(res.end_time, "end_time")
+    index = schedule.slot_index(start_time)
+    if index is None or not schedule.is_open(start_time.date(), index):
+        raise HTTPException(status_code=400, detail="Bloque horario inválido")
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            try:
+                await cur.execute(
+                    "SELECT status, reservation_id, slot_start, occupied FROM book_block(%s, %s, %s, %s, %s, %s, %s)",
+                    (schedule.res_id, res.dept_id, start_time, end_time, res.attendees,
+                     schedule.capacity, schedule.dept_capacity),
+                )
+            except psycopg.errors.LockNotAvailable:
+                raise HTTPException(status_code=409, detail="El bloque está muy solicitado, intenta nuevamente")
+            status, resv_id, slot_start, occupied = await cur.fetchone()
+            raise_for_booking_status(status, slot_start, schedule)
+            event = await block_event(cur, schedule, start_time, occupied)
+            await conn.commit()
+            announce(event)
+            return {"id": resv_id, "res_id": schedule.res_id, "dept_id": res.dept_id, "start_time": start_time, "end_time": end_time, "attendees": res.attendees}
+
+# Reserva de muchos bloques o días de un recurso en una sola transacción: la
+# función book_batch valida todo con una consulta y crea con un solo INSERT.
+BATCH_MAX_SLOTS = int(os.getenv("BATCH_MAX_SLOTS", "500"))
+BATCH_STATUS_MESSAGES = {
+    "created": "Reserva creada",
+    "full": "Cupo lleno",
+    "taken": "El recurso ya está reservado ese día",
+    "other_block": "El departamento ya tiene una reserva ese día",
+    "duplicate": "Bloque repetido en la solicitud",
+}
+
+
+def expand_batch_slots(batch: ReservationBatch, schedule: Optional[Schedule]) -> tuple:
+    """Bloques (inicio, fin) pedidos explícitamente y por recurrencia, más los días cerrados omitidos."""
+    slots, skipped = [], []
+    for slot in batch.slots:
+        if schedule is None:
+            slots.append(day_range(slot.start_time.date()))
+            continue
+        label = schedule.label_for(slot.start_time)
+        bounds = label and schedule.block_bounds(slot.start_time.date(), label)
+        if not bounds:
+            raise HTTPException(status_code=400, detail=f"Bloque horario inválido: {slot.start_time.isoformat()}")
+        slots.append(bounds)
+
+    rule = batch.recurrence
+    if rule is not None:
+        if rule.end_date < rule.start_date:
+            raise HTTPException(status_code=400, detail="La recurrencia termina antes de empezar")
+        if schedule is not None and not rule.blocks:
+            raise HTTPException(status_code=400, detail="Indica los bloques de la recurrencia")
+        if schedule is not None and any(b not in schedule.label_index for b in rule.blocks):
+            raise HTTPException(status_code=400, detail="Bloque horario inválido")
+        day = rule.start_date
+        while day <= rule.end_date and len(slots) <= BATCH_MAX_SLOTS:
+            if not rule.weekdays or day.weekday() in rule.weekdays:
+                if schedule is None:
+                    slots.append(day_range(day))
+                for block in rule.blocks if schedule is not None else ():
+                    bounds = schedule.block_bounds(day, block)
+                    if bounds:
+                        slots.append(bounds)
+                    else:
+                        skipped.append(f"{day.isoformat()} {block}")
+            day += timedelta(days=1)
+
+    if not slots:
+        raise HTTPException(status_code=400, detail="No hay bloques para reservar")
+    if len(slots) > BATCH_MAX_SLOTS:
+        raise HTTPException(status_code=400, detail=f"Máximo {BATCH_MAX_SLOTS} bloques por solicitud")
+    if schedule is None:
+        # Día completo, igual que reserve_common
+        slots = [(start, end - timedelta(seconds=1)) for start, end in slots]
+    return slots, skipped
+
+
+@app.post("/api/reservations/batch", dependencies=BOOKING_ADMISSION)
+async def create_reservation_batch(batch: ReservationBatch, session: Session = Depends(current_session)):
+    dept_id = batch.dept_id if session.is_admin else session_dept(session, batch.dept_id)
+    if dept_id is not None:
+        await enforce_rate_limit("booking_dept", dept_id)
+    schedule = await schedules.get(batch.res_id)
+    if batch.attendees < 1:
+        raise HTTPException(status_code=400, detail="Debe haber al menos 1 persona")
+    if schedule is not None and dept_id is not None and batch.attendees > schedule.dept_capacity:
+        raise HTTPException(status_code=400, detail=f"Máximo {schedule.dept_capacity} personas por departamento")
+    slots, skipped = expand_batch_slots(batch, schedule)
+
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            try:
+                await cur.execute(
+                    """
+                    SELECT ord, status, reservation_id, slot_start, occupied
+                    FROM book_batch(%s, %s, %s::timestamp[], %s::timestamp[], %s, %s, %s)
+                    """,
+                    (
+                        batch.res_id,
+                        dept_id,
+                        [start for start, _ in slots],
+                        [end for _, end in slots],
+                        batch.attendees,
+                        schedule.capacity if schedule is not None else None,
+                        batch.partial,
+                    ),
+                )
+            except psycopg.errors.LockNotAvailable:
+                raise HTTPException(status_code=409, detail="Los bloques están muy solicitados, intenta nuevamente")
+            except psycopg.errors.ForeignKeyViolation:
+                raise HTTPException(status_code=404, detail="Recurso o departamento inexistente")
+            rows = await cur.fetchall()
+            events = []
+            # La vista en vivo solo muestra el día de hoy: no avisamos los demás
+            today = date.today()
+            for _, status, _, slot_start, occupied in rows:
+                if schedule is not None and status == "created" and slot_start.date() == today:
+                    event = await block_event(cur, schedule, slot_start, occupied)
+                    if event:
+                        events.append(event)
+            await conn.commit()
+    for event in events:
+        announce(event)
+
+    results = [
+        {
+            "start_time": slot_start,
+            "status": status,
+            "id": reservation_id,
+            "detail": BATCH_STATUS_MESSAGES.get(status, status),
+        }
+        for _, status, reservation_id, slot_start, _ in rows
+    ]
+    created = sum(r["status"] == "created" for r in results)
+    if not batch.partial and created < len(results):
+        # Todo o nada: no se creó ninguna; devolvemos qué bloques lo impidieron
+        return ORJSONResponse(
+            {"detail": "No se pudo reservar todos los bloques", "results": [r for r in results if r["status"] != "ok"]},
+            status_code=409,
+        )
+    return ORJSONResponse({"ok": created > 0, "created": created, "results": results, "skipped": skipped})
+
+
+# Los residentes cambian sus reservas por /api/reserve/gym/{id} o anulando y
+# volviendo a reservar; la edición libre queda para administración
+@app.put("/api/reservations/{resv_id}", dependencies=ADMIN_ONLY)
+async def update_reservation(resv_id: int, res: ReservationUpdate):
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT res_id FROM reservations WHERE id=%s", (resv_id,))
+            row = await cur.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="Reserva no encontrada")
+            schedule = await schedules.get(row[0])
+            if schedule is not None:
+                return await update_block_reservation(conn, cur, resv_id, res, schedule)
             fields = []
             values = []
             if res.start_time:
@@ -534,155 +2517,1121 @@ def update_reservation(resv_id: int, res: ReservationUpdate):
             if not fields:
                 raise HTTPException(status_code=400, detail="Nada para actualizar")
             values.append(resv_id)
-            cur.execute(f"UPDATE reservations SET {', '.join(fields)} WHERE id=%s RETURNING id, res_id, dept_id, start_time, end_time, attendees", tuple(values))
-            conn.commit()
-            r = cur.fetchone()
+            await cur.execute(f"UPDATE reservations SET {', '.join(fields)} WHERE id=%s RETURNING id, res_id, dept_id, start_time, end_time, attendees", tuple(values))
+            await conn.commit()
+            r = await cur.fetchone()
             if not r:
                 raise HTTPException(status_code=404, detail="Reserva no encontrada")
             return {"id": r[0], "res_id": r[1], "dept_id": r[2], "start_time": r[3], "end_time": r[4], "attendees": r[5]}
 
+async def update_block_reservation(conn, cur, resv_id: int, res: ReservationUpdate, schedule: Schedule) -> dict:
+    # En recursos por bloques el aforo lo controla block_occupancy: el cambio de
+    # personas pasa por resize_block_reservation y mover de bloque no se permite aquí
+    if res.start_time or res.end_time:
+        raise HTTPException(
+            status_code=409, detail="Para cambiar de bloque, anula la reserva y crea una nueva"
+        )
+    if not res.attendees:
+        raise HTTPException(status_code=400, detail="Nada para actualizar")
+    try:
+        await cur.execute(
+            "SELECT status, reservation_id, slot_start, occupied FROM resize_block_reservation(%s, %s, %s, %s)",
+            (resv_id, res.attendees, schedule.capacity, schedule.dept_capacity),
+        )
+    except psycopg.errors.LockNotAvailable:
+        raise HTTPException(status_code=409, detail="El bloque está muy solicitado, intenta nuevamente")
+    status, _, slot_start, occupied = await cur.fetchone()
+    raise_for_booking_status(status, slot_start, schedule)
+    event = await block_event(cur, schedule, slot_start, occupied)
+    await cur.execute(
+        "SELECT id, res_id, dept_id, start_time, end_time, attendees FROM reservations WHERE id=%s", (resv_id,)
+    )
+    r = await cur.fetchone()
+    await conn.commit()
+    announce(event)
+    return {"id": r[0], "res_id": r[1], "dept_id": r[2], "start_time": r[3], "end_time": r[4], "attendees": r[5]}
+
 @app.delete("/api/reservations/{resv_id}")
-def delete_reservation(resv_id: int):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM reservations WHERE id=%s RETURNING id", (resv_id,))
-            conn.commit()
-            r = cur.fetchone()
+async def delete_reservation(resv_id: int, session: Session = Depends(current_session)):
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "DELETE FROM reservations WHERE id=%s AND (%s OR dept_id=%s) RETURNING id, res_id, start_time",
+                (resv_id, session.is_admin, session.dept_id),
+            )
+            r = await cur.fetchone()
             if not r:
+                await conn.commit()
                 raise HTTPException(status_code=404, detail="Reserva no encontrada")
+            schedule = await schedules.get(r[1])
+            event = await block_event(cur, schedule, r[2]) if schedule is not None else None
+            await conn.commit()
+            announce(event)
             return {"id": r[0]}
 
 # GET: Listar reservas de gimnasio por fecha
-@app.get("/api/reserve/gym")
-def get_gym_reservations(
-    date: Optional[str] = Query(None, description="Fecha YYYY-MM-DD")
+@app.get("/api/reserve/gym", response_model=List[BlockReservationOut], dependencies=READ_ADMISSION)
+async def get_gym_reservations(
+    date: Optional[str] = Query(None, description="Fecha YYYY-MM-DD"),
+    resource_id: int = Query(GYM_RES_ID),
 ):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            if not date:
-                from datetime import date as dt
-
-                date = dt.today().isoformat()
-            start = f"{date}T00:00:00"
-            end = f"{date}T23:59:59"
-            cur.execute(
-                """
-                SELECT id, dept_id, start_time, end_time, attendees FROM reservations
-                WHERE res_id=1 AND start_time >= %s AND start_time <= %s
-                ORDER BY start_time
-                """,
-                (start, end),
-            )
-            rows = cur.fetchall()
-            return [
-                {
-                    "id": r[0],
-                    "dept_id": r[1],
-                    "start_time": r[2],
-                    "end_time": r[3],
-                    "attendees": r[4],
-                }
-                for r in rows
-            ]
+    start, end = day_range(date or datetime.today().date())
+    return await fetch_json(
+        """
+        SELECT id, dept_id, start_time, end_time, attendees FROM reservations
+        WHERE res_id=%s AND start_time >= %s AND start_time < %s
+        ORDER BY start_time
+        """,
+        (resource_id, start, end),
+    )
 
 
 # GET: Listar reservas de espacios comunes por fecha y recurso
-@app.get("/api/reserve/common")
-def get_common_reservations(
+@app.get("/api/reserve/common", response_model=List[ReservationOut], dependencies=READ_ADMISSION)
+async def get_common_reservations(
     date: Optional[str] = Query(None, description="Fecha YYYY-MM-DD"),
     resource_id: Optional[int] = Query(None),
 ):
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            if not date:
-                from datetime import date as dt
-
-                date = dt.today().isoformat()
-            start = f"{date}T00:00:00"
-            end = f"{date}T23:59:59"
-            query = "SELECT id, res_id, dept_id, start_time, end_time, attendees FROM reservations WHERE start_time >= %s AND start_time <= %s"
-            params = [start, end]
-            if resource_id:
-                query += " AND res_id=%s"
-                params.append(resource_id)
-            query += " ORDER BY res_id, start_time"
-            cur.execute(query, tuple(params))
-            rows = cur.fetchall()
-            return [
-                {
-                    "id": r[0],
-                    "res_id": r[1],
-                    "dept_id": r[2],
-                    "start_time": r[3],
-                    "end_time": r[4],
-                    "attendees": r[5],
-                }
-                for r in rows
-            ]
+    start, end = day_range(date or datetime.today().date())
+    query = "SELECT id, res_id, dept_id, start_time, end_time, attendees FROM reservations WHERE start_time >= %s AND start_time < %s"
+    params = [start, end]
+    if resource_id:
+        query += " AND res_id=%s"
+        params.append(resource_id)
+    query += " ORDER BY res_id, start_time"
+    return await fetch_json(query, tuple(params))
+
+
+AVAILABILITY_MAX_DAYS = int(os.getenv("AVAILABILITY_MAX_DAYS", "62"))
+
+
+@app.get("/api/availability", dependencies=READ_ADMISSION)
+async def get_availability(
+    resource_id: int = Query(...),
+    date_from: Optional[str] = Query(None, alias="from", description="Primer día YYYY-MM-DD (por defecto hoy)"),
+    date_to: Optional[str] = Query(None, alias="to", description="Último día YYYY-MM-DD, inclusivo"),
+):
+    """
+    Matriz día x bloque de ocupación para un rango de días, en una sola consulta.
+    Los recursos con horario usan sus bloques (asistentes por bloque); los
+    espacios comunes tienen un único bloque por día (reservas del día, 0 o 1).
+    """
+    first, _ = day_range(date_from or datetime.today().date())
+    last, range_end = day_range(date_to) if date_to else (first, first + timedelta(days=7))
+    if last < first:
+        raise HTTPException(status_code=400, detail="'to' no puede ser anterior a 'from'")
+    days = (range_end - first).days
+    if days > AVAILABILITY_MAX_DAYS:
+        raise HTTPException(
+            status_code=400, detail=f"El rango no puede superar {AVAILABILITY_MAX_DAYS} días"
+        )
+
+    async with get_read_db() as conn:
+        async with conn.cursor() as cur:
+            # El LEFT JOIN distingue "recurso inexistente" de "sin reservas" sin otra consulta
+            await cur.execute(
+                """
+                SELECT r.id, o.block_start, o.attendees, o.bookings
+                FROM resources r
+                LEFT JOIN block_occupancy o
+                  ON o.res_id = r.id AND o.block_start >= %s AND o.block_start < %s
+                WHERE r.id = %s
+                ORDER BY o.block_start
+                """,
+                (first, range_end, resource_id),
+            )
+            rows = await cur.fetchall()
+    if not rows:
+        raise HTTPException(status_code=404, detail="Recurso no encontrado")
+
+    schedule = await schedules.get(resource_id)
+    hourly = schedule is not None
+    slots = schedule.labels if hourly else ["día"]
+    matrix = {
+        (first + timedelta(days=i)).date().isoformat(): [0] * len(slots) for i in range(days)
+    }
+    for _, block_start, attendees, bookings in rows:
+        if block_start is None:
+            continue
+        if hourly:
+            slot = schedule.slot_index(block_start)
+            if slot is not None:
+                matrix[block_start.date().isoformat()][slot] = int(attendees)
+        else:
+            matrix[block_start.date().isoformat()][0] += int(bookings)
+    return {
+        "resource_id": resource_id,
+        "from": first.date().isoformat(),
+        "to": (range_end - timedelta(days=1)).date().isoformat(),
+        "slots": slots,
+        "capacity": schedule.capacity if hourly else 1,
+        "days": matrix,
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Bienvenido a BuildingFlow API"}
 
 
-@app.post("/api/reserve/common")
-def reserve_common(req: CommonReservationRequest):
+@app.post("/api/reserve/common", dependencies=BOOKING_ADMISSION)
+async def reserve_common(req: CommonReservationRequest, session: Session = Depends(current_session)):
+    dept_id = session_dept(session, req.dept_id)
+    await enforce_rate_limit("booking_dept", dept_id)
     # Reserva de quinchos/salas
     if req.attendees < 1:
         raise HTTPException(status_code=400, detail="Debe haber al menos 1 persona")
-    with get_db() as conn:
-        with conn.cursor() as cur:
+    day_start, day_end = day_range(req.date)
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
             try:
-                conn.autocommit = False
-                # Validar si ya tiene reserva para ese recurso ese día
-                cur.execute(
+                # Un recurso común se reserva por el día completo: basta una sola
+                # búsqueda en el rango del día para validar ambas reglas.
+                await cur.execute(
                     """
-                    SELECT id FROM reservations
-                    WHERE res_id=%s AND dept_id=%s
-                    AND start_time >= %s AND start_time < %s
+                    SELECT dept_id FROM reservations
+                    WHERE res_id=%s AND start_time >= %s AND start_time < %s
+                    LIMIT 1
                     """,
-                    (
-                        req.resource_id,
-                        req.dept_id,
-                        f"{req.date}T00:00:00",
-                        f"{req.date}T23:59:59",
-                    ),
+                    (req.resource_id, day_start, day_end),
                 )
-                if cur.fetchone():
+                taken = await cur.fetchone()
+                if taken and taken[0] == dept_id:
                     raise HTTPException(
                         status_code=400,
                         detail="Solo una reserva por día para este recurso",
                     )
-                # Validar exclusividad del recurso
-                cur.execute(
-                    """
-                    SELECT id FROM reservations
-                    WHERE res_id=%s AND start_time >= %s AND start_time < %s
-                    """,
-                    (req.resource_id, f"{req.date}T00:00:00", f"{req.date}T23:59:59"),
-                )
-                if cur.fetchone():
+                if taken:
                     raise HTTPException(
                         status_code=400,
                         detail="Este recurso ya está reservado todo el día",
                     )
                 # Insertar reserva
-                cur.execute(
+                await cur.execute(
                     """
                     INSERT INTO reservations (res_id, dept_id, start_time, end_time, attendees)
                     VALUES (%s, %s, %s, %s, %s)
                     """,
                     (
                         req.resource_id,
-                        req.dept_id,
-                        f"{req.date}T00:00:00",
-                        f"{req.date}T23:59:59",
+                        dept_id,
+                        day_start,
+                        day_end - timedelta(seconds=1),
                         req.attendees,
                     ),
                 )
-                conn.commit()
+                await conn.commit()
                 return {"ok": True}
+            except HTTPException:
+                raise
             except Exception as e:
-                conn.rollback()
+                await conn.rollback()
                 raise HTTPException(status_code=500, detail=f"Error al reservar: {e}")
+
+
+# Importación / exportación masiva (COPY)
+# Las filas se validan por lotes, se cargan con COPY a una tabla temporal y desde
+# ahí se insertan con un solo INSERT ... SELECT, informando los errores por fila.
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(20 * 1024 * 1024)))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+IMPORT_MAX_ERRORS = 1000
+BULK_ENTITIES = ("users", "departments", "reservations")
+
+
+class ReservationImport(BaseModel):
+    res_id: int
+    dept_id: int
+    start_time: datetime
+    end_time: datetime
+    attendees: int
+
+
+async def read_limited_body(request: Request) -> str:
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > IMPORT_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+        chunks.append(chunk)
+    return b"".join(chunks).decode("utf-8-sig")
+
+
+def parse_import_rows(text: str, fmt: str):
+    """Entrega (n° de fila, dict) o (n° de fila, mensaje de error) por cada registro."""
+    if fmt == "ndjson":
+        for n, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield n, "JSON inválido"
+                continue
+            yield n, row if isinstance(row, dict) else "Se esperaba un objeto JSON"
+    else:
+        for n, row in enumerate(csv.DictReader(io.StringIO(text)), 1):
+            # En CSV una celda vacía significa "sin valor"
+            yield n, {k: (v if v != "" else None) for k, v in row.items() if k}
+
+
+def validation_message(e: ValidationError) -> str:
+    err = e.errors()[0]
+    field = ".".join(str(x) for x in err.get("loc", ()))
+    return f"{field}: {err.get('msg')}" if field else err.get("msg")
+
+
+# Cada prepare_* valida un lote sin tocar la base y devuelve las filas para COPY;
+# la conexión se pide recién cuando todo el archivo está listo.
+async def prepare_users(batch: list, errors: list, seen: set) -> list:
+    valid = []
+    for n, row in batch:
+        if isinstance(row, str):
+            errors.append({"row": n, "error": row})
+            continue
+        try:
+            user = UserCreate(**row)
+        except ValidationError as e:
+            errors.append({"row": n, "error": validation_message(e)})
+            continue
+        if len(user.password.encode("utf-8")) > 72:
+            errors.append({"row": n, "error": "La contraseña no puede superar los 72 caracteres."})
+        elif user.email in seen:
+            errors.append({"row": n, "error": "Correo repetido en el archivo"})
+        else:
+            seen.add(user.email)
+            valid.append((n, user))
+
+    # Por el pool acotado de bcrypt, de a PASSWORD_WORKERS: una importación no
+    # llena la cola de los logins y, si está llena, responde 503 como ellos
+    hashes = []
+    for i in range(0, len(valid), PASSWORD_WORKERS):
+        hashes.extend(await asyncio.gather(*(hash_password(u.password) for _, u in valid[i:i + PASSWORD_WORKERS])))
+    return [
+        (n, uuid4(), u.email, password_hash, u.full_name, u.dept_id, bool(u.is_admin))
+        for (n, u), password_hash in zip(valid, hashes)
+    ]
+
+
+async def prepare_departments(batch: list, errors: list, seen: set) -> list:
+    valid = []
+    for n, row in batch:
+        if isinstance(row, str):
+            errors.append({"row": n, "error": row})
+            continue
+        try:
+            dep = DepartmentCreate(**row)
+        except ValidationError as e:
+            errors.append({"row": n, "error": validation_message(e)})
+            continue
+        if dep.id in seen:
+            errors.append({"row": n, "error": "Departamento repetido en el archivo"})
+        else:
+            seen.add(dep.id)
+            valid.append((n, dep))
+    return [(n, d.id, d.floor, d.access_code) for n, d in valid]
+
+
+async def prepare_reservations(batch: list, errors: list, seen: set) -> list:
+    valid = []
+    for n, row in batch:
+        if isinstance(row, str):
+            errors.append({"row": n, "error": row})
+            continue
+        try:
+            res = ReservationImport(**row)
+        except ValidationError as e:
+            errors.append({"row": n, "error": validation_message(e)})
+            continue
+        if res.attendees < 1:
+            errors.append({"row": n, "error": "Debe haber al menos 1 persona"})
+        elif res.end_time <= res.start_time:
+            errors.append({"row": n, "error": "end_time debe ser posterior a start_time"})
+        else:
+            valid.append((n, res))
+    return [(n, r.res_id, r.dept_id, r.start_time, r.end_time, r.attendees) for n, r in valid]
+
+
+# Por entidad: tabla temporal, validación y COPY de carga, consultas que rechazan filas
+# (n° de fila, motivo) e INSERT final desde la tabla temporal. La tabla temporal
+# declara solo las columnas que se cargan: con LIKE heredaría los NOT NULL de
+# columnas que COPY no llena (reservations.id, defaults de departments).
+BULK_IMPORTS = {
+    "users": {
+        "table": "import_users",
+        "staging": (
+            "CREATE TEMP TABLE import_users (row_no INTEGER, id UUID, email VARCHAR(100), "
+            "password_hash VARCHAR(255), full_name VARCHAR(100), dept_id INTEGER, is_admin BOOLEAN) ON COMMIT DROP"
+        ),
+        "prepare": prepare_users,
+        "copy": "COPY import_users (row_no, id, email, password_hash, full_name, dept_id, is_admin) FROM STDIN",
+        "checks": [
+            ("SELECT row_no, 'El correo ya existe' FROM import_users s "
+             "WHERE EXISTS (SELECT 1 FROM users u WHERE u.email = s.email)", ()),
+            ("SELECT row_no, 'Departamento inexistente' FROM import_users s "
+             "WHERE s.dept_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM departments d WHERE d.id = s.dept_id)", ()),
+        ],
+        "insert": "INSERT INTO users (id, email, password_hash, full_name, dept_id, is_admin) "
+                  "SELECT id, email, password_hash, full_name, dept_id, is_admin FROM import_users",
+    },
+    "departments": {
+        "table": "import_departments",
+        "staging": (
+            "CREATE TEMP TABLE import_departments (row_no INTEGER, id INTEGER, floor INTEGER, "
+            "access_code VARCHAR(20)) ON COMMIT DROP"
+        ),
+        "prepare": prepare_departments,
+        "copy": "COPY import_departments (row_no, id, floor, access_code) FROM STDIN",
+        "checks": [
+            ("SELECT row_no, 'El departamento ya existe' FROM import_departments s "
+             "WHERE EXISTS (SELECT 1 FROM departments d WHERE d.id = s.id)", ()),
+        ],
+        "insert": "INSERT INTO departments (id, floor, access_code) "
+                  "SELECT id, floor, access_code FROM import_departments",
+    },
+    "reservations": {
+        "table": "import_reservations",
+        "staging": (
+            "CREATE TEMP TABLE import_reservations (row_no INTEGER, res_id INTEGER, dept_id INTEGER, "
+            "start_time TIMESTAMP, end_time TIMESTAMP, attendees INTEGER) ON COMMIT DROP"
+        ),
+        "prepare": prepare_reservations,
+        "copy": "COPY import_reservations (row_no, res_id, dept_id, start_time, end_time, attendees) FROM STDIN",
+        "checks": [
+            ("SELECT row_no, 'Recurso inexistente' FROM import_reservations s "
+             "WHERE NOT EXISTS (SELECT 1 FROM resources r WHERE r.id = s.res_id)", ()),
+            ("SELECT row_no, 'Departamento inexistente' FROM import_reservations s "
+             "WHERE NOT EXISTS (SELECT 1 FROM departments d WHERE d.id = s.dept_id)", ()),
+            # Las mismas reglas que book_block y reserve_common: máximo de personas
+            # por departamento, una reserva por departamento y día en los recursos
+            # por bloques, y un solo departamento por día en los recursos comunes
+            ("SELECT s.row_no, 'Máximo de personas por departamento superado' FROM import_reservations s "
+             "JOIN resource_schedules rs ON rs.res_id = s.res_id WHERE s.attendees > rs.dept_capacity", ()),
+            ("""
+             SELECT s.row_no, 'El departamento ya tiene una reserva ese día' FROM import_reservations s
+             JOIN resource_schedules rs ON rs.res_id = s.res_id
+             WHERE EXISTS (
+                 SELECT 1 FROM reservations r
+                 WHERE r.res_id = s.res_id AND r.dept_id = s.dept_id
+                   AND r.start_time >= date_trunc('day', s.start_time)
+                   AND r.start_time < date_trunc('day', s.start_time) + INTERVAL '1 day'
+             ) OR EXISTS (
+                 SELECT 1 FROM import_reservations o
+                 WHERE o.res_id = s.res_id AND o.dept_id = s.dept_id AND o.row_no < s.row_no
+                   AND date_trunc('day', o.start_time) = date_trunc('day', s.start_time)
+             )
+             """, ()),
+            ("""
+             SELECT s.row_no, 'El recurso ya está reservado ese día' FROM import_reservations s
+             WHERE NOT EXISTS (SELECT 1 FROM resource_schedules rs WHERE rs.res_id = s.res_id)
+               AND (EXISTS (
+                   SELECT 1 FROM reservations r
+                   WHERE r.res_id = s.res_id
+                     AND r.start_time >= date_trunc('day', s.start_time)
+                     AND r.start_time < date_trunc('day', s.start_time) + INTERVAL '1 day'
+               ) OR EXISTS (
+                   SELECT 1 FROM import_reservations o
+                   WHERE o.res_id = s.res_id AND o.row_no < s.row_no
+                     AND date_trunc('day', o.start_time) = date_trunc('day', s.start_time)
+               ))
+             """, ()),
+            # Bloques con horario que, sumando lo ya reservado, quedarían sobre el aforo
+            ("""
+             SELECT s.row_no, 'Aforo del bloque superado' FROM import_reservations s
+             JOIN (
+                 SELECT i.res_id, i.start_time FROM import_reservations i
+                 JOIN resource_schedules rs ON rs.res_id = i.res_id
+                 GROUP BY i.res_id, i.start_time, rs.capacity
+                 HAVING SUM(i.attendees) + COALESCE((
+                     SELECT o.attendees FROM block_occupancy o
+                     WHERE o.res_id = i.res_id AND o.block_start = i.start_time
+                 ), 0) > rs.capacity
+             ) over ON over.res_id = s.res_id AND over.start_time = s.start_time
+             """, ()),
+        ],
+        "insert": "INSERT INTO reservations (res_id, dept_id, start_time, end_time, attendees) "
+                  "SELECT res_id, dept_id, start_time, end_time, attendees FROM import_reservations",
+    },
+}
+
+
+@app.post("/api/admin/import/{entity}", dependencies=ADMIN_ONLY)
+async def bulk_import(
+    entity: str,
+    request: Request,
+    format: Optional[str] = Query(None, description="csv o ndjson (por defecto según Content-Type)"),
+):
+    """
+    Carga masiva en una sola transacción. Las filas válidas se insertan y las
+    inválidas se informan con su número de fila; el archivo no se rechaza entero.
+    """
+    spec = BULK_IMPORTS.get(entity)
+    if spec is None:
+        raise HTTPException(status_code=404, detail="Entidad no soportada")
+    fmt = format or ("ndjson" if "ndjson" in request.headers.get("content-type", "") else "csv")
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="Formato no soportado, usa csv o ndjson")
+
+    text = await read_limited_body(request)
+    errors = []
+    seen = set()
+    received = 0
+    rows, batch = [], []
+    for item in parse_import_rows(text, fmt):
+        received += 1
+        batch.append(item)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            rows.extend(await spec["prepare"](batch, errors, seen))
+            batch = []
+    if batch:
+        rows.extend(await spec["prepare"](batch, errors, seen))
+
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(spec["staging"])
+            async with cur.copy(spec["copy"]) as copy:
+                for row in rows:
+                    await copy.write_row(row)
+
+            # Cada regla borra lo que rechaza antes de la siguiente: una fila
+            # inválida no cuenta contra el aforo ni bloquea el día a otra válida
+            for query, params in spec["checks"]:
+                await cur.execute(query, params)
+                rejected = []
+                for row_no, message in await cur.fetchall():
+                    rejected.append(row_no)
+                    errors.append({"row": row_no, "error": message})
+                if rejected:
+                    await cur.execute(f"DELETE FROM {spec['table']} WHERE row_no = ANY(%s)", (rejected,))
+            try:
+                await cur.execute(spec["insert"])
+            except psycopg.errors.UniqueViolation:
+                raise HTTPException(status_code=409, detail="Conflicto con datos creados durante la importación, reintenta")
+            inserted = cur.rowcount
+            cache = {"users": users_cache, "departments": departments_cache}.get(entity)
+            if cache is not None:
+                await commit_and_invalidate(conn, cache)
+            else:
+                await conn.commit()
+
+    errors.sort(key=lambda e: e["row"])
+    return {
+        "entity": entity,
+        "received": received,
+        "inserted": inserted,
+        "error_count": len(errors),
+        "errors": errors[:IMPORT_MAX_ERRORS],
+    }
+
+
+BULK_EXPORTS = {
+    "users": "SELECT id, email, full_name, dept_id, is_admin FROM users ORDER BY email",
+    "departments": "SELECT id, floor, access_code FROM departments ORDER BY id",
+    "reservations": "SELECT id, res_id, dept_id, start_time, end_time, attendees FROM {table} "
+                    "WHERE start_time >= {from_} AND start_time < {to} ORDER BY start_time, id",
+}
+
+
+@app.get("/api/admin/export/{entity}", dependencies=ADMIN_ONLY)
+async def bulk_export(
+    entity: str,
+    format: str = Query("csv", description="csv o ndjson"),
+    date_from: Optional[str] = Query(None, alias="from", description="Solo reservas: inicio inclusivo (ISO)"),
+    date_to: Optional[str] = Query(None, alias="to", description="Solo reservas: fin exclusivo (ISO)"),
+    archive: bool = Query(False, description="Solo reservas: incluye los meses archivados"),
+):
+    """Exporta la tabla con COPY ... TO STDOUT, enviando los datos a medida que salen de la base."""
+    select = BULK_EXPORTS.get(entity)
+    if select is None:
+        raise HTTPException(status_code=404, detail="Entidad no soportada")
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="Formato no soportado, usa csv o ndjson")
+    if entity == "reservations":
+        # COPY no acepta parámetros: los límites se incrustan ya validados como literales
+        start = parse_datetime_param(date_from, "from") if date_from else datetime.min
+        end = parse_datetime_param(date_to, "to") if date_to else datetime.max
+        select = select.format(
+            table="reservations_history" if archive else "reservations",
+            from_=f"'{start.isoformat()}'",
+            to=f"'{end.isoformat()}'",
+        )
+
+    if format == "csv":
+        statement = f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)"
+    else:
+        statement = f"COPY (SELECT row_to_json(t)::text FROM ({select}) t) TO STDOUT"
+
+    async def rows():
+        async with get_db() as conn:
+            async with conn.cursor() as cur:
+                async with cur.copy(statement) as copy:
+                    if format == "csv":
+                        async for chunk in copy:
+                            yield bytes(chunk)
+                    else:
+                        copy.set_types(["text"])
+                        async for (line,) in copy.rows():
+                            yield line + "\n"
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"{entity}.{'csv' if format == 'csv' else 'ndjson'}"
+    return StreamingResponse(
+        rows(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/api/admin/overview", dependencies=ADMIN_ONLY)
+async def admin_overview(limit: int = Query(50, ge=1, le=500, description="Filas de la primera página de cada tabla")):
+    """
+    Todo lo que necesita el panel de administración al abrirse: conteos,
+    ocupación de hoy por recurso y la primera página de cada tabla. Las
+    consultas van en pipeline por una sola conexión (un solo viaje de red).
+    """
+    day_start, day_end = day_range(date.today())
+    queries = {
+        "counts": (
+            """
+            SELECT (SELECT count(*) FROM users) AS users,
+                   (SELECT count(*) FROM departments) AS departments,
+                   (SELECT count(*) FROM resources) AS resources,
+                   (SELECT count(*) FROM reservations) AS reservations,
+                   (SELECT count(*) FROM reservations WHERE start_time >= %s AND start_time < %s) AS reservations_today
+            """,
+            (day_start, day_end),
+        ),
+        "occupancy": (
+            """
+            SELECT r.id AS res_id, r.name, COALESCE(SUM(o.attendees), 0) AS attendees,
+                   COALESCE(SUM(o.bookings), 0) AS bookings
+            FROM resources r
+            LEFT JOIN block_occupancy o
+              ON o.res_id = r.id AND o.block_start >= %s AND o.block_start < %s
+            GROUP BY r.id, r.name ORDER BY r.name
+            """,
+            (day_start, day_end),
+        ),
+        "users": (USERS_PAGE_QUERY + " ORDER BY full_name, id LIMIT %s", (limit + 1,)),
+        "departments": ("SELECT id, floor, access_code FROM departments ORDER BY id LIMIT %s", (limit + 1,)),
+        "resources": ("SELECT id, name, type FROM resources ORDER BY name", ()),
+        "reservations": (
+            "SELECT id, res_id, dept_id, start_time, end_time, attendees FROM reservations "
+            "ORDER BY start_time DESC, id DESC LIMIT %s",
+            (limit + 1,),
+        ),
+    }
+    await schedules.refresh()
+    async with get_db() as conn:
+        cursors = {}
+        async with conn.pipeline():
+            for key, (query, params) in queries.items():
+                cursors[key] = conn.cursor(row_factory=dict_row)
+                await cursors[key].execute(query, params)
+        rows = {key: await cur.fetchall() for key, cur in cursors.items()}
+        for cur in cursors.values():
+            await cur.close()
+
+    for item in rows["occupancy"]:
+        schedule = schedules.schedules.get(item["res_id"])
+        # Cupos del día: aforo por bloque x bloques (o el día completo en espacios comunes)
+        item["capacity"] = schedule.capacity * len(schedule.labels) if schedule else 1
+    next_cursor = {
+        "users": next_users_cursor,
+        "departments": lambda last: encode_keyset(last["id"]),
+        "reservations": lambda last: encode_cursor(last["start_time"], last["id"]),
+    }
+    pages = {}
+    for key, make_cursor in next_cursor.items():
+        page = rows[key]
+        pages[key] = {"items": page[:limit], "next_cursor": make_cursor(page[limit - 1]) if len(page) > limit else None}
+    return ORJSONResponse({
+        "counts": rows["counts"][0],
+        "occupancy_today": rows["occupancy"],
+        "resources": rows["resources"],
+        **pages,
+    })
+
+
+@app.post("/api/admin/occupancy/rebuild", dependencies=ADMIN_ONLY)
+async def rebuild_occupancy():
+    """Recalcula block_occupancy desde las reservas (también: python manage.py rebuild-occupancy)."""
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT rebuild_block_occupancy()")
+            rows = (await cur.fetchone())[0]
+            # Los streams abiertos vuelven a pedir el mapa completo
+            event = {"type": "resync"}
+            if AVAILABILITY_NOTIFY:
+                await cur.execute("SELECT pg_notify(%s, %s)", (AVAILABILITY_CHANNEL, json.dumps(event)))
+            await conn.commit()
+    announce(event)
+    return {"ok": True, "blocks": rows}
+
+
+# Estadísticas de uso para el panel de administración. Los reportes leen solo de
+# las tablas usage_daily*, que refresh_usage_rollups() mantiene al día
+# recalculando únicamente los días con cambios (tarea refresh-usage): un rango
+# de meses cuesta lo mismo que uno de días y nunca se recorre reservations al consultar.
+USAGE_REFRESH_SECONDS = int(os.getenv("USAGE_REFRESH_SECONDS", "300"))
+STATS_MAX_DAYS = int(os.getenv("STATS_MAX_DAYS", "3660"))
+STATS_RESOURCE_COLUMNS = ("res_id", "name", "bookings", "attendees", "days_used", "occupancy_rate")
+STATS_BLOCK_COLUMNS = ("block", "bookings", "attendees", "departments", "days_used", "occupancy_rate")
+STATS_DEPARTMENT_COLUMNS = ("dept_id", "bookings", "attendees", "days_used")
+
+
+def stats_range(date_from: Optional[str], date_to: Optional[str]) -> tuple:
+    last = parse_datetime_param(date_to, "to").date() if date_to else date.today()
+    first = parse_datetime_param(date_from, "from").date() if date_from else last - timedelta(days=29)
+    if last < first:
+        raise HTTPException(status_code=400, detail="'to' no puede ser anterior a 'from'")
+    if (last - first).days >= STATS_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"El rango no puede superar {STATS_MAX_DAYS} días")
+    return first, last
+
+
+def stats_response(rows: list, format: str, name: str, columns: tuple) -> Response:
+    if format == "json":
+        return ORJSONResponse(rows)
+    if format != "csv":
+        raise HTTPException(status_code=400, detail="Formato no soportado, usa json o csv")
+    # La cabecera sale siempre, aunque el rango no tenga filas
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=columns)
+    writer.writeheader()
+    writer.writerows(rows)
+    return Response(
+        out.getvalue(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{name}.csv"'},
+    )
+
+
+def occupancy_rate(used: float, available: float) -> Optional[float]:
+    return round(used / available, 4) if available else None
+
+
+async def fetch_stats(query: str, params: tuple) -> list:
+    async with get_read_db() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(query, params)
+            return await cur.fetchall()
+
+
+@app.get("/api/admin/stats/resources", dependencies=ADMIN_ONLY)
+async def stats_by_resource(
+    date_from: Optional[str] = Query(None, alias="from", description="Primer día (por defecto, 30 días atrás)"),
+    date_to: Optional[str] = Query(None, alias="to", description="Último día, inclusivo (por defecto hoy)"),
+    format: str = Query("json", description="json o csv"),
+):
+    """Uso por recurso. occupancy_rate: asistentes sobre aforo de todos los bloques (o días reservados, en espacios comunes)."""
+    first, last = stats_range(date_from, date_to)
+    days = (last - first).days + 1
+    rows = await fetch_stats(
+        """
+        SELECT r.id AS res_id, r.name, COALESCE(SUM(u.bookings), 0) AS bookings,
+               COALESCE(SUM(u.attendees), 0) AS attendees, COUNT(DISTINCT u.day) AS days_used
+        FROM resources r
+        LEFT JOIN usage_daily u ON u.res_id = r.id AND u.day >= %s AND u.day <= %s
+        GROUP BY r.id, r.name ORDER BY r.name
+        """,
+        (first, last),
+    )
+    for row in rows:
+        schedule = await schedules.get(row["res_id"])
+        if schedule is not None:
+            row["occupancy_rate"] = occupancy_rate(row["attendees"], schedule.capacity * len(schedule.labels) * days)
+        else:
+            row["occupancy_rate"] = occupancy_rate(row["days_used"], days)
+    return stats_response(rows, format, f"uso_recursos_{first}_{last}", STATS_RESOURCE_COLUMNS)
+
+
+@app.get("/api/admin/stats/blocks", dependencies=ADMIN_ONLY)
+async def stats_by_block(
+    resource_id: int = Query(GYM_RES_ID),
+    date_from: Optional[str] = Query(None, alias="from", description="Primer día (por defecto, 30 días atrás)"),
+    date_to: Optional[str] = Query(None, alias="to", description="Último día, inclusivo (por defecto hoy)"),
+    format: str = Query("json", description="json o csv"),
+):
+    """Uso de cada bloque horario del recurso en el rango."""
+    first, last = stats_range(date_from, date_to)
+    days = (last - first).days + 1
+    schedule = await schedules.get(resource_id)
+    rows = await fetch_stats(
+        """
+        SELECT block_start, SUM(bookings) AS bookings, SUM(attendees) AS attendees,
+               SUM(departments) AS departments, COUNT(*) AS days_used
+        FROM usage_daily
+        WHERE res_id = %s AND day >= %s AND day <= %s
+        GROUP BY block_start ORDER BY block_start
+        """,
+        (resource_id, first, last),
+    )
+    for row in rows:
+        start = row.pop("block_start")
+        label = schedule.label_for(datetime.combine(first, start)) if schedule is not None else None
+        row["block"] = label or start.strftime("%H:%M")
+        capacity = schedule.capacity if schedule is not None else 1
+        row["occupancy_rate"] = occupancy_rate(row["attendees"] if schedule is not None else row["days_used"], capacity * days)
+    return stats_response(rows, format, f"uso_bloques_{resource_id}_{first}_{last}", STATS_BLOCK_COLUMNS)
+
+
+@app.get("/api/admin/stats/departments", dependencies=ADMIN_ONLY)
+async def stats_by_department(
+    resource_id: Optional[int] = Query(None, description="Solo este recurso"),
+    date_from: Optional[str] = Query(None, alias="from", description="Primer día (por defecto, 30 días atrás)"),
+    date_to: Optional[str] = Query(None, alias="to", description="Último día, inclusivo (por defecto hoy)"),
+    format: str = Query("json", description="json o csv"),
+):
+    """Uso por departamento, de mayor a menor número de asistentes."""
+    first, last = stats_range(date_from, date_to)
+    query = """
+        SELECT dept_id, SUM(bookings) AS bookings, SUM(attendees) AS attendees, COUNT(DISTINCT day) AS days_used
+        FROM usage_daily_dept
+        WHERE day >= %s AND day <= %s
+    """
+    params = [first, last]
+    if resource_id is not None:
+        query += " AND res_id = %s"
+        params.append(resource_id)
+    query += " GROUP BY dept_id ORDER BY attendees DESC, dept_id"
+    rows = await fetch_stats(query, tuple(params))
+    return stats_response(rows, format, f"uso_departamentos_{first}_{last}", STATS_DEPARTMENT_COLUMNS)
+
+
+# Tareas programadas: mantenimiento fuera del camino de las solicitudes. Cada
+# worker corre un Scheduler desde el lifespan; las tareas de base de datos solo
+# las ejecuta el líder (el worker que tiene el advisory lock SCHEDULER_LEADER_KEY
+# en su conexión dedicada; si muere, la conexión se cierra y otro lo toma). Las
+# tareas por worker (p. ej. calentar cachés) corren en todos. Cada tarea tiene un
+# presupuesto de tiempo y sus ejecuciones quedan en job_runs y en /metrics.
+# El horario se cambia con JOB_<NOMBRE>_SCHEDULE: segundos, cron de 5 campos u "off".
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "5"))
+SCHEDULER_LEADER_KEY = 510500
+JOB_RUNS_TTL_DAYS = int(os.getenv("JOB_RUNS_TTL_DAYS", "30"))
+RESERVATIONS_MONTHS_AHEAD = int(os.getenv("RESERVATIONS_MONTHS_AHEAD", "3"))
+RESERVATIONS_KEEP_MONTHS = int(os.getenv("RESERVATIONS_KEEP_MONTHS", "12"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+JOB_RUNS = Counter("edi5_job_runs_total", "Ejecuciones de tareas programadas por resultado", ("job", "status"))
+JOB_SECONDS = Histogram(
+    "edi5_job_seconds", "Duración de las tareas programadas", ("job",),
+    buckets=(0.01, 0.1, 0.5, 1, 5, 15, 60, 300, 900),
+)
+
+
+class Cron:
+    """Expresión cron de 5 campos (minuto hora día mes día_semana) con *, listas, rangos y pasos."""
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr: str):
+        parts = expr.split()
+        if len(parts) != 5:
+            raise ValueError(f"Expresión cron inválida: {expr!r}")
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self.parse_field(part, lo, hi) for part, (lo, hi) in zip(parts, self.FIELDS)
+        )
+        self.weekdays = {d % 7 for d in weekdays}
+        # Como en cron: si día y día de la semana están restringidos, basta con uno
+        self.either_day = parts[2] != "*" and parts[4] != "*"
+
+    @staticmethod
+    def parse_field(text: str, lo: int, hi: int) -> set:
+        values = set()
+        for part in text.split(","):
+            span, _, step = part.partition("/")
+            if span == "*":
+                start, end = lo, hi
+            elif "-" in span:
+                start, end = (int(v) for v in span.split("-", 1))
+            else:
+                start = end = int(span)
+                if step:
+                    end = hi
+            if start < lo or end > hi or start > end or (step and int(step) < 1):
+                raise ValueError(f"Campo cron fuera de rango: {text!r}")
+            values.update(range(start, end + 1, int(step or 1)))
+        return values
+
+    def matches_day(self, t: datetime) -> bool:
+        by_day = t.day in self.days
+        by_weekday = (t.weekday() + 1) % 7 in self.weekdays
+        return (by_day or by_weekday) if self.either_day else (by_day and by_weekday)
+
+    def next_after(self, now: datetime) -> datetime:
+        t = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=5 * 366)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.matches_day(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"La expresión cron nunca se cumple: {self.expr!r}")
+
+
+class Job:
+    def __init__(self, name: str, fn, schedule: str, timeout: float, leader_only: bool = True):
+        self.name = name
+        self.fn = fn
+        self.timeout = timeout
+        self.leader_only = leader_only
+        self.schedule = os.getenv(f"JOB_{name.upper().replace('-', '_')}_SCHEDULE", schedule).strip()
+        self.interval = self.cron = None
+        if self.schedule.replace(".", "", 1).isdigit():
+            self.interval = float(self.schedule) or None
+        elif self.schedule not in ("", "off"):
+            self.cron = Cron(self.schedule)
+        self.next_run = None
+
+    def next_after(self, now: datetime) -> Optional[datetime]:
+        if self.interval:
+            return now + timedelta(seconds=self.interval)
+        return self.cron.next_after(now) if self.cron else None
+
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = {}
+        self.leader = False
+        self.leader_conn = None
+        self.running = set()
+        self.tasks = set()
+
+    def add(self, job: Job):
+        self.jobs[job.name] = job
+
+    async def elect(self):
+        try:
+            if self.leader_conn is None or self.leader_conn.closed:
+                self.leader = False
+                self.leader_conn = await psycopg.AsyncConnection.connect(
+                    conninfo_from_url(DATABASE_URL), autocommit=True
+                )
+            if self.leader:
+                # Sigue viva la conexión que sostiene el lock
+                await self.leader_conn.execute("SELECT 1")
+            else:
+                cur = await self.leader_conn.execute("SELECT pg_try_advisory_lock(%s)", (SCHEDULER_LEADER_KEY,))
+                self.leader = (await cur.fetchone())[0]
+        except psycopg.Error as e:
+            if self.leader:
+                logger.warning("Scheduler: se perdió el liderazgo: %s", e)
+            self.leader = False
+            if self.leader_conn is not None:
+                await self.leader_conn.close()
+            self.leader_conn = None
+
+    async def run_forever(self):
+        now = datetime.now()
+        for job in self.jobs.values():
+            job.next_run = job.next_after(now)
+        try:
+            while True:
+                await self.elect()
+                now = datetime.now()
+                for job in self.jobs.values():
+                    if job.next_run is None or job.next_run > now:
+                        continue
+                    job.next_run = job.next_after(now)
+                    if self.leader or not job.leader_only:
+                        self.spawn(job, "schedule")
+                await asyncio.sleep(SCHEDULER_TICK_SECONDS)
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            if self.leader_conn is not None:
+                await self.leader_conn.close()
+
+    def spawn(self, job: Job, trigger: str) -> bool:
+        if job.name in self.running:
+            return False
+        self.running.add(job.name)
+        task = asyncio.create_task(self.run(job, trigger))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    async def run(self, job: Job, trigger: str):
+        try:
+            if not job.leader_only:
+                await self.execute(job)
+                return
+            # Conexión propia, fuera del pool: al cerrarse libera el lock de la tarea
+            # aunque la ejecución se interrumpa, y evita que la corra otro worker a la vez
+            async with await psycopg.AsyncConnection.connect(
+                conninfo_from_url(DATABASE_URL), autocommit=True
+            ) as conn:
+                cur = await conn.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (f"edi5_job:{job.name}",))
+                if not (await cur.fetchone())[0]:
+                    return
+                cur = await conn.execute(
+                    "INSERT INTO job_runs (job, trigger, worker) VALUES (%s, %s, %s) RETURNING id",
+                    (job.name, trigger, WORKER_ID),
+                )
+                run_id = (await cur.fetchone())[0]
+                status, detail = await self.execute(job)
+                await conn.execute(
+                    "UPDATE job_runs SET finished_at = now(), status = %s, detail = %s WHERE id = %s",
+                    (status, detail, run_id),
+                )
+        except psycopg.Error as e:
+            logger.warning("Tarea %s: no se pudo registrar la ejecución: %s", job.name, e)
+        finally:
+            self.running.discard(job.name)
+
+    async def execute(self, job: Job) -> tuple:
+        started = clock.perf_counter()
+        try:
+            detail = await asyncio.wait_for(job.fn(), timeout=job.timeout)
+            status = "ok"
+        except asyncio.TimeoutError:
+            status, detail = "timeout", f"Superó el presupuesto de {job.timeout:g} s"
+        except Exception as e:
+            status, detail = "error", str(e)
+        JOB_SECONDS.observe(clock.perf_counter() - started, job.name)
+        JOB_RUNS.inc(job.name, status)
+        if status != "ok":
+            logger.error("Tarea %s: %s", job.name, detail)
+        return status, detail
+
+
+async def purge_expired() -> str:
+    async with get_db() as conn:
+        keys = await conn.execute(
+            "DELETE FROM idempotency_keys WHERE created_at < now() - make_interval(secs => %s)",
+            (IDEMPOTENCY_TTL_SECONDS,),
+        )
+        tickets = await conn.execute(
+            "DELETE FROM booking_tickets WHERE created_at < now() - make_interval(secs => %s)",
+            (TICKET_TTL_SECONDS,),
+        )
+        runs = await conn.execute(
+            "DELETE FROM job_runs WHERE started_at < now() - make_interval(days => %s)", (JOB_RUNS_TTL_DAYS,)
+        )
+        await conn.commit()
+    return f"{keys.rowcount} claves, {tickets.rowcount} tickets y {runs.rowcount} ejecuciones eliminadas"
+
+
+async def maintain_partitions() -> str:
+    async with get_db() as conn:
+        # El DDL toma locks sobre reservations: si hay tráfico, mejor reintentar otro día que hacer esperar reservas
+        await conn.execute("SET LOCAL lock_timeout = '3s'")
+        cur = await conn.execute("SELECT ensure_reservation_partitions(%s)", (RESERVATIONS_MONTHS_AHEAD,))
+        created = (await cur.fetchone())[0]
+        await conn.commit()
+        archived = 0
+        if RESERVATIONS_KEEP_MONTHS > 0:
+            await conn.execute("SET LOCAL lock_timeout = '3s'")
+            cur = await conn.execute("SELECT archive_reservation_partitions(%s)", (RESERVATIONS_KEEP_MONTHS,))
+            archived = (await cur.fetchone())[0]
+            await conn.commit()
+    return f"{created} particiones creadas, {archived} meses archivados"
+
+
+async def refresh_usage() -> str:
+    async with get_db() as conn:
+        cur = await conn.execute("SELECT refresh_usage_rollups()")
+        rows = (await cur.fetchone())[0]
+        await conn.commit()
+    return f"{rows} días por recurso recalculados"
+
+
+async def rotate_access_codes() -> str:
+    async with get_db() as conn:
+        # Todo el edificio en una transacción; los códigos nuevos no se repiten entre departamentos
+        cur = await conn.execute("SELECT id FROM departments FOR UPDATE")
+        ids = [r[0] for r in await cur.fetchall()]
+        codes = [f"{n:06d}" for n in secrets.SystemRandom().sample(range(10**6), len(ids))]
+        await conn.execute(
+            "UPDATE departments d SET access_code = c.code "
+            "FROM unnest(%s::int[], %s::text[]) AS c(id, code) WHERE d.id = c.id",
+            (ids, codes),
+        )
+        await commit_and_invalidate(conn, departments_cache)
+    return f"{len(ids)} códigos de acceso rotados"
+
+
+async def warm_caches() -> str:
+    await schedules.refresh()
+    resources_cache.put("all", await load_resources())
+    departments_cache.put("all", await load_departments())
+    # Sin NOTIFY entre workers, esto acota cuánto tarda un cambio de código en llegar a todos
+    await access_codes.load()
+    return "ok"
+
+
+scheduler = Scheduler()
+scheduler.add(Job("purge-expired", purge_expired, "3600", timeout=120))
+scheduler.add(Job("maintain-partitions", maintain_partitions, "15 3 * * *", timeout=600))
+scheduler.add(Job("refresh-usage", refresh_usage, str(USAGE_REFRESH_SECONDS), timeout=120))
+# Cambia los códigos de las puertas: solo si se configura (p. ej. "0 4 1 * *")
+scheduler.add(Job("rotate-access-codes", rotate_access_codes, "off", timeout=60))
+scheduler.add(Job("warm-caches", warm_caches, str(max(1, int(CACHE_TTL_SECONDS // 2))), timeout=30, leader_only=False))
+
+
+@app.get("/api/admin/jobs", dependencies=ADMIN_ONLY)
+async def list_jobs():
+    """Tareas registradas, su próxima ejecución en este worker y la última ejecución registrada."""
+    async with get_db() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(
+                """
+                SELECT DISTINCT ON (job) job, id, trigger, worker, started_at, finished_at, status, detail
+                FROM job_runs ORDER BY job, started_at DESC
+                """
+            )
+            last_runs = {row.pop("job"): row for row in await cur.fetchall()}
+    return ORJSONResponse({
+        "worker": WORKER_ID,
+        "leader": scheduler.leader,
+        "jobs": [
+            {
+                "name": job.name,
+                "schedule": job.schedule or "off",
+                "timeout": job.timeout,
+                "leader_only": job.leader_only,
+                "next_run": job.next_run,
+                "running": job.name in scheduler.running,
+                "last_run": last_runs.get(job.name),
+            }
+            for job in scheduler.jobs.values()
+        ],
+    })
+
+
+@app.get("/api/admin/jobs/runs", dependencies=ADMIN_ONLY)
+async def list_job_runs(
+    job: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=500),
+):
+    query, params = "SELECT id, job, trigger, worker, started_at, finished_at, status, detail FROM job_runs", []
+    if job:
+        query += " WHERE job = %s"
+        params.append(job)
+    return await fetch_json(query + " ORDER BY id DESC LIMIT %s", (*params, limit))
+
+
+@app.post("/api/admin/jobs/{name}/run", status_code=202, dependencies=ADMIN_ONLY)
+async def trigger_job(name: str):
+    job = scheduler.jobs.get(name)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Tarea no encontrada")
+    if not scheduler.spawn(job, "manual"):
+        raise HTTPException(status_code=409, detail="La tarea ya se está ejecutando")
+    return {"ok": True, "job": name}
@@ -0,0 +1,102 @@
+"""
+Comandos de mantenimiento de la base de datos.
+
+Uso:
+    python manage.py rebuild-occupancy
+    python manage.py purge-idempotency
+    python manage.py purge-tickets
+    python manage.py maintain-partitions [--ahead 3] [--keep-months 12]
+    python manage.py refresh-usage
+"""
+import argparse
+import os
+import re
+
+import psycopg
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))
+
+
+def connect() -> psycopg.Connection:
+    # Acepta también URLs estilo SQLAlchemy ('postgresql+psycopg2://...')
+    url = re.sub(r"^postgres(ql)?\+\w+://", "postgresql://", os.environ["DATABASE_URL"])
+    return psycopg.connect(url)
+
+
+def rebuild_occupancy(args):
+    with connect() as conn:
+        rows = conn.execute("SELECT rebuild_block_occupancy()").fetchone()[0]
+        conn.commit()
+    print(f"block_occupancy recalculada: {rows} bloques")
+
+
+def purge_idempotency(args):
+    ttl = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+    with connect() as conn:
+        cur = conn.execute(
+            "DELETE FROM idempotency_keys WHERE created_at < now() - make_interval(secs => %s)", (ttl,)
+        )
+        conn.commit()
+    print(f"idempotency_keys: {cur.rowcount} claves expiradas eliminadas")
+
+
+def purge_tickets(args):
+    ttl = int(os.getenv("TICKET_TTL_SECONDS", "3600"))
+    with connect() as conn:
+        cur = conn.execute(
+            "DELETE FROM booking_tickets WHERE created_at < now() - make_interval(secs => %s)", (ttl,)
+        )
+        conn.commit()
+    print(f"booking_tickets: {cur.rowcount} tickets expirados eliminados")
+
+
+def maintain_partitions(args):
+    with connect() as conn:
+        created = conn.execute("SELECT ensure_reservation_partitions(%s)", (args.ahead,)).fetchone()[0]
+        conn.commit()
+        archived = 0
+        if args.keep_months > 0:
+            archived = conn.execute("SELECT archive_reservation_partitions(%s)", (args.keep_months,)).fetchone()[0]
+            conn.commit()
+    print(f"reservations: {created} particiones creadas, {archived} meses archivados")
+
+
+def refresh_usage(args):
+    with connect() as conn:
+        rows = conn.execute("SELECT refresh_usage_rollups()").fetchone()[0]
+        conn.commit()
+    print(f"usage_daily: {rows} días por recurso recalculados")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mantenimiento de Edi5")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser(
+        "rebuild-occupancy", help="Recalcula block_occupancy desde la tabla reservations"
+    ).set_defaults(func=rebuild_occupancy)
+    commands.add_parser(
+        "purge-idempotency", help="Borra las Idempotency-Key más antiguas que IDEMPOTENCY_TTL_SECONDS"
+    ).set_defaults(func=purge_idempotency)
+    commands.add_parser(
+        "purge-tickets", help="Borra los tickets de reserva más antiguos que TICKET_TTL_SECONDS"
+    ).set_defaults(func=purge_tickets)
+    partitions = commands.add_parser(
+        "maintain-partitions", help="Crea las particiones mensuales futuras y archiva las antiguas"
+    )
+    partitions.add_argument("--ahead", type=int, default=3, help="Meses futuros a tener creados")
+    partitions.add_argument(
+        "--keep-months", type=int, default=12, help="Meses que quedan en reservations (0 no archiva)"
+    )
+    partitions.set_defaults(func=maintain_partitions)
+    commands.add_parser(
+        "refresh-usage", help="Recalcula las estadísticas de uso de los días con cambios"
+    ).set_defaults(func=refresh_usage)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
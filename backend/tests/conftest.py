@@ -0,0 +1,79 @@
+"""
+Pruebas de integración contra un Postgres real. TEST_DATABASE_URL debe apuntar
+a una base desechable: el esquema public se recrea con db/supabase_schema.sql.
+
+    TEST_DATABASE_URL=postgresql://... python -m pytest tests
+"""
+import os
+import sys
+from datetime import date, datetime, time, timedelta
+from uuid import uuid4
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+SCHEMA_PATH = os.path.join(BACKEND_DIR, "..", "db", "supabase_schema.sql")
+GYM_ID = 1
+
+
+@pytest.fixture(scope="session")
+def database_url():
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL no definido")
+    psycopg = pytest.importorskip("psycopg")
+    # El archivo de esquema crea la base y el usuario antes de "\c" y después da
+    # permisos sobre edi5_db: eso lo omitimos, la base de pruebas tiene otro nombre
+    with open(SCHEMA_PATH) as f:
+        ddl = f.read().split("\\c edi5_db", 1)[-1]
+    ddl = "\n".join(line for line in ddl.splitlines() if not line.startswith("GRANT "))
+    with psycopg.connect(url, autocommit=True) as conn:
+        conn.execute("DROP SCHEMA public CASCADE")
+        conn.execute("CREATE SCHEMA public")
+        conn.execute(ddl)
+    return url
+
+
+@pytest.fixture(scope="session")
+def main(database_url):
+    pytest.importorskip("fastapi")
+    os.environ.update(DATABASE_URL=database_url, SCHEDULER_ENABLED="0", SESSION_SECRET="pruebas")
+    sys.path.insert(0, BACKEND_DIR)
+    import main
+    return main
+
+
+@pytest.fixture(scope="session")
+def client(main):
+    """Cliente con una sesión de administrador. El lifespan corre una vez: al salir cierra el pool."""
+    from fastapi.testclient import TestClient
+    token = main.issue_session(uuid4(), None, True)["token"]
+    with TestClient(main.app, headers={"Authorization": f"Bearer {token}"}) as client:
+        yield client
+
+
+@pytest.fixture
+def db(database_url, main):
+    """Base vacía con el gimnasio (08:00-21:00, aforo 3) y el departamento 101."""
+    import psycopg
+    with psycopg.connect(database_url) as conn:
+        conn.execute("TRUNCATE reservations, users, departments, resources, block_occupancy RESTART IDENTITY CASCADE")
+        conn.execute("INSERT INTO resources (id, name, type) VALUES (%s, 'Gimnasio', 'GYM')", (GYM_ID,))
+        conn.execute(
+            "INSERT INTO resource_schedules (res_id, slot_minutes, opens_at, closes_at, capacity, dept_capacity) "
+            "VALUES (%s, 60, '08:00', '21:00', 3, 2)",
+            (GYM_ID,),
+        )
+        conn.execute("INSERT INTO departments (id, floor, access_code) VALUES (101, 1, '111111')")
+        conn.commit()
+        # El cliente es de toda la sesión: sus cachés e índices no deben arrastrar la prueba anterior
+        for cache in main.CACHES.values():
+            cache.invalidate()
+        yield conn
+
+
+@pytest.fixture
+def gym_block():
+    """Un bloque de mañana del gimnasio, en el mes en curso."""
+    start = datetime.combine(date.today() + timedelta(days=1), time(10))
+    return start, start + timedelta(hours=1)
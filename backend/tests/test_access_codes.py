@@ -0,0 +1,45 @@
+import psycopg
+import pytest
+
+
+def verify(client, code: str, device_id: str = "puerta-1") -> dict:
+    resp = client.post("/api/access/verify", json={"code": code, "device_id": device_id})
+    assert resp.status_code == 200, resp.text
+    return resp.json()
+
+
+def test_failed_load_keeps_index_stale(client, db, main, monkeypatch):
+    def unavailable_db():
+        raise psycopg.OperationalError("base no disponible")
+
+    monkeypatch.setattr(main, "get_db", unavailable_db)
+    with pytest.raises(psycopg.OperationalError):
+        verify(client, "111111")
+    # La carga fallida no deja el índice marcado como vigente...
+    assert main.access_codes.stale
+
+    # ...así que la siguiente verificación lo reintenta y acepta el código
+    monkeypatch.undo()
+    assert verify(client, "111111") == {"ok": True, "dept_id": 101}
+    assert not main.access_codes.stale
+
+
+def test_changed_code_keeps_grace_period(client, db):
+    assert verify(client, "111111") == {"ok": True, "dept_id": 101}
+    resp = client.put("/api/departments/101", json={"id": 101, "floor": 1, "access_code": "222222"})
+    assert resp.status_code == 200, resp.text
+    # Tras cambiar el código, el anterior sigue valiendo durante el periodo de gracia
+    assert verify(client, "222222") == {"ok": True, "dept_id": 101}
+    assert verify(client, "111111") == {"ok": True, "dept_id": 101}
+    assert verify(client, "999999") == {"ok": False, "dept_id": None}
+
+
+def test_imported_department_codes_verify(client, db):
+    # access_code_changed_at (NOT NULL con default) no debe romper la importación
+    resp = client.post(
+        "/api/admin/import/departments", content="id,floor,access_code\n102,1,333333\n",
+        headers={"Content-Type": "text/csv"},
+    )
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["inserted"] == 1
+    assert verify(client, "333333") == {"ok": True, "dept_id": 102}
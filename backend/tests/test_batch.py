@@ -0,0 +1,39 @@
+from datetime import date, timedelta
+
+import pytest
+
+
+def post_batch(client, recurrence: dict):
+    body = {"res_id": 1, "dept_id": 101, "attendees": 1, "recurrence": recurrence}
+    return client.post("/api/reservations/batch", json=body)
+
+
+@pytest.mark.parametrize("weekdays", [[7], [-1], [0, 9]])
+def test_batch_rejects_invalid_weekdays(client, db, weekdays):
+    start = date.today() + timedelta(days=1)
+    resp = post_batch(client, {
+        "start_date": start.isoformat(), "end_date": (start + timedelta(days=6)).isoformat(),
+        "weekdays": weekdays, "blocks": ["10:00-11:00"],
+    })
+    assert resp.status_code == 422, resp.text
+
+
+def test_batch_rejects_overlong_span(client, db, main):
+    start = date.today() + timedelta(days=1)
+    resp = post_batch(client, {
+        "start_date": start.isoformat(),
+        "end_date": (start + timedelta(days=main.RECURRENCE_MAX_DAYS + 1)).isoformat(),
+        "blocks": ["10:00-11:00"],
+    })
+    assert resp.status_code == 422, resp.text
+    assert not db.execute("SELECT 1 FROM reservations").fetchone()
+
+
+def test_batch_accepts_span_at_limit(client, db, main):
+    start = date.today() + timedelta(days=1)
+    resp = post_batch(client, {
+        "start_date": start.isoformat(),
+        "end_date": (start + timedelta(days=main.RECURRENCE_MAX_DAYS)).isoformat(),
+        "weekdays": [start.weekday()], "blocks": ["10:00-11:00"], "partial": True,
+    })
+    assert resp.status_code == 200, resp.text
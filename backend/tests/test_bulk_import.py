@@ -0,0 +1,75 @@
+import json
+from datetime import datetime, time, timedelta
+
+
+def post_import(client, entity: str, body: str, fmt: str = "csv"):
+    content_type = "application/x-ndjson" if fmt == "ndjson" else "text/csv"
+    return client.post(f"/api/admin/import/{entity}", content=body, headers={"Content-Type": content_type})
+
+
+def test_import_departments(client, db):
+    body = "id,floor,access_code\n102,1,222222\n103,2,333333\n102,1,444444\n101,1,555555\n"
+    resp = post_import(client, "departments", body)
+    assert resp.status_code == 200, resp.text
+    result = resp.json()
+    assert result["inserted"] == 2
+    assert [e["row"] for e in result["errors"]] == [3, 4]
+    rows = db.execute("SELECT id, floor FROM departments ORDER BY id").fetchall()
+    assert rows == [(101, 1), (102, 1), (103, 2)]
+
+
+def test_import_users(client, db):
+    body = "\n".join(json.dumps(u) for u in [
+        {"email": "a@edi5.cl", "password": "secreto", "full_name": "A", "dept_id": 101},
+        {"email": "b@edi5.cl", "password": "secreto", "full_name": "B", "dept_id": 999},
+        {"email": "c@edi5.cl", "full_name": "C", "dept_id": 101},
+    ])
+    resp = post_import(client, "users", body, "ndjson")
+    assert resp.status_code == 200, resp.text
+    result = resp.json()
+    assert result["inserted"] == 1
+    assert [e["row"] for e in result["errors"]] == [2, 3]
+    assert db.execute("SELECT email, dept_id, is_admin FROM users").fetchall() == [("a@edi5.cl", 101, False)]
+
+
+def test_import_reservations(client, db, gym_block):
+    start, end = gym_block
+    body = (
+        "res_id,dept_id,start_time,end_time,attendees\n"
+        f"1,101,{start.isoformat()},{end.isoformat()},2\n"
+        f"99,101,{start.isoformat()},{end.isoformat()},1\n"
+        f"1,101,{end.isoformat()},{start.isoformat()},1\n"
+    )
+    resp = post_import(client, "reservations", body)
+    assert resp.status_code == 200, resp.text
+    result = resp.json()
+    assert result["inserted"] == 1
+    assert [e["row"] for e in result["errors"]] == [2, 3]
+    rows = db.execute("SELECT res_id, dept_id, start_time, attendees FROM reservations").fetchall()
+    assert rows == [(1, 101, start, 2)]
+    occupancy = db.execute("SELECT attendees FROM block_occupancy WHERE res_id = 1 AND block_start = %s", (start,))
+    assert occupancy.fetchone() == (2,)
+
+
+def test_import_reservations_enforces_booking_rules(client, db, gym_block):
+    db.execute("INSERT INTO resources (id, name, type) VALUES (2, 'Quincho', 'QUINCHO')")
+    db.commit()
+    start, end = gym_block
+    later, later_end = start + timedelta(hours=2), end + timedelta(hours=2)
+    day = datetime.combine(start.date(), time.min)
+    day_end = day + timedelta(days=1) - timedelta(seconds=1)
+    body = (
+        "res_id,dept_id,start_time,end_time,attendees\n"
+        f"1,101,{start.isoformat()},{end.isoformat()},3\n"  # sobre dept_capacity (2)
+        f"1,101,{start.isoformat()},{end.isoformat()},1\n"  # válida: la anterior ya no cuenta
+        f"1,101,{later.isoformat()},{later_end.isoformat()},1\n"  # segundo bloque del día
+        f"2,101,{day.isoformat()},{day_end.isoformat()},10\n"
+        f"2,101,{day.isoformat()},{day_end.isoformat()},5\n"  # recurso común ya tomado ese día
+    )
+    resp = post_import(client, "reservations", body)
+    assert resp.status_code == 200, resp.text
+    result = resp.json()
+    assert result["inserted"] == 2
+    assert [e["row"] for e in result["errors"]] == [1, 3, 5]
+    rows = db.execute("SELECT res_id, start_time, attendees FROM reservations ORDER BY res_id").fetchall()
+    assert rows == [(1, start, 1), (2, day, 10)]
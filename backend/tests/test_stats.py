@@ -0,0 +1,25 @@
+import csv
+import io
+
+import pytest
+
+COLUMNS = {
+    "resources": ["res_id", "name", "bookings", "attendees", "days_used", "occupancy_rate"],
+    "blocks": ["block", "bookings", "attendees", "departments", "days_used", "occupancy_rate"],
+    "departments": ["dept_id", "bookings", "attendees", "days_used"],
+}
+
+
+@pytest.mark.parametrize("report", sorted(COLUMNS))
+def test_stats_csv_has_header_on_empty_range(client, db, report):
+    resp = client.get(f"/api/admin/stats/{report}", params={"from": "2000-01-01", "to": "2000-01-31", "format": "csv"})
+    assert resp.status_code == 200, resp.text
+    assert resp.headers["content-type"].startswith("text/csv")
+    lines = list(csv.reader(io.StringIO(resp.text)))
+    assert lines[0] == COLUMNS[report]
+
+
+def test_stats_csv_rows_match_header(client, db):
+    resp = client.get("/api/admin/stats/resources", params={"from": "2000-01-01", "to": "2000-01-31", "format": "csv"})
+    rows = list(csv.DictReader(io.StringIO(resp.text)))
+    assert [(row["res_id"], row["bookings"]) for row in rows] == [("1", "0")]
@@ -7,9 +7,12 @@ GRANT ALL PRIVILEGES ON DATABASE edi5_db TO edi5_user;
 GRANT CREATE, CONNECT ON DATABASE edi5_db TO edi5_user;
 -- Tabla de departamentos
 CREATE TABLE departments (
-    id PRIMARY KEY NOT NULL,
+    id INTEGER PRIMARY KEY NOT NULL,
     floor INTEGER NOT NULL,
-    access_code VARCHAR(20) NOT NULL
+    access_code VARCHAR(20) NOT NULL,
+    -- Código reemplazado en la última rotación; vale durante ACCESS_CODE_GRACE_SECONDS
+    previous_access_code VARCHAR(20),
+    access_code_changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 
 -- Tabla de usuarios (autenticación propia)
@@ -29,18 +32,637 @@ CREATE TABLE resources (
     type VARCHAR(10) CHECK (type IN ('GYM', 'QUINCHO', 'SALA'))
 );
 
--- Tabla de reservas
+-- Tabla de reservas, particionada por mes sobre start_time. Las consultas del
+-- día solo tocan la partición del mes y el vacuum trabaja por partición, así que
+-- el costo no crece con los años de historial. ensure_reservation_partitions()
+-- crea los meses siguientes y archive_reservation_partitions() mueve los antiguos
+-- a reservations_archive (python manage.py maintain-partitions).
 CREATE TABLE reservations (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     res_id INTEGER REFERENCES resources(id),
     dept_id INTEGER REFERENCES departments(id),
     start_time TIMESTAMP NOT NULL,
     end_time TIMESTAMP NOT NULL,
-    attendees INTEGER NOT NULL
+    attendees INTEGER NOT NULL,
+    -- La clave de partición debe ser parte de la clave primaria
+    PRIMARY KEY (id, start_time)
+) PARTITION BY RANGE (start_time);
+
+-- Red de seguridad para fechas sin partición (importaciones antiguas o lejanas);
+-- ensure_reservation_partitions() mueve sus filas a la partición que corresponda
+CREATE TABLE reservations_default PARTITION OF reservations DEFAULT;
+
+-- Meses archivados: mismas columnas, sin el trigger de ocupación
+CREATE TABLE reservations_archive (
+    id INTEGER NOT NULL,
+    res_id INTEGER,
+    dept_id INTEGER,
+    start_time TIMESTAMP NOT NULL,
+    end_time TIMESTAMP NOT NULL,
+    attendees INTEGER NOT NULL,
+    PRIMARY KEY (id, start_time)
+) PARTITION BY RANGE (start_time);
+
+-- Consultas históricas (GET /api/reservations?archive=true, exportación)
+CREATE VIEW reservations_history AS
+SELECT id, res_id, dept_id, start_time, end_time, attendees FROM reservations
+UNION ALL
+SELECT id, res_id, dept_id, start_time, end_time, attendees FROM reservations_archive;
+
+-- Horario de los recursos que se reservan por bloques (gimnasio, salas por hora).
+-- Los bloques de slot_minutes van desde opens_at hasta closes_at (00:00 = medianoche);
+-- capacity y dept_capacity son el aforo total y por departamento de cada bloque.
+-- Un recurso sin fila aquí se reserva por día completo.
+CREATE TABLE resource_schedules (
+    res_id INTEGER PRIMARY KEY REFERENCES resources(id) ON DELETE CASCADE,
+    slot_minutes INTEGER NOT NULL CHECK (slot_minutes > 0),
+    opens_at TIME NOT NULL,
+    closes_at TIME NOT NULL,
+    capacity INTEGER NOT NULL CHECK (capacity > 0),
+    dept_capacity INTEGER NOT NULL CHECK (dept_capacity > 0 AND dept_capacity <= capacity)
+);
+
+-- Días con horario especial: acortan el horario o, sin horas, cierran el día
+CREATE TABLE schedule_exceptions (
+    res_id INTEGER NOT NULL REFERENCES resource_schedules(res_id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    opens_at TIME,
+    closes_at TIME,
+    PRIMARY KEY (res_id, day),
+    CHECK ((opens_at IS NULL) = (closes_at IS NULL))
 );
 
 -- Índices y restricciones adicionales
-CREATE INDEX idx_reservations_res_id ON reservations(res_id);
-CREATE INDEX idx_reservations_dept_id ON reservations(dept_id);
+-- Todas las consultas por día filtran con rangos semiabiertos sobre start_time
+-- (start_time >= día AND start_time < día + 1), que estos índices resuelven
+-- con un index scan. Los prefijos res_id / dept_id cubren además las FK.
+
+-- Paginación keyset de GET /api/reservations (ORDER BY start_time DESC, id DESC)
+CREATE INDEX idx_reservations_start_id ON reservations(start_time, id);
+CREATE INDEX idx_reservations_dept_start_id ON reservations(dept_id, start_time, id);
+-- Disponibilidad y reservas del día por recurso: (res_id, start_time)
+CREATE INDEX idx_reservations_res_start_id ON reservations(res_id, start_time, id);
+-- Reserva existente de un departamento en un recurso ese día
+CREATE INDEX idx_reservations_dept_res_start ON reservations(dept_id, res_id, start_time);
+-- Al adjuntar un mes al archivo se reutilizan los índices que ya tenía la partición
+CREATE INDEX idx_reservations_archive_start_id ON reservations_archive(start_time, id);
+CREATE INDEX idx_reservations_archive_dept_start_id ON reservations_archive(dept_id, start_time, id);
+-- Paginación keyset de GET /api/users (ORDER BY full_name, id)
+CREATE INDEX idx_users_full_name_id ON users(full_name, id);
+
+-- Respuestas guardadas por Idempotency-Key (POST de reservas y altas).
+-- status_code NULL: la solicitud original todavía se está procesando.
+CREATE TABLE idempotency_keys (
+    key VARCHAR(255) NOT NULL,
+    scope VARCHAR(100) NOT NULL,
+    request_hash CHAR(64) NOT NULL,
+    status_code INTEGER,
+    content_type VARCHAR(100),
+    body BYTEA,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (key, scope)
+);
+CREATE INDEX idx_idempotency_keys_created ON idempotency_keys(created_at);
+
+-- Buckets del limitador de tasa compartido entre workers (RATE_LIMIT_BACKEND=postgres).
+-- UNLOGGED: si se pierden tras una caída, los buckets simplemente vuelven a llenarse.
+CREATE UNLOGGED TABLE rate_limit_buckets (
+    key VARCHAR(200) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL
+);
+
+-- Toma un token del bucket (p_rate tokens/segundo, hasta p_burst).
+-- Devuelve 0 si se concedió, o los segundos que faltan para el próximo token.
+CREATE OR REPLACE FUNCTION take_token(p_key TEXT, p_rate DOUBLE PRECISION, p_burst DOUBLE PRECISION)
+RETURNS DOUBLE PRECISION
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_tokens DOUBLE PRECISION;
+BEGIN
+    INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+    VALUES (p_key, p_burst, clock_timestamp())
+    ON CONFLICT (key) DO UPDATE
+       SET tokens = LEAST(p_burst, b.tokens + p_rate * extract(epoch FROM clock_timestamp() - b.updated_at)),
+           updated_at = clock_timestamp()
+    RETURNING tokens INTO v_tokens;
+    IF v_tokens < 1 THEN
+        RETURN (1 - v_tokens) / p_rate;
+    END IF;
+    UPDATE rate_limit_buckets SET tokens = tokens - 1 WHERE key = p_key;
+    RETURN 0;
+END;
+$$;
+
+-- Ocupación por (recurso, inicio de bloque), mantenida por trigger en la misma
+-- transacción que cada INSERT/UPDATE/DELETE de reservations. La disponibilidad
+-- y los chequeos de aforo leen de aquí con una búsqueda por clave primaria.
+CREATE TABLE block_occupancy (
+    res_id INTEGER NOT NULL REFERENCES resources(id) ON DELETE CASCADE,
+    block_start TIMESTAMP NOT NULL,
+    attendees INTEGER NOT NULL DEFAULT 0,
+    bookings INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (res_id, block_start)
+);
+
+CREATE OR REPLACE FUNCTION track_block_occupancy() RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- Cambio de asistentes sin mover la reserva: un solo UPDATE
+    IF TG_OP = 'UPDATE' AND NEW.res_id IS NOT DISTINCT FROM OLD.res_id
+       AND NEW.start_time = OLD.start_time THEN
+        UPDATE block_occupancy
+           SET attendees = attendees + NEW.attendees - OLD.attendees
+         WHERE res_id = NEW.res_id AND block_start = NEW.start_time;
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.res_id IS NOT NULL THEN
+        UPDATE block_occupancy
+           SET attendees = attendees - OLD.attendees, bookings = bookings - 1
+         WHERE res_id = OLD.res_id AND block_start = OLD.start_time;
+        DELETE FROM block_occupancy
+         WHERE res_id = OLD.res_id AND block_start = OLD.start_time AND bookings <= 0;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.res_id IS NOT NULL THEN
+        INSERT INTO block_occupancy (res_id, block_start, attendees, bookings)
+        VALUES (NEW.res_id, NEW.start_time, NEW.attendees, 1)
+        ON CONFLICT (res_id, block_start) DO UPDATE
+           SET attendees = block_occupancy.attendees + EXCLUDED.attendees,
+               bookings = block_occupancy.bookings + 1;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER reservations_block_occupancy
+AFTER INSERT OR DELETE OR UPDATE OF res_id, start_time, attendees ON reservations
+FOR EACH ROW EXECUTE FUNCTION track_block_occupancy();
+
+-- Recalcula block_occupancy desde cero (comando de mantenimiento / reparación)
+CREATE OR REPLACE FUNCTION rebuild_block_occupancy() RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_rows INTEGER;
+BEGIN
+    -- Impide escrituras en reservations mientras se recalcula
+    LOCK TABLE reservations IN SHARE MODE;
+    TRUNCATE block_occupancy;
+    INSERT INTO block_occupancy (res_id, block_start, attendees, bookings)
+    SELECT res_id, start_time, SUM(attendees), COUNT(*)
+      FROM reservations
+     WHERE res_id IS NOT NULL
+     GROUP BY res_id, start_time;
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+    RETURN v_rows;
+END;
+$$;
 
 -- Reglas de negocio y triggers pueden agregarse según necesidad
+
+-- Reserva atómica de bloques con aforo garantizado por la base de datos.
+-- La API hace una sola llamada por reserva. Orden de bloqueo (siempre el mismo,
+-- para no generar deadlocks): fila del departamento -> advisory lock del bloque
+-- -> fila de la reserva. lock_timeout corto: ante contención fallamos rápido.
+CREATE OR REPLACE FUNCTION book_block(
+    p_res_id INTEGER,
+    p_dept_id INTEGER,
+    p_start TIMESTAMP,
+    p_end TIMESTAMP,
+    p_attendees INTEGER,
+    p_capacity INTEGER,
+    p_dept_capacity INTEGER
+) RETURNS TABLE (status TEXT, reservation_id INTEGER, slot_start TIMESTAMP, occupied INTEGER)
+LANGUAGE plpgsql
+SET lock_timeout = '2s'
+AS $$
+DECLARE
+    v_day_start TIMESTAMP := date_trunc('day', p_start);
+    v_id INTEGER;
+    v_start TIMESTAMP;
+    v_own INTEGER;
+    v_others INTEGER;
+BEGIN
+    IF p_attendees < 1 OR p_attendees > p_dept_capacity THEN
+        RETURN QUERY SELECT 'dept_limit'::TEXT, NULL::INTEGER, NULL::TIMESTAMP, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    -- Una reserva por departamento y día: serializamos por departamento
+    PERFORM 1 FROM departments WHERE id = p_dept_id FOR NO KEY UPDATE;
+    -- Aforo del bloque: serializamos por (recurso, inicio del bloque en minutos)
+    PERFORM pg_advisory_xact_lock(p_res_id, (extract(epoch FROM p_start) / 60)::INTEGER);
+
+    SELECT r.id, r.start_time, r.attendees INTO v_id, v_start, v_own
+      FROM reservations r
+     WHERE r.res_id = p_res_id AND r.dept_id = p_dept_id
+       AND r.start_time >= v_day_start AND r.start_time < v_day_start + INTERVAL '1 day'
+     LIMIT 1;
+
+    IF v_id IS NOT NULL AND v_start <> p_start THEN
+        RETURN QUERY SELECT 'other_block'::TEXT, v_id, v_start, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    -- Ocupación del resto: lectura puntual del resumen menos lo propio
+    SELECT COALESCE(MAX(o.attendees), 0) - COALESCE(v_own, 0) INTO v_others
+      FROM block_occupancy o
+     WHERE o.res_id = p_res_id AND o.block_start = p_start;
+
+    IF v_others + p_attendees > p_capacity THEN
+        RETURN QUERY SELECT 'full'::TEXT, v_id, p_start, v_others;
+        RETURN;
+    END IF;
+
+    IF v_id IS NOT NULL THEN
+        UPDATE reservations SET attendees = p_attendees WHERE id = v_id AND start_time = v_start;
+        RETURN QUERY SELECT 'updated'::TEXT, v_id, p_start, v_others + p_attendees;
+    ELSE
+        INSERT INTO reservations (res_id, dept_id, start_time, end_time, attendees)
+        VALUES (p_res_id, p_dept_id, p_start, p_end, p_attendees)
+        RETURNING id INTO v_id;
+        RETURN QUERY SELECT 'created'::TEXT, v_id, p_start, v_others + p_attendees;
+    END IF;
+END;
+$$;
+
+-- Cambia los asistentes de una reserva existente con la misma regla de aforo
+CREATE OR REPLACE FUNCTION resize_block_reservation(
+    p_id INTEGER,
+    p_attendees INTEGER,
+    p_capacity INTEGER,
+    p_dept_capacity INTEGER
+) RETURNS TABLE (status TEXT, reservation_id INTEGER, slot_start TIMESTAMP, occupied INTEGER)
+LANGUAGE plpgsql
+SET lock_timeout = '2s'
+AS $$
+DECLARE
+    v_res_id INTEGER;
+    v_dept_id INTEGER;
+    v_start TIMESTAMP;
+    v_own INTEGER;
+    v_others INTEGER;
+BEGIN
+    SELECT r.res_id, r.dept_id, r.start_time INTO v_res_id, v_dept_id, v_start
+      FROM reservations r WHERE r.id = p_id;
+    IF v_res_id IS NULL THEN
+        RETURN QUERY SELECT 'not_found'::TEXT, p_id, NULL::TIMESTAMP, NULL::INTEGER;
+        RETURN;
+    END IF;
+    IF p_attendees < 1 OR p_attendees > p_dept_capacity THEN
+        RETURN QUERY SELECT 'dept_limit'::TEXT, p_id, v_start, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    PERFORM 1 FROM departments WHERE id = v_dept_id FOR NO KEY UPDATE;
+    PERFORM pg_advisory_xact_lock(v_res_id, (extract(epoch FROM v_start) / 60)::INTEGER);
+
+    -- Releemos ya con los locks tomados por si la reserva cambió o se borró
+    SELECT r.attendees INTO v_own
+      FROM reservations r WHERE r.id = p_id AND r.start_time = v_start FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'not_found'::TEXT, p_id, NULL::TIMESTAMP, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    SELECT COALESCE(MAX(o.attendees), 0) - v_own INTO v_others
+      FROM block_occupancy o
+     WHERE o.res_id = v_res_id AND o.block_start = v_start;
+
+    IF v_others + p_attendees > p_capacity THEN
+        RETURN QUERY SELECT 'full'::TEXT, p_id, v_start, v_others;
+        RETURN;
+    END IF;
+
+    UPDATE reservations SET attendees = p_attendees WHERE id = p_id AND start_time = v_start;
+    RETURN QUERY SELECT 'updated'::TEXT, p_id, v_start, v_others + p_attendees;
+END;
+$$;
+
+-- En una instalación nueva aún no hay recursos: se crea el gimnasio como recurso 1
+-- (el GYM_RES_ID por defecto) para que /api/reserve/gym* funcione desde el inicio
+INSERT INTO resources (id, name, type)
+SELECT 1, 'Gimnasio', 'GYM' WHERE NOT EXISTS (SELECT 1 FROM resources WHERE type = 'GYM')
+ON CONFLICT (id) DO NOTHING;
+SELECT setval(pg_get_serial_sequence('resources', 'id'), (SELECT MAX(id) FROM resources));
+
+-- Horario del gimnasio (antes fijo en el código): bloques de 1 hora de 08:00 a 21:00,
+-- 3 personas por bloque y 2 por departamento
+INSERT INTO resource_schedules (res_id, slot_minutes, opens_at, closes_at, capacity, dept_capacity)
+SELECT id, 60, '08:00', '21:00', 3, 2 FROM resources WHERE type = 'GYM'
+ON CONFLICT (res_id) DO NOTHING;
+
+-- Asignación por lotes del modo de reserva por turnos: aplica book_block a cada
+-- solicitud en el orden recibido, dentro de la transacción de quien llama.
+-- Un lock que no se obtiene a tiempo solo marca esa solicitud como 'busy'.
+CREATE OR REPLACE FUNCTION book_blocks(
+    p_res_id INTEGER,
+    p_dept_ids INTEGER[],
+    p_starts TIMESTAMP[],
+    p_ends TIMESTAMP[],
+    p_attendees INTEGER[],
+    p_capacity INTEGER,
+    p_dept_capacity INTEGER
+) RETURNS TABLE (ord INTEGER, status TEXT, reservation_id INTEGER, slot_start TIMESTAMP, occupied INTEGER)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    FOR i IN 1 .. COALESCE(array_length(p_dept_ids, 1), 0) LOOP
+        BEGIN
+            RETURN QUERY
+            SELECT i, b.status, b.reservation_id, b.slot_start, b.occupied
+              FROM book_block(p_res_id, p_dept_ids[i], p_starts[i], p_ends[i], p_attendees[i],
+                              p_capacity, p_dept_capacity) b;
+        EXCEPTION WHEN lock_not_available THEN
+            RETURN QUERY SELECT i, 'busy'::TEXT, NULL::INTEGER, p_starts[i], NULL::INTEGER;
+        END;
+    END LOOP;
+END;
+$$;
+
+-- Reserva de muchos bloques/días de un recurso en una sola llamada
+-- (POST /api/reservations/batch). Mismo orden de bloqueo que book_block: fila
+-- del departamento y luego el advisory lock de cada bloque, por hora de inicio.
+-- Una consulta valida todos los bloques y un INSERT ... SELECT crea los válidos;
+-- sin p_partial, si alguno falla no se crea ninguno. p_capacity NULL indica un
+-- recurso por día completo: exclusivo, una reserva por día. p_dept_id NULL
+-- (bloqueo del administrador) no aplica la regla de una reserva diaria.
+CREATE OR REPLACE FUNCTION book_batch(
+    p_res_id INTEGER,
+    p_dept_id INTEGER,
+    p_starts TIMESTAMP[],
+    p_ends TIMESTAMP[],
+    p_attendees INTEGER,
+    p_capacity INTEGER,
+    p_partial BOOLEAN
+) RETURNS TABLE (ord INTEGER, status TEXT, reservation_id INTEGER, slot_start TIMESTAMP, occupied INTEGER)
+LANGUAGE plpgsql
+SET lock_timeout = '2s'
+AS $$
+#variable_conflict use_column
+BEGIN
+    IF p_dept_id IS NOT NULL THEN
+        PERFORM 1 FROM departments WHERE id = p_dept_id FOR NO KEY UPDATE;
+    END IF;
+    PERFORM pg_advisory_xact_lock(p_res_id, (extract(epoch FROM b.st) / 60)::INTEGER)
+       FROM (SELECT DISTINCT st FROM unnest(p_starts) AS u(st) ORDER BY st) b;
+
+    CREATE TEMP TABLE batch_slots ON COMMIT DROP AS
+    SELECT s.ord::INTEGER AS ord, s.st, s.en,
+           COALESCE(o.attendees, 0) + p_attendees AS occupied,
+           CASE
+               WHEN row_number() OVER (PARTITION BY s.st ORDER BY s.ord) > 1 THEN 'duplicate'
+               WHEN p_capacity IS NULL AND COALESCE(o.bookings, 0) > 0 THEN 'taken'
+               WHEN p_capacity IS NOT NULL AND COALESCE(o.attendees, 0) + p_attendees > p_capacity THEN 'full'
+               WHEN p_capacity IS NOT NULL AND p_dept_id IS NOT NULL AND (
+                    row_number() OVER (PARTITION BY s.st::DATE ORDER BY s.ord) > 1
+                    OR EXISTS (
+                        SELECT 1 FROM reservations r
+                         WHERE r.res_id = p_res_id AND r.dept_id = p_dept_id
+                           AND r.start_time >= s.st::DATE AND r.start_time < s.st::DATE + 1
+                    )) THEN 'other_block'
+               ELSE 'ok'
+           END AS status
+      FROM unnest(p_starts, p_ends) WITH ORDINALITY AS s(st, en, ord)
+      LEFT JOIN block_occupancy o ON o.res_id = p_res_id AND o.block_start = s.st;
+
+    IF NOT p_partial AND EXISTS (SELECT 1 FROM batch_slots b WHERE b.status <> 'ok') THEN
+        RETURN QUERY SELECT b.ord, b.status, NULL::INTEGER, b.st, NULL::INTEGER FROM batch_slots b ORDER BY b.ord;
+        RETURN;
+    END IF;
+
+    RETURN QUERY
+    WITH ins AS (
+        INSERT INTO reservations (res_id, dept_id, start_time, end_time, attendees)
+        SELECT p_res_id, p_dept_id, b.st, b.en, p_attendees FROM batch_slots b WHERE b.status = 'ok'
+        RETURNING id, start_time
+    )
+    SELECT b.ord,
+           CASE WHEN b.status = 'ok' THEN 'created' ELSE b.status END,
+           ins.id,
+           b.st,
+           CASE WHEN b.status = 'ok' THEN b.occupied END
+      FROM batch_slots b
+      LEFT JOIN ins ON b.status = 'ok' AND ins.start_time = b.st
+     ORDER BY b.ord;
+END;
+$$;
+
+-- Resultado de cada ticket del modo por turnos (consultado con GET /api/reserve/gym/tickets/{id})
+CREATE TABLE booking_tickets (
+    id VARCHAR(64) PRIMARY KEY,
+    res_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    reservation_id INTEGER,
+    slot_start TIMESTAMP,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX idx_booking_tickets_created ON booking_tickets(created_at);
+
+-- Crea las particiones mensuales desde el mes más antiguo que haya en la
+-- partición por defecto (o el actual) hasta p_months_ahead meses adelante.
+-- Devuelve cuántas particiones creó.
+CREATE OR REPLACE FUNCTION ensure_reservation_partitions(p_months_ahead INTEGER DEFAULT 3) RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_month DATE;
+    v_last DATE := (date_trunc('month', current_date) + make_interval(months => p_months_ahead))::DATE;
+    v_name TEXT;
+    v_created INTEGER := 0;
+BEGIN
+    SELECT LEAST(date_trunc('month', MIN(start_time)), date_trunc('month', current_date))::DATE
+      INTO v_month FROM reservations_default;
+
+    WHILE v_month <= v_last LOOP
+        v_name := 'reservations_p' || to_char(v_month, 'YYYYMM');
+        IF to_regclass(v_name) IS NULL THEN
+            -- No se puede crear un rango que ya tenga filas en la partición por
+            -- defecto: se sacan, se crea la partición y se vuelven a insertar
+            CREATE TEMP TABLE moved_reservations (LIKE reservations);
+            WITH moved AS (
+                DELETE FROM reservations_default
+                 WHERE start_time >= v_month AND start_time < v_month + INTERVAL '1 month'
+                RETURNING *
+            )
+            INSERT INTO moved_reservations SELECT * FROM moved;
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF reservations FOR VALUES FROM (%L) TO (%L)',
+                v_name, v_month, (v_month + INTERVAL '1 month')::DATE
+            );
+            INSERT INTO reservations SELECT * FROM moved_reservations;
+            DROP TABLE moved_reservations;
+            v_created := v_created + 1;
+        END IF;
+        v_month := (v_month + INTERVAL '1 month')::DATE;
+    END LOOP;
+    RETURN v_created;
+END;
+$$;
+
+-- Pasa a reservations_archive los meses anteriores a los últimos p_keep_months
+-- (DETACH/ATTACH: solo metadatos, sin copiar filas) y borra su ocupación por
+-- bloque, que ya no se consulta. Devuelve cuántos meses archivó.
+CREATE OR REPLACE FUNCTION archive_reservation_partitions(p_keep_months INTEGER DEFAULT 12) RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_cutoff DATE := (date_trunc('month', current_date) - make_interval(months => p_keep_months))::DATE;
+    v_name TEXT;
+    v_month DATE;
+    v_archived INTEGER := 0;
+BEGIN
+    FOR v_name, v_month IN
+        SELECT c.relname, to_date(substring(c.relname FROM '(\d{6})$'), 'YYYYMM')
+          FROM pg_inherits i
+          JOIN pg_class c ON c.oid = i.inhrelid
+         WHERE i.inhparent = 'reservations'::regclass
+           AND c.relname ~ '^reservations_p\d{6}$'
+         ORDER BY 2
+    LOOP
+        EXIT WHEN v_month >= v_cutoff;
+        EXECUTE format('ALTER TABLE reservations DETACH PARTITION %I', v_name);
+        EXECUTE format(
+            'ALTER TABLE reservations_archive ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+            v_name, v_month, (v_month + INTERVAL '1 month')::DATE
+        );
+        DELETE FROM block_occupancy
+         WHERE block_start >= v_month AND block_start < v_month + INTERVAL '1 month';
+        v_archived := v_archived + 1;
+    END LOOP;
+    RETURN v_archived;
+END;
+$$;
+
+SELECT ensure_reservation_partitions();
+
+-- Estadísticas de uso pre-agregadas por día (GET /api/admin/stats/*): los
+-- reportes leen solo de aquí, nunca de reservations. usage_dirty anota qué
+-- (día, recurso) cambió y refresh_usage_rollups() recalcula solo esos.
+CREATE TABLE usage_daily (
+    day DATE NOT NULL,
+    res_id INTEGER NOT NULL REFERENCES resources(id) ON DELETE CASCADE,
+    block_start TIME NOT NULL,
+    bookings INTEGER NOT NULL,
+    attendees INTEGER NOT NULL,
+    departments INTEGER NOT NULL,
+    PRIMARY KEY (day, res_id, block_start)
+);
+
+CREATE TABLE usage_daily_dept (
+    day DATE NOT NULL,
+    res_id INTEGER NOT NULL REFERENCES resources(id) ON DELETE CASCADE,
+    dept_id INTEGER NOT NULL,
+    bookings INTEGER NOT NULL,
+    attendees INTEGER NOT NULL,
+    PRIMARY KEY (day, res_id, dept_id)
+);
+CREATE INDEX idx_usage_daily_res_day ON usage_daily(res_id, day);
+
+CREATE TABLE usage_dirty (
+    day DATE NOT NULL,
+    res_id INTEGER NOT NULL,
+    PRIMARY KEY (day, res_id)
+);
+
+CREATE OR REPLACE FUNCTION mark_usage_dirty() RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.res_id IS NOT NULL THEN
+        INSERT INTO usage_dirty VALUES (OLD.start_time::DATE, OLD.res_id) ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.res_id IS NOT NULL THEN
+        INSERT INTO usage_dirty VALUES (NEW.start_time::DATE, NEW.res_id) ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER reservations_usage_dirty
+AFTER INSERT OR DELETE OR UPDATE OF res_id, dept_id, start_time, attendees ON reservations
+FOR EACH ROW EXECUTE FUNCTION mark_usage_dirty();
+
+-- Recalcula los (día, recurso) pendientes; lee de reservations_history para que
+-- un día ya archivado también se pueda recalcular. Si otro proceso está
+-- refrescando, no hace nada. Devuelve cuántos (día, recurso) recalculó.
+CREATE OR REPLACE FUNCTION refresh_usage_rollups() RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_rows INTEGER;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('refresh_usage_rollups')) THEN
+        RETURN 0;
+    END IF;
+    CREATE TEMP TABLE usage_refresh (day DATE, res_id INTEGER) ON COMMIT DROP;
+    WITH done AS (DELETE FROM usage_dirty RETURNING day, res_id)
+    INSERT INTO usage_refresh SELECT day, res_id FROM done;
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+
+    DELETE FROM usage_daily u USING usage_refresh f WHERE u.day = f.day AND u.res_id = f.res_id;
+    DELETE FROM usage_daily_dept u USING usage_refresh f WHERE u.day = f.day AND u.res_id = f.res_id;
+
+    INSERT INTO usage_daily (day, res_id, block_start, bookings, attendees, departments)
+    SELECT f.day, f.res_id, r.start_time::TIME, COUNT(*), SUM(r.attendees), COUNT(DISTINCT r.dept_id)
+      FROM usage_refresh f
+      JOIN reservations_history r
+        ON r.res_id = f.res_id AND r.start_time >= f.day AND r.start_time < f.day + 1
+     GROUP BY f.day, f.res_id, r.start_time::TIME;
+
+    INSERT INTO usage_daily_dept (day, res_id, dept_id, bookings, attendees)
+    SELECT f.day, f.res_id, r.dept_id, COUNT(*), SUM(r.attendees)
+      FROM usage_refresh f
+      JOIN reservations_history r
+        ON r.res_id = f.res_id AND r.start_time >= f.day AND r.start_time < f.day + 1
+     WHERE r.dept_id IS NOT NULL
+     GROUP BY f.day, f.res_id, r.dept_id;
+
+    DROP TABLE usage_refresh;
+    RETURN v_rows;
+END;
+$$;
+
+-- Cualquier cambio de access_code (edición, importación o rotación masiva)
+-- guarda el código anterior para el periodo de gracia de /api/access/verify.
+CREATE OR REPLACE FUNCTION keep_previous_access_code() RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NEW.access_code IS DISTINCT FROM OLD.access_code THEN
+        NEW.previous_access_code := OLD.access_code;
+        NEW.access_code_changed_at := now();
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER departments_previous_access_code
+BEFORE UPDATE OF access_code ON departments
+FOR EACH ROW EXECUTE FUNCTION keep_previous_access_code();
+
+-- Ejecuciones de las tareas programadas (GET /api/admin/jobs/runs)
+CREATE TABLE job_runs (
+    id BIGSERIAL PRIMARY KEY,
+    job VARCHAR(64) NOT NULL,
+    trigger VARCHAR(16) NOT NULL,
+    worker VARCHAR(128) NOT NULL,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ,
+    status VARCHAR(16) NOT NULL DEFAULT 'running',
+    detail TEXT
+);
+CREATE INDEX idx_job_runs_job_started ON job_runs(job, started_at DESC);
+
+-- Carga inicial del resumen de ocupación (necesaria al migrar una base existente)
+SELECT rebuild_block_occupancy();
+
+-- Carga inicial de las estadísticas de uso
+INSERT INTO usage_dirty
+SELECT DISTINCT start_time::DATE, res_id FROM reservations_history WHERE res_id IS NOT NULL
+ON CONFLICT DO NOTHING;
+SELECT refresh_usage_rollups();
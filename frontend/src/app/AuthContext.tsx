@@ -5,7 +5,11 @@ export type AuthUser = {
   id: string;
   email: string;
   full_name: string;
+  dept_id: number | null;
   is_admin: boolean;
+  // Token firmado por /api/login (lleva el departamento) y su token de refresco
+  token: string;
+  refresh_token: string;
 };
 
 interface AuthContextProps {
@@ -1,6 +1,6 @@
 "use client";
 
-import { API_HOST } from "../../config/api";
+import { API_HOST, authFetch } from "../../config/api";
 import React, { useState, useEffect } from "react";
 import { useAuth } from "../AuthContext";
 import { useRouter } from "next/navigation";
@@ -17,6 +17,11 @@ export default function AdminPage() {
   const [departments, setDepartments] = useState<any[]>([]);
   const [resources, setResources] = useState<any[]>([]);
   const [users, setUsers] = useState<any[]>([]);
+  const [reservationsCursor, setReservationsCursor] = useState<string | null>(null);
+  const [usersCursor, setUsersCursor] = useState<string | null>(null);
+  const [departmentsCursor, setDepartmentsCursor] = useState<string | null>(null);
+  const [counts, setCounts] = useState<{ [table: string]: number }>({});
+  const [occupancyToday, setOccupancyToday] = useState<any[]>([]);
 
   // Estados de Formularios
   const [userForm, setUserForm] = useState({ email: '', password: '', full_name: '', dept_id: '', is_admin: false });
@@ -42,18 +47,19 @@ export default function AdminPage() {
     router.push("/");
   };
 
+  // Una sola llamada trae conteos, ocupación de hoy y la primera página de cada tabla
   const fetchData = async () => {
     try {
-      const [resv, depts, res, us] = await Promise.all([
-        fetch(`${API_HOST}/api/reservations`).then(r => r.json()),
-        fetch(`${API_HOST}/api/departments`).then(r => r.json()),
-        fetch(`${API_HOST}/api/resources`).then(r => r.json()),
-        fetch(`${API_HOST}/api/users`).then(r => r.json()),
-      ]);
-      setReservations(resv || []);
-      setDepartments(depts || []);
-      setResources(res || []);
-      setUsers(us || []);
+      const data = await authFetch(`${API_HOST}/api/admin/overview`).then(r => r.json());
+      setCounts(data.counts || {});
+      setOccupancyToday(data.occupancy_today || []);
+      setResources(data.resources || []);
+      setReservations(data.reservations.items);
+      setReservationsCursor(data.reservations.next_cursor);
+      setUsers(data.users.items);
+      setUsersCursor(data.users.next_cursor);
+      setDepartments(data.departments.items);
+      setDepartmentsCursor(data.departments.next_cursor);
     } catch (e) {
       setError("Error de conexión con el servidor");
     } finally {
@@ -65,11 +71,45 @@ export default function AdminPage() {
     if (user?.is_admin) fetchData(); 
   }, [user]);
 
+  const loadMore = async (
+    endpoint: string,
+    cursor: string | null,
+    setRows: React.Dispatch<React.SetStateAction<any[]>>,
+    setCursor: (cursor: string | null) => void,
+  ) => {
+    if (!cursor) return;
+    const resp = await authFetch(`${API_HOST}/api/${endpoint}?limit=50&cursor=${encodeURIComponent(cursor)}`);
+    if (resp.ok) {
+      const page = await resp.json();
+      setRows(prev => [...prev, ...page]);
+      setCursor(resp.headers.get("X-Next-Cursor"));
+    }
+  };
+
+  // Las mutaciones devuelven la fila afectada: parchamos el estado local en vez de recargar todo
+  const upsertRow = (setRows: React.Dispatch<React.SetStateAction<any[]>>, row: any, previousId?: any) => {
+    setRows(prev => {
+      const id = previousId ?? row.id;
+      return prev.some(x => x.id === id) ? prev.map(x => (x.id === id ? row : x)) : [row, ...prev];
+    });
+  };
+
+  const setters: { [endpoint: string]: React.Dispatch<React.SetStateAction<any[]>> } = {
+    users: setUsers, reservations: setReservations, departments: setDepartments, resources: setResources,
+  };
+
+  const bumpCount = (table: string, delta: number) => {
+    setCounts(prev => ({ ...prev, [table]: (prev[table] ?? 0) + delta }));
+  };
+
   // --- HANDLERS ---
   const handleDelete = async (endpoint: string, id: any) => {
     if (!confirm('¿Confirmas la eliminación permanente?')) return;
-    const resp = await fetch(`${API_HOST}/api/${endpoint}/${id}`, { method: 'DELETE' });
-    if (resp.ok) fetchData();
+    const resp = await authFetch(`${API_HOST}/api/${endpoint}/${id}`, { method: 'DELETE' });
+    if (resp.ok) {
+      setters[endpoint](prev => prev.filter(x => x.id !== id));
+      bumpCount(endpoint, -1);
+    }
   };
 
   const handleUserSubmit = async (e: React.FormEvent) => {
@@ -79,15 +119,16 @@ export default function AdminPage() {
     const payload = { ...userForm };
     if (editingUser && !payload.password) delete payload.password;
 
-    const resp = await fetch(url, {
+    const resp = await authFetch(url, {
       method,
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(payload)
     });
     if (resp.ok) {
+      upsertRow(setUsers, await resp.json());
+      if (!editingUser) bumpCount('users', 1);
       setUserForm({ email: '', password: '', full_name: '', dept_id: '', is_admin: false });
       setEditingUser(null);
-      fetchData();
     }
   };
 
@@ -95,15 +136,17 @@ export default function AdminPage() {
     e.preventDefault();
     const method = editingDept ? 'PUT' : 'POST';
     const url = editingDept ? `${API_HOST}/api/departments/${editingDept.id}` : `${API_HOST}/api/departments`;
-    const resp = await fetch(url, {
+    const resp = await authFetch(url, {
       method,
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify(deptForm)
+      // El número del departamento es su id
+      body: JSON.stringify({ id: Number(deptForm.number), floor: Number(deptForm.floor), access_code: deptForm.access_code })
     });
     if (resp.ok) {
+      upsertRow(setDepartments, await resp.json(), editingDept?.id);
+      if (!editingDept) bumpCount('departments', 1);
       setDeptForm({ number: '', floor: '', access_code: '' });
       setEditingDept(null);
-      fetchData();
     }
   };
 
@@ -111,22 +154,20 @@ export default function AdminPage() {
     e.preventDefault();
     const method = editingRes ? 'PUT' : 'POST';
     const url = editingRes ? `${API_HOST}/api/resources/${editingRes.id}` : `${API_HOST}/api/resources`;
-    const resp = await fetch(url, {
+    const resp = await authFetch(url, {
       method,
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(resForm)
     });
     if (resp.ok) {
+      upsertRow(setResources, await resp.json());
+      if (!editingRes) bumpCount('resources', 1);
       setResForm({ name: '', type: 'GYM' });
       setEditingRes(null);
-      fetchData();
     }
   };
 
-  const getDeptLabel = (id: any) => {
-    const d = departments.find(d => d.id === Number(id));
-    return d ? d.number : 'N/A';
-  };
+  const getDeptLabel = (id: any) => id ?? 'N/A';
 
   if (loading || !user || !user.is_admin) return <div className="min-h-screen bg-[#1A161D]" />;
 
@@ -150,6 +191,7 @@ export default function AdminPage() {
                   className={`px-4 py-2 rounded-lg text-[9px] font-bold uppercase tracking-widest transition-all ${activeTab === tab ? 'bg-[#C26B4E] text-white shadow-lg' : 'text-[#888888]'}`}
                 >
                   {tab === 'users' ? 'Usuarios' : tab === 'reservations' ? 'Reservas' : tab === 'departments' ? 'Deptos' : 'Recursos'}
+                  {counts[tab] !== undefined && <span className="ml-1 opacity-60">{counts[tab]}</span>}
                 </button>
               ))}
             </nav>
@@ -186,7 +228,7 @@ export default function AdminPage() {
                     <label className="text-[9px] uppercase text-[#888888] font-bold">Depto</label>
                     <select value={userForm.dept_id} onChange={e => setUserForm({...userForm, dept_id: e.target.value})} className="w-full bg-[#1A161D] border border-[#362E3A] rounded-xl px-4 py-3 text-xs outline-none focus:border-[#C26B4E]">
                       <option value="">Seleccionar...</option>
-                      {departments.map(d => <option key={d.id} value={d.id}>{d.number}</option>)}
+                      {departments.map(d => <option key={d.id} value={d.id}>{d.id}</option>)}
                     </select>
                   </div>
                   <button type="submit" className="py-3 bg-[#C26B4E] text-white text-[10px] font-bold uppercase tracking-widest rounded-xl hover:shadow-lg transition-all">
@@ -221,12 +263,27 @@ export default function AdminPage() {
                     ))}
                   </tbody>
                 </table>
+                {usersCursor && (
+                  <button onClick={() => loadMore('users', usersCursor, setUsers, setUsersCursor)} className="w-full p-4 text-[9px] font-bold uppercase tracking-widest text-[#888888] hover:text-[#C26B4E] border-t border-[#362E3A] transition-colors">
+                    Cargar más
+                  </button>
+                )}
               </div>
             </div>
           )}
 
           {/* TAB RESERVAS */}
           {activeTab === 'reservations' && (
+            <div className="space-y-6">
+            <div className="grid grid-cols-2 md:grid-cols-4 gap-3">
+              {occupancyToday.map(o => (
+                <div key={o.res_id} className="container-glass p-4">
+                  <p className="text-[8px] text-[#7B5C7E] font-bold uppercase mb-1 tracking-widest">Hoy</p>
+                  <h4 className="font-bold tracking-tighter">{o.name}</h4>
+                  <p className="text-[10px] text-[#888888]">{o.capacity > 1 ? `${o.attendees} / ${o.capacity} cupos` : (o.bookings ? 'Reservado' : 'Libre')}</p>
+                </div>
+              ))}
+            </div>
             <div className="container-glass overflow-hidden">
               <table className="w-full text-left text-xs">
                 <thead className="bg-[#1A161D] text-[#7B5C7E] font-bold uppercase tracking-widest border-b border-[#362E3A]">
@@ -249,6 +306,12 @@ export default function AdminPage() {
                   )}
                 </tbody>
               </table>
+              {reservationsCursor && (
+                <button onClick={() => loadMore('reservations', reservationsCursor, setReservations, setReservationsCursor)} className="w-full p-4 text-[9px] font-bold uppercase tracking-widest text-[#888888] hover:text-[#C26B4E] border-t border-[#362E3A] transition-colors">
+                  Cargar más
+                </button>
+              )}
+            </div>
             </div>
           )}
 
@@ -281,17 +344,22 @@ export default function AdminPage() {
                   <tbody className="divide-y divide-[#362E3A]">
                     {departments.map(d => (
                       <tr key={d.id} className="hover:bg-white/5 transition-colors">
-                        <td className="p-4 font-bold">Depto {d.number}</td>
+                        <td className="p-4 font-bold">Depto {d.id}</td>
                         <td className="p-4 text-[#888888]">Piso {d.floor}</td>
                         <td className="p-4 font-mono text-[#C26B4E]">{d.access_code}</td>
                         <td className="p-4 text-right space-x-4">
-                          <button onClick={() => { setEditingDept(d); setDeptForm(d); }} className="text-[#888888] hover:text-white text-[9px] font-bold uppercase">Editar</button>
+                          <button onClick={() => { setEditingDept(d); setDeptForm({ number: String(d.id), floor: String(d.floor), access_code: d.access_code }); }} className="text-[#888888] hover:text-white text-[9px] font-bold uppercase">Editar</button>
                           <button onClick={() => handleDelete('departments', d.id)} className="text-red-500/40 hover:text-red-500 text-[9px] font-bold uppercase">Borrar</button>
                         </td>
                       </tr>
                     ))}
                   </tbody>
                 </table>
+                {departmentsCursor && (
+                  <button onClick={() => loadMore('admin/departments', departmentsCursor, setDepartments, setDepartmentsCursor)} className="w-full p-4 text-[9px] font-bold uppercase tracking-widest text-[#888888] hover:text-[#C26B4E] border-t border-[#362E3A] transition-colors">
+                    Cargar más
+                  </button>
+                )}
               </div>
             </div>
           )}
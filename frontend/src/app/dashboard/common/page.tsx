@@ -2,7 +2,7 @@
 import { useEffect, useState } from "react";
 import { useAuth } from "../../AuthContext";
 import { useRouter } from "next/navigation";
-import { API_HOST } from "../../../config/api";
+import { API_HOST, postIdempotent } from "../../../config/api";
 import Link from "next/link";
 
 export default function CommonSpacesPage() {
@@ -28,16 +28,10 @@ export default function CommonSpacesPage() {
     async function fetchData() {
       if (!user) return;
       try {
-        const [resResources, resUser] = await Promise.all([
-          fetch(`${API_HOST}/api/resources`),
-          fetch(`${API_HOST}/api/users/${user.id}`)
-        ]);
-        
-        const resourcesData = await resResources.json();
-        const userData = await resUser.json();
-        
+        // El departamento viene en la sesión del login
+        if (user.dept_id) setDeptId(user.dept_id);
+        const resourcesData = await fetch(`${API_HOST}/api/resources`).then(r => r.json());
         setResources(resourcesData.filter((r: any) => r.type !== 'GYM') || []);
-        if (userData?.dept_id) setDeptId(userData.dept_id);
       } catch (e) {
         console.error("Error cargando datos");
       } finally {
@@ -57,11 +51,7 @@ export default function CommonSpacesPage() {
     
     setReserveLoading(true);
     try {
-      const res = await fetch(`${API_HOST}/api/reserve/common`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ resource_id: selected, date, attendees, dept_id: deptId }),
-      });
+      const res = await postIdempotent(`${API_HOST}/api/reserve/common`, { resource_id: selected, date, attendees, dept_id: deptId });
       const result = await res.json();
       if (res.ok) {
         setMessage("Solicitud de reserva enviada con éxito.");
@@ -2,14 +2,12 @@
 import { useEffect, useState, useCallback } from "react";
 import { useAuth } from "../../AuthContext";
 import { useRouter } from "next/navigation";
-import { API_HOST } from "../../../config/api";
+import { API_HOST, authFetch, postIdempotent } from "../../../config/api";
 import Link from "next/link";
 
-const BLOCKS = [
-  "08:00-09:00", "09:00-10:00", "10:00-11:00", "11:00-12:00",
-  "12:00-13:00", "13:00-14:00", "14:00-15:00", "15:00-16:00",
-  "16:00-17:00", "17:00-18:00", "18:00-19:00", "19:00-20:00", "20:00-21:00",
-];
+const GYM_RES_ID = 1;
+
+type Schedule = { slots: string[]; capacity: number; dept_capacity: number };
 
 export default function GymPage() {
   const { user, loading: authLoading } = useAuth();
@@ -24,32 +22,28 @@ export default function GymPage() {
   const [isSyncing, setIsSyncing] = useState(false);
   const [deptId, setDeptId] = useState<number | null>(null);
   const [userReservation, setUserReservation] = useState<any | null>(null);
+  // Bloques y aforo vienen del horario del recurso en la API
+  const [schedule, setSchedule] = useState<Schedule | null>(null);
 
-  const fetchAvailability = useCallback(async () => {
+  const fetchUserReservation = useCallback(async () => {
     if (!deptId) return;
     setIsSyncing(true);
     try {
-      // Usamos el nuevo endpoint de disponibilidad optimizado
-      const res = await fetch(`${API_HOST}/api/reserve/gym/availability?t=${Date.now()}`);
-      if (res.ok) {
-        const data = await res.json();
-        setAvailability(data);
-      }
-      
-      // Consultamos las reservas del departamento
-      const resUser = await fetch(`${API_HOST}/api/reservations?dept_id=${deptId}`);
+      // Consultamos solo las reservas de gimnasio de hoy del departamento (filtradas en el servidor)
+      const now = new Date();
+      const today = now.toLocaleDateString("en-CA");
+      const tomorrow = new Date(now.getFullYear(), now.getMonth(), now.getDate() + 1).toLocaleDateString("en-CA");
+      const resUser = await authFetch(`${API_HOST}/api/reservations?dept_id=${deptId}&res_id=${GYM_RES_ID}&from=${today}&to=${tomorrow}&limit=1`);
       if (resUser.ok) {
         const reservations = await resUser.json();
-        const activeGymRes = reservations.find((r: any) => 
-          r.res_id === 1 || r.resource_name?.toLowerCase().includes('gym')
-        );
+        const activeGymRes = reservations[0];
         
         if (activeGymRes) {
           setUserReservation(activeGymRes);
           // La API nos devuelve start_time como "2023-10-10T08:00:00"
           // Mapeamos de vuelta al formato del bloque "08:00-09:00"
           const timePart = activeGymRes.start_time.split('T')[1].substring(0, 5);
-          const foundBlock = BLOCKS.find(b => b.startsWith(timePart));
+          const foundBlock = schedule?.slots.find(b => b.startsWith(timePart));
           
           if (foundBlock) {
             setSelectedBlock(foundBlock);
@@ -64,25 +58,39 @@ export default function GymPage() {
     } finally {
       setIsSyncing(false);
     }
-  }, [deptId]);
+  }, [deptId, schedule]);
 
   useEffect(() => {
-    async function init() {
-      if (!user) return;
-      const res = await fetch(`${API_HOST}/api/users/${user.id}`);
-      const data = await res.json();
-      if (data?.dept_id) setDeptId(data.dept_id);
-    }
-    if (!authLoading && user) init();
+    fetch(`${API_HOST}/api/schedules/${GYM_RES_ID}`)
+      .then(res => res.ok ? res.json() : null)
+      .then(data => data && setSchedule(data));
+  }, []);
+
+  // El departamento viene en la sesión del login, sin consultar /api/users
+  useEffect(() => {
+    if (!authLoading && user?.dept_id) setDeptId(user.dept_id);
   }, [user, authLoading]);
 
   useEffect(() => {
-    if (deptId) {
-      fetchAvailability();
-      const interval = setInterval(fetchAvailability, 20000);
-      return () => clearInterval(interval);
-    }
-  }, [deptId, fetchAvailability]);
+    if (deptId) fetchUserReservation();
+  }, [deptId, fetchUserReservation]);
+
+  // La ocupación llega por Server-Sent Events: un snapshot inicial y luego
+  // solo los bloques que cambian. EventSource reconecta solo si se corta.
+  useEffect(() => {
+    if (!deptId) return;
+    const source = new EventSource(`${API_HOST}/api/reserve/gym/availability/stream`);
+    source.addEventListener("snapshot", (e) => {
+      setAvailability(JSON.parse((e as MessageEvent).data));
+      setIsSyncing(false);
+    });
+    source.addEventListener("block", (e) => {
+      const delta = JSON.parse((e as MessageEvent).data);
+      setAvailability(prev => ({ ...(prev || {}), [delta.block]: delta.occupied }));
+    });
+    source.onerror = () => setIsSyncing(true);
+    return () => source.close();
+  }, [deptId]);
 
   const handleReserve = async () => {
     if (!selectedBlock || !deptId) return;
@@ -93,25 +101,29 @@ export default function GymPage() {
     // De acuerdo a la nueva API, el POST maneja tanto la creación como la actualización 
     // si el bloque coincide, pero el frontend prefiere ser explícito.
     try {
-      const res = await fetch(`${API_HOST}/api/reserve/gym`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ 
-            block: selectedBlock, 
-            attendees: attendees, 
-            dept_id: deptId 
-        }),
+      const res = await postIdempotent(`${API_HOST}/api/reserve/gym`, {
+        block: selectedBlock,
+        attendees: attendees,
+        dept_id: deptId,
       });
       
-      const result = await res.json();
-      
-      if (res.ok) {
+      let result = await res.json();
+
+      // En la apertura de bloques la API encola la solicitud y entrega un ticket
+      while (res.status === 202 && result.status === "pending") {
+        setMessage("Solicitud en cola, asignando cupos...");
+        const poll = await authFetch(`${API_HOST}/api/reserve/gym/tickets/${result.ticket}?wait=10`);
+        result = { ...result, ...(await poll.json()) };
+        if (!poll.ok) break;
+      }
+
+      if (res.status === 202 ? result.ok : res.ok) {
         setMessage(result.message || "Operación realizada con éxito.");
-        await fetchAvailability();
+        await fetchUserReservation();
       } else {
         setError(result.detail || "No se pudo procesar la reserva.");
-        // Si hay error, refrescamos para asegurar que el estado visual sea real
-        await fetchAvailability();
+        // Si hay error, refrescamos nuestra reserva; la ocupación llega por el stream
+        await fetchUserReservation();
       }
     } catch (e) {
       setError("Error de red al intentar conectar con la API.");
@@ -124,13 +136,13 @@ export default function GymPage() {
     if (!userReservation || !confirm("¿Eliminar tu reserva para liberar el cupo?")) return;
     setReserveLoading(true);
     try {
-      const res = await fetch(`${API_HOST}/api/reservations/${userReservation.id}`, { method: 'DELETE' });
+      const res = await authFetch(`${API_HOST}/api/reservations/${userReservation.id}`, { method: 'DELETE' });
       if (res.ok) {
         setUserReservation(null);
         setSelectedBlock(null);
         setAttendees(1);
         setMessage("Reserva cancelada exitosamente.");
-        await fetchAvailability();
+        await fetchUserReservation();
       } else {
           setError("No se pudo eliminar la reserva.");
       }
@@ -141,7 +153,7 @@ export default function GymPage() {
     }
   };
 
-  if (authLoading || availability === null) return (
+  if (authLoading || availability === null || schedule === null) return (
     <div className="min-h-screen bg-[#1A161D] flex items-center justify-center">
         <div className="text-[#C26B4E] font-bold animate-pulse tracking-widest uppercase text-xs">Sincronizando...</div>
     </div>
@@ -175,10 +187,10 @@ export default function GymPage() {
 
         <div className="grid grid-cols-1 lg:grid-cols-4 gap-8">
           <div className="lg:col-span-3 grid grid-cols-2 md:grid-cols-3 gap-3">
-            {BLOCKS.map(block => {
+            {schedule.slots.map(block => {
               const occupied = availability[block] ?? 0;
               const isSelected = selectedBlock === block;
-              const isFull = (3 - occupied) <= 0 && !isSelected;
+              const isFull = (schedule.capacity - occupied) <= 0 && !isSelected;
               
               // RESTRICCIÓN: Si ya hay reserva, bloqueamos visualmente el resto
               const isLocked = userReservation && !isSelected;
@@ -199,7 +211,7 @@ export default function GymPage() {
                   </span>
                   <div className="flex items-baseline gap-1">
                     <span className="text-2xl font-bold tracking-tighter">
-                        {3 - occupied}
+                        {schedule.capacity - occupied}
                     </span>
                     <span className="text-[10px] text-[#888888] uppercase font-bold">Cupos</span>
                   </div>
@@ -216,7 +228,7 @@ export default function GymPage() {
                 <div>
                   <label className="text-[10px] text-[#888888] uppercase block mb-3 font-bold">¿Cuántos asisten?</label>
                   <div className="flex bg-[#120F14] border border-[#362E3A] rounded-xl p-1">
-                    {[1, 2].map(n => (
+                    {Array.from({ length: schedule.dept_capacity }, (_, i) => i + 1).map(n => (
                       <button 
                         key={n}
                         onClick={() => setAttendees(n)}
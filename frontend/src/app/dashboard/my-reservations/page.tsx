@@ -2,7 +2,7 @@
 import { useEffect, useState } from "react";
 import { useAuth } from "../../AuthContext";
 import { useRouter } from "next/navigation";
-import { API_HOST } from "../../../config/api";
+import { API_HOST, authFetch } from "../../../config/api";
 import Link from "next/link";
 
 export default function MyReservationsPage() {
@@ -22,7 +22,7 @@ export default function MyReservationsPage() {
       setLoading(true);
       try {
         const [resReserv, resResour] = await Promise.all([
-          fetch(`${API_HOST}/api/reservations?user_id=${user.id}`),
+          authFetch(`${API_HOST}/api/reservations?user_id=${user.id}`),
           fetch(`${API_HOST}/api/resources`)
         ]);
         setReservations(await resReserv.json() || []);
@@ -38,7 +38,7 @@ export default function MyReservationsPage() {
 
   const handleCancel = async (id: number) => {
     if (!confirm("¿Deseas anular esta reserva?")) return;
-    const res = await fetch(`${API_HOST}/api/reservations/${id}`, { method: 'DELETE' });
+    const res = await authFetch(`${API_HOST}/api/reservations/${id}`, { method: 'DELETE' });
     if (res.ok) {
       setReservations(prev => prev.filter(r => r.id !== id));
     }
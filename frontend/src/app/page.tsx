@@ -31,7 +31,10 @@ export default function Home() {
           id: data.id,
           email: data.email,
           full_name: data.full_name,
+          dept_id: data.dept_id,
           is_admin: data.is_admin,
+          token: data.token,
+          refresh_token: data.refresh_token,
         };
         localStorage.setItem("user", JSON.stringify(usuario));
         setUser(usuario);
@@ -1 +1,55 @@
 export const API_HOST = process.env.NEXT_PUBLIC_API_HOST || "http://localhost:8001";
+
+// fetch con el token de sesión guardado por el login. Si expiró, se refresca
+// una vez con el token de refresco y se reintenta. También reenvía X-Last-Write
+// (hora de nuestra última escritura) para que la API lea del primario y no de
+// una réplica atrasada justo después de reservar.
+export async function authFetch(url: string, init: RequestInit = {}): Promise<Response> {
+  const stored = localStorage.getItem("user");
+  const user = stored ? JSON.parse(stored) : null;
+  const lastWrite = localStorage.getItem("lastWrite");
+  const withToken = (token?: string) => ({
+    ...init,
+    headers: {
+      ...(init.headers || {}),
+      ...(token ? { Authorization: `Bearer ${token}` } : {}),
+      ...(lastWrite ? { "X-Last-Write": lastWrite } : {}),
+    },
+  });
+  const res = rememberWrite(await fetch(url, withToken(user?.token)));
+  if (res.status !== 401 || !user?.refresh_token) return res;
+
+  const refreshed = await fetch(`${API_HOST}/api/login/refresh`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ refresh_token: user.refresh_token }),
+  });
+  if (!refreshed.ok) return res;
+  const session = await refreshed.json();
+  localStorage.setItem("user", JSON.stringify({ ...user, ...session }));
+  return rememberWrite(await fetch(url, withToken(session.token)));
+}
+
+function rememberWrite(res: Response): Response {
+  const lastWrite = res.headers.get("X-Last-Write");
+  if (lastWrite) localStorage.setItem("lastWrite", lastWrite);
+  return res;
+}
+
+// POST con Idempotency-Key: ante un corte de red se reintenta con la misma clave,
+// y si el primer intento sí llegó, la API devuelve la respuesta original.
+export async function postIdempotent(url: string, payload: unknown, retries = 2): Promise<Response> {
+  const key = crypto.randomUUID();
+  for (let attempt = 0; ; attempt++) {
+    try {
+      return await authFetch(url, {
+        method: "POST",
+        headers: { "Content-Type": "application/json", "Idempotency-Key": key },
+        body: JSON.stringify(payload),
+      });
+    } catch (e) {
+      if (attempt >= retries) throw e;
+      await new Promise(resolve => setTimeout(resolve, 500 * (attempt + 1)));
+    }
+  }
+}